@@ -1,17 +1,24 @@
 import os
-import sys
 import time
 import queue
-import random
+import shutil
 import string
-import ffmpeg
 import atexit
-import tempfile
 import threading
 import subprocess
 
+from pipeline_metrics import PipelineMetrics
 from synchronized_cache_file import SynchronizedCacheFile
 
+try:
+    from aax_converter import mp4_atoms
+    from aax_converter.streaming import StreamingConversion
+    from aax_converter.segmented import SegmentedConversion, write_concat_list, write_ffmetadata
+except ImportError:
+    import mp4_atoms
+    from streaming import StreamingConversion
+    from segmented import SegmentedConversion, write_concat_list, write_ffmetadata
+
 
 class AaxFileMetadata:
 
@@ -22,6 +29,9 @@ class AaxFileMetadata:
         self.copyright = ""
         self.date = ""  # Publication date
         self.aax_file = ""
+        self.output_file = ""
+        self.duration = 0.0  # Seconds
+        self.chapters = []  # (start, end, title), start and end in seconds
 
     @property
     def safe_title(self):
@@ -41,97 +51,315 @@ class AaxFileMetadata:
         return metadata
 
 
-class ConversionThreadWrapper:
-
-    def __init__(self, conversion_function, args):
-        self._args = args
-        self.active = True
-        self._conversion_function = conversion_function
-
-    def run(self):
-        self._conversion_function(self._args)
-        self.active = False
-
-
 class AaxConverter:
 
+    # Output format -> whether the audio is stream copied rather than re-encoded
+    OUTPUT_FORMATS = {
+        "mp3": False,
+        "m4a": True,
+        "m4b": True
+    }
+
     class __AaxConverter:
 
         def __init__(self, config, auth_bytes):
             self._alive = False
-            self._watcher_thread = None
-            self._requiring_cleanup = []
-            self._conversion_threads = []
+            self._worker_threads = []
             self._auth_bytes = auth_bytes
             self._ffmpeg = config["ffmpeg_path"]
-            self._ffprobe = config["ffprobe_path"]
-            self._max_threads = config["max_threads"]
+            self._max_threads = config.get("max_threads") or self._get_available_cores()
             self._library_dir = config["library_directory"]
+            self._output_format = config.get("output_format", "mp3")
+            if self._output_format not in AaxConverter.OUTPUT_FORMATS:
+                raise ValueError("Invalid output format: {0}".format(self._output_format))
+            self._stream_conversion = config.get("stream_conversion", False)
+            self._chapter_parallel_min_duration = config.get("chapter_parallel_min_duration", 0)
             self._pending_conversions = queue.Queue()
+            self._active_streams = 0
+            self._streams_changed = threading.Condition()
             self.conversion_finished_event = None
+            # Optional SynchronizedCacheFile that keeps parsed metadata between runs
+            self.metadata_cache = None
 
-        def _conversion_worker(self, aax_file):
-            probed_data = ffmpeg.probe(aax_file, cmd=self._ffprobe)
-            aax_metadata = AaxFileMetadata.from_dict(probed_data["format"]["tags"])
-            aax_metadata.aax_file = aax_file
-            output_file = os.path.join(self._library_dir, aax_metadata.safe_title + ".mp3")
-            command = ' '.join([
+        @staticmethod
+        def _get_available_cores():
+            try:
+                return len(os.sched_getaffinity(0))
+            except AttributeError:
+                return os.cpu_count() or 1
+
+        def _get_conversion_command(self, aax_file, aax_metadata, bit_rate, output_file):
+            # Passed to subprocess as a list, so titles with quotes or ampersands need no escaping
+            if AaxConverter.OUTPUT_FORMATS[self._output_format]:
+                # Decrypt and remux only, the AAC audio, tags and chapter list are carried over untouched
+                return [
+                    self._ffmpeg,
+                    "-loglevel", "error",
+                    "-y",
+                    "-activation_bytes", self._auth_bytes,
+                    "-i", aax_file,
+                    "-map", "0:a", "-codec", "copy",
+                    "-map_metadata", "0",
+                    "-map_chapters", "0",
+                    "-metadata", "genre=Audiobook",
+                    output_file
+                ]
+            return [
                 self._ffmpeg,
                 "-loglevel", "error",
-                "-stats",
+                "-y",
                 "-activation_bytes", self._auth_bytes,
-                "-i", '"{0}"'.format(aax_file),
+                "-i", aax_file,
                 "-vn", "-codec:a", "libmp3lame",
-                "-ab", probed_data["streams"][0]["bit_rate"],
+                "-ab", bit_rate,
                 "-map_metadata", "-1",
-                "-metadata", r'title="{0}"'.format(aax_metadata.title),
-                "-metadata", r'artist="{0}"'.format(aax_metadata.artist),
-                "-metadata", r'album="{0}"'.format(aax_metadata.album),
-                "-metadata", r'date="{0}"'.format(aax_metadata.date),
-                "-metadata", r'genre="Audiobook"',
-                "-metadata", r'copyright="{0}"'.format(aax_metadata.copyright),
-                output_file, "& exit"
-            ])
-            tmp_batch = ''.join(random.choices(string.ascii_letters, k=16)) + ".bat"
-            with open(tmp_batch, "w") as outfile:
-                outfile.write(command)
-            self._requiring_cleanup.append(tmp_batch)
-            os.system("start /wait cmd /k {0}".format(tmp_batch))
+                "-metadata", "title={0}".format(aax_metadata.title),
+                "-metadata", "artist={0}".format(aax_metadata.artist),
+                "-metadata", "album={0}".format(aax_metadata.album),
+                "-metadata", "date={0}".format(aax_metadata.date),
+                "-metadata", "genre=Audiobook",
+                "-metadata", "copyright={0}".format(aax_metadata.copyright),
+                output_file
+            ]
+
+        def _get_segment_command(self, aax_file, bit_rate, start, end, segment_file):
+            return [
+                self._ffmpeg,
+                "-loglevel", "error",
+                "-y",
+                "-activation_bytes", self._auth_bytes,
+                "-ss", "{0:.3f}".format(start),
+                "-t", "{0:.3f}".format(end - start),
+                "-i", aax_file,
+                "-vn", "-codec:a", "libmp3lame",
+                "-ab", bit_rate,
+                "-map_metadata", "-1",
+                "-map_chapters", "-1",
+                segment_file
+            ]
+
+        def _get_concat_command(self, concat_list, metadata_file, output_file):
+            # Segments are joined without re-encoding, tags and the full chapter table come from the metadata file
+            return [
+                self._ffmpeg,
+                "-loglevel", "error",
+                "-y",
+                "-f", "concat", "-safe", "0", "-i", concat_list,
+                "-f", "ffmetadata", "-i", metadata_file,
+                "-map", "0:a", "-codec", "copy",
+                "-map_metadata", "1",
+                "-map_chapters", "1",
+                output_file
+            ]
+
+        def _probe_metadata(self, aax_file):
+            # Read straight from the moov box, no ffprobe process per file
+            with PipelineMetrics().span("metadata_probe", os.path.basename(aax_file)):
+                parsed_data = mp4_atoms.get_metadata(aax_file, self.metadata_cache)
+            aax_metadata = AaxFileMetadata.from_dict(parsed_data)
+            aax_metadata.aax_file = aax_file
+            aax_metadata.duration = parsed_data["duration"]
+            aax_metadata.chapters = list(parsed_data["chapters"])
+            return aax_metadata, parsed_data["bit_rate"]
+
+        def _get_output_file(self, aax_metadata):
+            aax_metadata.output_file = os.path.join(
+                self._library_dir, "{0}.{1}".format(aax_metadata.safe_title, self._output_format))
+            return aax_metadata.output_file
+
+        def probe_file(self, aax_file):
+            """
+                Metadata for aax_file, with output_file set to where its conversion ends up in the library.
+            """
+            aax_metadata, _ = self._probe_metadata(aax_file)
+            self._get_output_file(aax_metadata)
+            return aax_metadata
+
+        @staticmethod
+        def _record_conversion(aax_metadata, started, succeeded, mode):
+            # One span per title from the first look at the file to the finished output, however it was converted
+            fields = {"mode": mode}
+            if succeeded:
+                try:
+                    fields["bytes"] = os.path.getsize(aax_metadata.aax_file)
+                    PipelineMetrics().increment("conversion_bytes_total", fields["bytes"])
+                except OSError:
+                    pass
+            PipelineMetrics().record_span("conversion", time.perf_counter() - started, aax_metadata.title,
+                                          "ok" if succeeded else "failed", **fields)
+
+        def _finish_conversion(self, aax_metadata):
             if self.conversion_finished_event is not None:
                 print("[*] Conversion of {0} finished, finalizing . . .".format(aax_metadata.title))
                 self.conversion_finished_event(aax_metadata)
 
-        def _watcher(self):
-            while self._alive:
-                if not self._pending_conversions.empty():
-                    if not len(self._conversion_threads) >= self._max_threads:
-                        aax_file_path = self._pending_conversions.get()
-                        conversion_wrapper = ConversionThreadWrapper(self._conversion_worker, aax_file_path)
-                        self._conversion_threads.append(conversion_wrapper)
-                        t = threading.Thread(target=conversion_wrapper.run)
-                        t.setDaemon(True)
-                        t.start()
-                        continue
-                self._conversion_threads = [x for x in self._conversion_threads if x.active]
-                time.sleep(0.5)
+        def _get_chapter_segments(self, aax_metadata):
+            """
+                Splits a long book into roughly one chapter aligned segment per worker.  Returns an empty list when the
+                book should be converted in one go.
+            """
+            if AaxConverter.OUTPUT_FORMATS[self._output_format] or self._max_threads < 2 or \
+                    not self._chapter_parallel_min_duration or \
+                    aax_metadata.duration < self._chapter_parallel_min_duration or len(aax_metadata.chapters) < 2:
+                return []
+            segment_length = aax_metadata.duration / self._max_threads
+            segments = []
+            segment_start = 0.0
+            for chapter_start, _, _ in aax_metadata.chapters[1:]:
+                if chapter_start - segment_start >= segment_length:
+                    segments.append((segment_start, chapter_start))
+                    segment_start = chapter_start
+            segments.append((segment_start, aax_metadata.duration))
+            return segments if len(segments) > 1 else []
+
+        def _run_ffmpeg(self, command, description, stage, title):
+            with PipelineMetrics().span(stage, title) as span:
+                result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+                if result.returncode:
+                    span.result = "failed"
+            if result.returncode:
+                print("[*] {0} failed: {1}".format(description, result.stderr.decode("utf-8", "replace").strip()))
+            return not result.returncode
+
+        def _join_segments(self, aax_metadata, work_directory, segment_files, succeeded, started):
+            try:
+                if succeeded:
+                    concat_list = os.path.join(work_directory, "segments.txt")
+                    metadata_file = os.path.join(work_directory, "metadata.txt")
+                    write_concat_list(concat_list, segment_files)
+                    write_ffmetadata(metadata_file, {
+                        "title": aax_metadata.title,
+                        "artist": aax_metadata.artist,
+                        "album": aax_metadata.album,
+                        "date": aax_metadata.date,
+                        "genre": "Audiobook",
+                        "copyright": aax_metadata.copyright
+                    }, aax_metadata.chapters)
+                    command = self._get_concat_command(concat_list, metadata_file, aax_metadata.output_file)
+                    succeeded = self._run_ffmpeg(command, "Joining segments of {0}".format(aax_metadata.title),
+                                                 "join_segments", aax_metadata.title)
+                    self._record_conversion(aax_metadata, started, succeeded, "segmented")
+                    if succeeded:
+                        self._finish_conversion(aax_metadata)
+                else:
+                    self._record_conversion(aax_metadata, started, False, "segmented")
+                    print("[*] Conversion of {0} failed, a segment could not be converted.".format(aax_metadata.title))
+            finally:
+                shutil.rmtree(work_directory, ignore_errors=True)
+
+        def _start_segmented_conversion(self, aax_file, aax_metadata, bit_rate, segments, started):
+            print("[*] Converting {0} as {1} chapter aligned segments".format(aax_metadata.title, len(segments)))
+            work_directory = os.path.join(self._library_dir, ".segments_{0}".format(aax_metadata.safe_title))
+            os.makedirs(work_directory, exist_ok=True)
+            conversion = SegmentedConversion(
+                segments, work_directory, ".{0}".format(self._output_format),
+                lambda start, end, segment_file: self._run_ffmpeg(
+                    self._get_segment_command(aax_file, bit_rate, start, end, segment_file),
+                    "Converting {0} segment {1:.0f}s - {2:.0f}s".format(aax_metadata.title, start, end),
+                    "transcode_segment", aax_metadata.title),
+                lambda segment_files, succeeded: self._join_segments(
+                    aax_metadata, work_directory, segment_files, succeeded, started),
+                self._pending_conversions.put
+            )
+            for job in conversion.jobs():
+                self._pending_conversions.put(job)
+
+        def _conversion_worker(self, aax_file):
+            started = time.perf_counter()
+            aax_metadata, bit_rate = self._probe_metadata(aax_file)
+            output_file = self._get_output_file(aax_metadata)
+            segments = self._get_chapter_segments(aax_metadata)
+            if segments:
+                self._start_segmented_conversion(aax_file, aax_metadata, bit_rate, segments, started)
+                return
+            command = self._get_conversion_command(aax_file, aax_metadata, bit_rate, output_file)
+            succeeded = self._run_ffmpeg(command, "Conversion of {0}".format(aax_metadata.title), "transcode",
+                                         aax_metadata.title)
+            self._record_conversion(aax_metadata, started, succeeded, "file")
+            if succeeded:
+                self._finish_conversion(aax_metadata)
+
+        def _start_streaming_process(self, partial_file):
+            # The moov box is already on disk by the time this runs, which is all the metadata parser needs
+            aax_metadata, bit_rate = self._probe_metadata(partial_file)
+            command = self._get_conversion_command("pipe:0", aax_metadata, bit_rate,
+                                                   self._get_output_file(aax_metadata))
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+            return aax_metadata, process
+
+        def _streaming_finished(self, aax_metadata, aax_file, succeeded, started):
+            try:
+                if succeeded:
+                    aax_metadata.aax_file = aax_file
+                    self._record_conversion(aax_metadata, started, True, "stream")
+                    self._finish_conversion(aax_metadata)
+                elif aax_file:
+                    self.convert_file(aax_file)
+            except OSError as e:
+                print("[*] Finalizing streamed conversion of {0} failed: {1}".format(aax_file, e))
+            finally:
+                with self._streams_changed:
+                    self._active_streams -= 1
+                    self._streams_changed.notify_all()
+
+        def open_stream(self, partial_file):
+            """
+                Returns a StreamingConversion to tee a fresh download of partial_file into, or None when streaming
+                conversion is turned off.  Whatever can't be streamed falls back to convert_file().
+            """
+            if not self._stream_conversion:
+                return None
+            with self._streams_changed:
+                self._active_streams += 1
+            started = time.perf_counter()
+            return StreamingConversion(
+                lambda: self._start_streaming_process(partial_file),
+                lambda aax_metadata, aax_file, succeeded: self._streaming_finished(
+                    aax_metadata, aax_file, succeeded, started))
+
+        def _worker(self):
+            while True:
+                aax_file_path = self._pending_conversions.get()
+                try:
+                    if aax_file_path is None:
+                        break
+                    elif callable(aax_file_path):
+                        # Segment of a book that's being converted chapter by chapter
+                        aax_file_path()
+                    else:
+                        self._conversion_worker(aax_file_path)
+                except (ValueError, OSError, KeyError) as e:
+                    print("[*] Conversion of {0} failed: {1}".format(aax_file_path, e))
+                finally:
+                    self._pending_conversions.task_done()
 
         def start(self):
             self._alive = True
-            self._watcher_thread = threading.Thread(target=self._watcher)
-            self._watcher_thread.setDaemon(True)
-            self._watcher_thread.start()
+            PipelineMetrics().track_gauge("queue_depth", self._pending_conversions.qsize, queue="conversions")
+            PipelineMetrics().track_gauge("queue_depth", lambda: self._active_streams, queue="conversion_streams")
+            for _ in range(self._max_threads):
+                t = threading.Thread(target=self._worker)
+                t.setDaemon(True)
+                t.start()
+                self._worker_threads.append(t)
 
         def convert_file(self, file_path):
             self._pending_conversions.put(file_path)
 
         def cleanup(self):
-            for filename in self._requiring_cleanup:
-                if os.path.isfile(filename):
-                    os.unlink(filename)
+            # Lets idle workers exit, anything still converting is abandoned along with the process
+            if self._alive:
+                self._alive = False
+                for _ in self._worker_threads:
+                    self._pending_conversions.put(None)
 
         def wait_for_conversion_completion(self):
-            while not self._pending_conversions.empty() and len(self._conversion_threads):
-                time.sleep(10)
+            # Streams go first, a stream that can't finish hands its file to the regular queue
+            with self._streams_changed:
+                self._streams_changed.wait_for(lambda: not self._active_streams)
+            self._pending_conversions.join()
 
     __instance = None
 
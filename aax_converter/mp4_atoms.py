@@ -0,0 +1,336 @@
+import os
+import struct
+import threading
+
+from collections import OrderedDict
+
+
+class Mp4Box:
+
+    def __init__(self, box_type, offset, size, header_size):
+        self.type = box_type
+        self.offset = offset
+        self.size = size
+        self.header_size = header_size
+
+    @property
+    def data_offset(self):
+        return self.offset + self.header_size
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+
+class Mp4MetadataParser:
+    """
+        Reads the metadata ffprobe used to give us straight out of the moov box of an MP4/AAX file.  Only box headers
+        and the handful of small boxes that carry tags, timing and chapter data are read, the audio samples (and the
+        audio track's sample tables, which run to megabytes on long books) are skipped over.
+    """
+
+    # ilst item -> AaxFileMetadata field, the same tags ffprobe reported as title/artist/album/date/copyright
+    ILST_TAGS = {
+        b"\xa9nam": "title",
+        b"\xa9ART": "artist",
+        b"\xa9alb": "album",
+        b"\xa9day": "date",
+        b"cprt": "copyright"
+    }
+    AUDIO_SAMPLE_ENTRY_SIZE = 28
+
+    def __init__(self, infile):
+        self._file = infile
+        self._file_size = os.fstat(infile.fileno()).st_size
+
+    def _read_exact(self, length):
+        data = self._file.read(length)
+        if len(data) != length:
+            raise ValueError("Unexpected end of file at offset {0}".format(self._file.tell()))
+        return data
+
+    def _iter_boxes(self, start, end):
+        offset = start
+        while offset + 8 <= end:
+            self._file.seek(offset)
+            box_size, box_type = struct.unpack(">I4s", self._read_exact(8))
+            header_size = 8
+            if box_size == 1:
+                box_size = struct.unpack(">Q", self._read_exact(8))[0]
+                header_size = 16
+            elif box_size == 0:
+                box_size = end - offset
+            if box_size < header_size:
+                raise ValueError("Invalid MP4 box size at offset {0}".format(offset))
+            yield Mp4Box(box_type, offset, box_size, header_size)
+            offset += box_size
+
+    def _children(self, box, skip=0):
+        return self._iter_boxes(box.data_offset + skip, box.end)
+
+    def _find_child(self, box, box_type, skip=0):
+        for child in self._children(box, skip):
+            if child.type == box_type:
+                return child
+        return None
+
+    def _read(self, box):
+        self._file.seek(box.data_offset)
+        return self._read_exact(box.size - box.header_size)
+
+    @staticmethod
+    def _parse_timing(data):
+        # mvhd and mdhd share the layout: version, flags, creation/modification time, timescale, duration
+        if data[0] == 1:
+            return struct.unpack(">IQ", data[20:32])
+        return struct.unpack(">II", data[12:20])
+
+    def _parse_tags(self, udta):
+        tags = {}
+        meta = self._find_child(udta, b"meta")
+        if meta is None:
+            return tags
+        # ISO meta is a full box with version and flags, the QuickTime flavour goes straight into its children
+        self._file.seek(meta.data_offset)
+        skip = 0 if self._file.read(8)[4:8] == b"hdlr" else 4
+        ilst = self._find_child(meta, b"ilst", skip)
+        if ilst is None:
+            return tags
+        for item in self._children(ilst):
+            if item.type not in self.ILST_TAGS:
+                continue
+            data_box = self._find_child(item, b"data")
+            if data_box is not None:
+                # type indicator and locale come before the value
+                tags[self.ILST_TAGS[item.type]] = self._read(data_box)[8:].decode("utf-8", "replace")
+        return tags
+
+    def _parse_nero_chapters(self, udta, duration):
+        chpl = self._find_child(udta, b"chpl")
+        if chpl is None:
+            return []
+        data = self._read(chpl)
+        # version, flags, reserved byte, then a count and (100ns start, length prefixed title) per chapter
+        offset = 5 if data[0] else 4
+        chapter_count = data[offset]
+        offset += 1
+        starts = []
+        for _ in range(chapter_count):
+            start, title_length = struct.unpack(">QB", data[offset:offset + 9])
+            starts.append((start / 10000000.0, data[offset + 9:offset + 9 + title_length].decode("utf-8", "replace")))
+            offset += 9 + title_length
+        return [(start, starts[i + 1][0] if i + 1 < len(starts) else duration, title)
+                for i, (start, title) in enumerate(starts)]
+
+    @staticmethod
+    def _parse_avg_bitrate(esds_data):
+        # esds: version/flags, then an ES_Descriptor (tag 3) holding a DecoderConfigDescriptor (tag 4)
+        position = 4
+
+        def read_descriptor_header(position):
+            tag = esds_data[position]
+            position += 1
+            for _ in range(4):
+                size_byte = esds_data[position]
+                position += 1
+                if not size_byte & 0x80:
+                    break
+            return tag, position
+
+        tag, position = read_descriptor_header(position)
+        if tag != 0x03:
+            return 0
+        flags = esds_data[position + 2]
+        position += 3
+        if flags & 0x80:
+            position += 2
+        if flags & 0x40:
+            position += 1 + esds_data[position]
+        if flags & 0x20:
+            position += 2
+        tag, position = read_descriptor_header(position)
+        if tag != 0x04:
+            return 0
+        return struct.unpack(">I", esds_data[position + 9:position + 13])[0]
+
+    def _parse_sample_entry(self, stsd):
+        # stsd: version/flags and entry count ahead of the sample entries
+        for sample_entry in self._children(stsd, 8):
+            esds = self._find_child(sample_entry, b"esds", self.AUDIO_SAMPLE_ENTRY_SIZE)
+            if esds is not None:
+                return self._parse_avg_bitrate(self._read(esds))
+        return 0
+
+    def _parse_track(self, trak):
+        track = {"chapter_tracks": [], "avg_bitrate": 0}
+        for child in self._children(trak):
+            if child.type == b"tkhd":
+                data = self._read(child)
+                track["id"] = struct.unpack(">I", data[20:24] if data[0] == 1 else data[12:16])[0]
+            elif child.type == b"tref":
+                chap = self._find_child(child, b"chap")
+                if chap is not None:
+                    data = self._read(chap)
+                    track["chapter_tracks"] = list(struct.unpack(">{0}I".format(len(data) // 4), data))
+            elif child.type == b"mdia":
+                for mdia_child in self._children(child):
+                    if mdia_child.type == b"mdhd":
+                        track["timescale"], track["duration"] = self._parse_timing(self._read(mdia_child))
+                    elif mdia_child.type == b"hdlr":
+                        track["handler"] = self._read(mdia_child)[8:12]
+                    elif mdia_child.type == b"minf":
+                        track["stbl"] = self._find_child(mdia_child, b"stbl")
+        if track.get("handler") == b"soun" and track.get("stbl") is not None:
+            stsd = self._find_child(track["stbl"], b"stsd")
+            if stsd is not None:
+                track["avg_bitrate"] = self._parse_sample_entry(stsd)
+        return track
+
+    def _read_sample_table(self, stbl):
+        tables = {}
+        for child in self._children(stbl):
+            if child.type in (b"stts", b"stsz", b"stsc", b"stco", b"co64"):
+                tables[child.type] = self._read(child)
+        return tables
+
+    def _parse_text_track_chapters(self, track, duration):
+        tables = self._read_sample_table(track["stbl"])
+        if not all(x in tables for x in (b"stts", b"stsz", b"stsc")) or not (b"stco" in tables or b"co64" in tables):
+            return []
+        sample_durations = []
+        stts = tables[b"stts"]
+        for i in range(struct.unpack(">I", stts[4:8])[0]):
+            sample_count, sample_delta = struct.unpack(">II", stts[8 + i * 8:16 + i * 8])
+            sample_durations.extend([sample_delta] * sample_count)
+        stsz = tables[b"stsz"]
+        sample_size, sample_count = struct.unpack(">II", stsz[4:12])
+        sample_sizes = [sample_size] * sample_count if sample_size else \
+            list(struct.unpack(">{0}I".format(sample_count), stsz[12:12 + sample_count * 4]))
+        if b"co64" in tables:
+            chunk_count = struct.unpack(">I", tables[b"co64"][4:8])[0]
+            chunk_offsets = struct.unpack(">{0}Q".format(chunk_count), tables[b"co64"][8:8 + chunk_count * 8])
+        else:
+            chunk_count = struct.unpack(">I", tables[b"stco"][4:8])[0]
+            chunk_offsets = struct.unpack(">{0}I".format(chunk_count), tables[b"stco"][8:8 + chunk_count * 4])
+        stsc = tables[b"stsc"]
+        stsc_entries = [struct.unpack(">III", stsc[8 + i * 12:20 + i * 12])
+                        for i in range(struct.unpack(">I", stsc[4:8])[0])]
+        sample_offsets = []
+        for i, (first_chunk, samples_per_chunk, _) in enumerate(stsc_entries):
+            next_first_chunk = stsc_entries[i + 1][0] if i + 1 < len(stsc_entries) else chunk_count + 1
+            for chunk in range(first_chunk, next_first_chunk):
+                offset = chunk_offsets[chunk - 1]
+                for _ in range(samples_per_chunk):
+                    if len(sample_offsets) == sample_count:
+                        break
+                    sample_offsets.append(offset)
+                    offset += sample_sizes[len(sample_offsets) - 1]
+        chapters = []
+        start = 0
+        for sample_offset, sample_size, sample_duration in zip(sample_offsets, sample_sizes, sample_durations):
+            # Each text sample is a 16 bit length followed by the chapter title
+            self._file.seek(sample_offset)
+            sample = self._file.read(sample_size)
+            title_length = struct.unpack(">H", sample[:2])[0] if len(sample) >= 2 else 0
+            title_bytes = sample[2:2 + title_length]
+            title = title_bytes.decode("utf-16") if title_bytes.startswith((b"\xfe\xff", b"\xff\xfe")) else \
+                title_bytes.decode("utf-8", "replace")
+            chapters.append((start / track["timescale"], min((start + sample_duration) / track["timescale"],
+                                                             duration), title))
+            start += sample_duration
+        return chapters
+
+    def parse(self):
+        """
+            Raises ValueError for anything that isn't a readable MP4/AAX file, truncated and corrupt ones included.
+        """
+        try:
+            return self._parse()
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ValueError("Corrupt MP4 metadata: {0}".format(e))
+
+    def _parse(self):
+        moov = None
+        for box in self._iter_boxes(0, self._file_size):
+            if box.type == b"moov":
+                moov = box
+                break
+        if moov is None:
+            raise ValueError("No moov box found, not an MP4/AAX file.")
+        metadata = {"title": "", "artist": "", "album": "", "date": "", "copyright": ""}
+        duration = 0.0
+        tracks = []
+        udta = None
+        for child in self._children(moov):
+            if child.type == b"mvhd":
+                timescale, duration_units = self._parse_timing(self._read(child))
+                duration = duration_units / float(timescale) if timescale else 0.0
+            elif child.type == b"trak":
+                tracks.append(self._parse_track(child))
+            elif child.type == b"udta":
+                udta = child
+        if udta is not None:
+            metadata.update(self._parse_tags(udta))
+        audio_tracks = [x for x in tracks if x.get("handler") == b"soun"]
+        if not audio_tracks:
+            raise ValueError("No audio track found.")
+        audio_track = audio_tracks[0]
+        chapters = []
+        for track in tracks:
+            if track.get("id") in audio_track["chapter_tracks"] and track.get("stbl") is not None:
+                chapters = self._parse_text_track_chapters(track, duration)
+                break
+        if not chapters and udta is not None:
+            chapters = self._parse_nero_chapters(udta, duration)
+        bit_rate = audio_track["avg_bitrate"]
+        if not bit_rate and duration:
+            # Same estimate ffprobe falls back on: everything outside the moov box over the running time
+            bit_rate = int((self._file_size - moov.size) * 8 / duration)
+        metadata["bit_rate"] = str(bit_rate)
+        metadata["duration"] = duration
+        metadata["chapters"] = chapters
+        return metadata
+
+
+class _MetadataCache:
+    """
+        Parsed metadata keyed by path, size and modification time, so files queued again aren't parsed twice while
+        unchanged.  Kept in memory for the run, and across runs in persistent_cache (a SynchronizedCacheFile or any
+        dict like object) when one is passed in.
+    """
+
+    MAX_ENTRIES = 4096
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_metadata(self, file_path, persistent_cache=None):
+        with open(file_path, "rb") as infile:
+            file_stat = os.fstat(infile.fileno())
+            absolute_path = os.path.abspath(file_path)
+            cache_key = (absolute_path, file_stat.st_size, file_stat.st_mtime_ns)
+            with self._lock:
+                if cache_key in self._entries:
+                    self._entries.move_to_end(cache_key)
+                    return self._entries[cache_key]
+            cache_entry = persistent_cache.get(absolute_path) if persistent_cache is not None else None
+            if cache_entry and (cache_entry["size"], cache_entry["mtime"]) == cache_key[1:]:
+                metadata = cache_entry["metadata"]
+            else:
+                metadata = Mp4MetadataParser(infile).parse()
+                if persistent_cache is not None:
+                    persistent_cache[absolute_path] = {"size": file_stat.st_size, "mtime": file_stat.st_mtime_ns,
+                                                       "metadata": metadata}
+        with self._lock:
+            self._entries[cache_key] = metadata
+            if len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+        return metadata
+
+
+_metadata_cache = _MetadataCache()
+
+
+def get_metadata(file_path, persistent_cache=None):
+    return _metadata_cache.get_metadata(file_path, persistent_cache)
@@ -0,0 +1,84 @@
+import os
+import threading
+
+
+def escape_ffmetadata(value):
+    for special_character in ("\\", "=", ";", "#", "\n"):
+        value = value.replace(special_character, "\\" + special_character)
+    return value
+
+
+def write_ffmetadata(file_path, tags, chapters):
+    # https://ffmpeg.org/ffmpeg-formats.html#Metadata-1
+    with open(file_path, "w", encoding="utf-8") as outfile:
+        outfile.write(";FFMETADATA1\n")
+        for key, value in tags.items():
+            outfile.write("{0}={1}\n".format(key, escape_ffmetadata(value)))
+        for start, end, title in chapters:
+            outfile.write("[CHAPTER]\nTIMEBASE=1/1000\nSTART={0}\nEND={1}\ntitle={2}\n".format(
+                int(start * 1000), int(end * 1000), escape_ffmetadata(title)))
+
+
+def write_concat_list(file_path, segment_files):
+    # https://ffmpeg.org/ffmpeg-formats.html#concat-1
+    with open(file_path, "w", encoding="utf-8") as outfile:
+        for segment_file in segment_files:
+            outfile.write("file '{0}'\n".format(os.path.abspath(segment_file).replace("'", "'\\''")))
+
+
+class SegmentJob:
+
+    def __init__(self, conversion, index):
+        self._conversion = conversion
+        self._index = index
+
+    def __call__(self):
+        self._conversion.run_segment(self._index)
+
+
+class SegmentedConversion:
+    """
+        One book converted as several chapter aligned segments, each one a job on the converter's worker pool.
+
+        convert_segment(start, end, segment_file) encodes a single segment and returns whether it worked, a failed
+        segment is handed back to requeue() on its own until it runs out of attempts.  Once every segment is done,
+        join_segments(segment_files, succeeded) is called exactly once by whichever worker finished last.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, segments, work_directory, extension, convert_segment, join_segments, requeue):
+        self._segments = segments
+        self._convert_segment = convert_segment
+        self._join_segments = join_segments
+        self._requeue = requeue
+        self._attempts = [0] * len(segments)
+        self._remaining = len(segments)
+        self._failed = False
+        self._lock = threading.Lock()
+        self.segment_files = [os.path.join(work_directory, "segment_{0:04d}{1}".format(i, extension))
+                              for i in range(len(segments))]
+
+    def jobs(self):
+        return [SegmentJob(self, i) for i in range(len(self._segments))]
+
+    def run_segment(self, index):
+        start, end = self._segments[index]
+        succeeded = False
+        if not self._failed:
+            try:
+                succeeded = self._convert_segment(start, end, self.segment_files[index])
+            except OSError as e:
+                print("[*] Segment {0} failed: {1}".format(index, e))
+        if not succeeded and not self._failed:
+            self._attempts[index] += 1
+            if self._attempts[index] < self.MAX_ATTEMPTS:
+                print("[*] Retrying segment {0} ({1:.0f}s - {2:.0f}s)".format(index, start, end))
+                self._requeue(SegmentJob(self, index))
+                return
+            self._failed = True
+        with self._lock:
+            self._remaining -= 1
+            finished = not self._remaining
+        if finished:
+            self._join_segments(self.segment_files, not self._failed)
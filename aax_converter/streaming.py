@@ -0,0 +1,162 @@
+import queue
+import struct
+import threading
+
+
+class Mp4LayoutSniffer:
+    """
+        Walks the top level boxes at the start of an MP4/AAX stream.  The file can only be decoded from a pipe when the
+        moov box (sample tables, metadata) arrives before the mdat box holding the audio.
+    """
+
+    # A moov box bigger than this is almost certainly not coming before the audio
+    MAX_HEAD_SIZE = 32 * 1024 * 1024
+
+    def __init__(self):
+        self.head = bytearray()
+        self._offset = 0
+
+    def feed(self, data):
+        """
+            Returns True once the whole moov box has been seen ahead of mdat, False when the layout requires seeking,
+            and None while more data is needed.
+        """
+        self.head += data
+        while len(self.head) >= self._offset + 8:
+            box_size, box_type = struct.unpack(">I4s", self.head[self._offset:self._offset + 8])
+            if box_size == 1:
+                if len(self.head) < self._offset + 16:
+                    return None
+                box_size = struct.unpack(">Q", self.head[self._offset + 8:self._offset + 16])[0]
+            if box_type == b"mdat" or box_size == 0 or box_size < 8:
+                return False
+            if box_type == b"moov":
+                return True if len(self.head) >= self._offset + box_size else self._check_head_size()
+            self._offset += box_size
+        return self._check_head_size()
+
+    def _check_head_size(self):
+        return False if len(self.head) > self.MAX_HEAD_SIZE else None
+
+
+class StreamingConversion:
+    """
+        Tees a download into a conversion process while the archival copy is still being written.
+
+        start_process() is called once the layout is known to be streamable and returns (metadata, process) for a
+        process reading the AAX from stdin.  on_finished(metadata, aax_file, succeeded) is called exactly once, with
+        succeeded False whenever the file has to go through the regular file based conversion instead.
+    """
+
+    # Download side blocks at most this long on a stalled conversion before giving up on streaming
+    STALL_TIMEOUT = 300
+    MAX_QUEUED_CHUNKS = 64
+
+    def __init__(self, start_process, on_finished):
+        self._start_process = start_process
+        self._on_finished = on_finished
+        self._sniffer = Mp4LayoutSniffer()
+        self._chunks = queue.Queue(maxsize=self.MAX_QUEUED_CHUNKS)
+        self._writer_thread = None
+        self._process = None
+        self._metadata = None
+        self._aax_file = None
+        self._streaming = None
+        self._finished = False
+        self._download_done = threading.Event()
+
+    def _start_streaming(self):
+        try:
+            self._metadata, self._process = self._start_process()
+        except Exception as e:
+            print("[*] Unable to start streaming conversion, falling back to file conversion: {0}".format(e))
+            self._streaming = False
+            return
+        self._streaming = True
+        self._writer_thread = threading.Thread(target=self._write_to_process)
+        self._writer_thread.setDaemon(True)
+        self._writer_thread.start()
+        self._enqueue(bytes(self._sniffer.head))
+        self._sniffer.head = bytearray()
+
+    def _enqueue(self, data):
+        try:
+            self._chunks.put(data, timeout=self.STALL_TIMEOUT)
+        except queue.Full:
+            self._stop_streaming()
+
+    def _drain(self):
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                break
+
+    def _stop_streaming(self):
+        self._streaming = False
+        if self._process.poll() is None:
+            self._process.kill()
+        # Unblock the writer thread if it's waiting for data
+        self._drain()
+        self._chunks.put(None)
+
+    def _write_to_process(self):
+        succeeded = False
+        try:
+            while True:
+                data = self._chunks.get()
+                if data is None:
+                    break
+                self._process.stdin.write(data)
+            self._process.stdin.close()
+            succeeded = self._process.wait() == 0
+        except (OSError, ValueError):
+            # The process went away early, stop queueing data and make sure nothing is left blocking feed()
+            self._streaming = False
+            self._process.kill()
+            self._drain()
+        self._process.wait()
+        # The archival file path is only known once the download side is done with this stream
+        self._download_done.wait()
+        succeeded = succeeded and self._streaming and self._aax_file is not None
+        self._on_finished(self._metadata, self._aax_file, succeeded)
+
+    def feed(self, data):
+        if self._streaming is None:
+            streamable = self._sniffer.feed(data)
+            if streamable:
+                self._start_streaming()
+            elif streamable is False:
+                self._streaming = False
+                self._sniffer.head = bytearray()
+        elif self._streaming:
+            self._enqueue(bytes(data))
+
+    def finish(self, aax_file):
+        """
+            Called with the final archival path once the download completed.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        self._aax_file = aax_file
+        if self._writer_thread:
+            # The writer thread reports the outcome, including falling back when streaming broke part way
+            if self._streaming:
+                self._enqueue(None)
+            self._download_done.set()
+        else:
+            self._on_finished(None, aax_file, False)
+
+    def abort(self):
+        """
+            Called when the download failed, nothing is converted.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if self._writer_thread:
+            self._stop_streaming()
+            self._download_done.set()
+        else:
+            self._on_finished(None, None, False)
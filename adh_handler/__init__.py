@@ -1,53 +1,366 @@
+import os
+import time
+import urllib3
 import requests
 import tempfile
+import threading
 import progressbar
 
+from concurrent.futures import ThreadPoolExecutor
+
+from file_integrity import BlockHashes, BLOCK_SIZE
+from pipeline_metrics import PipelineMetrics
+
 try:
     import adh_handler.adh_parser
 except ImportError:
     import adm_parser
 
+# Responses a CDN sends when it wants fewer or slower requests, the download is worth retrying later
+THROTTLED_STATUS_CODES = (429, 503)
+
 
 class DownloadData(object):
 
-    def __init__(self):
+    def __init__(self, tempfile_path=None):
         self.title = ""
         self.content_length = 0
         self.download_progress = 0
-        self.tempfile = tempfile.mktemp()
+        self.verified_offset = 0  # Bytes flushed to disk that a later run can resume from
+        self.etag = ""
+        self.last_modified = ""
+        self.tempfile = tempfile_path or tempfile.mktemp()
+        # Hashed as it's written, see file_integrity
+        self.block_hashes = None
+
+    @property
+    def complete(self):
+        return bool(self.content_length) and self.download_progress >= self.content_length
+
+    @property
+    def validator(self):
+        # Weak ETags aren't allowed in If-Range, Last-Modified is the next best thing
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    @property
+    def checksum(self):
+        return self.block_hashes.digest if self.block_hashes and self.complete else None
+
+    def to_dict(self):
+        return {
+            "tempfile": self.tempfile,
+            "content_length": self.content_length,
+            "verified_offset": self.verified_offset,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "block_hashes": self.block_hashes.get_digests(self.verified_offset) if self.block_hashes else []
+        }
+
+    @staticmethod
+    def from_dict(state_dict):
+        download_data = DownloadData(state_dict["tempfile"])
+        download_data.content_length = state_dict["content_length"]
+        download_data.verified_offset = state_dict["verified_offset"]
+        download_data.etag = state_dict["etag"]
+        download_data.last_modified = state_dict["last_modified"]
+        if state_dict.get("block_hashes"):
+            download_data.block_hashes = BlockHashes(download_data.content_length, state_dict["block_hashes"])
+        return download_data
+
+
+class _ResponseReader:
+    """
+        readinto() over a streamed response.  Plain bodies are read straight from the connection into the caller's
+        buffer, encoded bodies go through requests' decoder and are copied in.
+    """
+
+    def __init__(self, response, chunk_size):
+        self._response = response
+        self._chunks = None
+        self._leftover = b""
+        if response.headers.get("content-encoding", "identity").lower() != "identity":
+            self._chunks = response.iter_content(chunk_size=chunk_size)
+
+    def readinto(self, view):
+        if self._chunks is None:
+            try:
+                return self._response.raw.readinto(view)
+            except urllib3.exceptions.HTTPError as e:
+                raise requests.exceptions.ChunkedEncodingError(e)
+        if not self._leftover:
+            self._leftover = next(self._chunks, b"")
+        count = min(len(view), len(self._leftover))
+        view[:count] = self._leftover[:count]
+        self._leftover = self._leftover[count:]
+        return count
 
 
 class AudibleDownloader:
 
-    def __init__(self, cdn_hostname, user_agent_string):
+    # Files smaller than this per segment aren't worth splitting into parallel range requests
+    MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+    # How much data may be written between two resumable checkpoints being reported
+    CHECKPOINT_INTERVAL = 16 * 1024 * 1024
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+    # download_data_callback fires at most once per interval, unless this many bytes arrived since the last call
+    DEFAULT_PROGRESS_INTERVAL = 0.5
+    DEFAULT_PROGRESS_BYTES = 32 * 1024 * 1024
+    # Seconds to connect, and without a single byte arriving, before the connection counts as dropped
+    DEFAULT_TIMEOUT = (10, 60)
+
+    def __init__(self, cdn_hostname, user_agent_string, session=None, segments=1, buffer_size=DEFAULT_BUFFER_SIZE,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL, progress_bytes=DEFAULT_PROGRESS_BYTES,
+                 timeout=DEFAULT_TIMEOUT):
         self._headers = {"User-Agent": user_agent_string}
+        self._timeout = tuple(timeout)
         self._cdn_hostname = cdn_hostname
+        self._session = session if session is not None else requests
+        self._segments = max(1, segments)
+        self._buffer_size = max(4096, buffer_size)
+        self._progress_interval = progress_interval
+        self._progress_bytes = progress_bytes
+        self._progress_lock = threading.Lock()
+        self._reported_progress = 0
+        self._reported_time = 0
+        self._received_bytes = 0
+        self._metrics = PipelineMetrics()
         self.download_data_callback = None
+        self.download_state_callback = None
+        # Receives every byte of a download that starts at offset zero, in order, as it's written to disk
+        self.download_stream_callback = None
+        # A DownloadScheduler shared by all downloads, every chunk received is passed through its consume()
+        self.download_scheduler = None
+
+    @staticmethod
+    def create_session(pool_size):
+        # A single session shared between download threads, sized so that every thread keeps its own connection alive
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
     @staticmethod
     def _get_adm_data(adm_file):
         return adh_parser.AdhParser(adm_file).parse_adm_file()
 
-    def _handle_multipart_download(self, response, download_data):
-        download_data.content_length = response.headers.get("content-length")
-        if not download_data.content_length:
+    @staticmethod
+    def _record_validators(response, download_data):
+        download_data.etag = response.headers.get("etag", "")
+        download_data.last_modified = response.headers.get("last-modified", "")
+
+    @staticmethod
+    def _preallocate(outfile, size):
+        # Reserve the whole file up front so the filesystem doesn't have to keep extending it while we write
+        outfile.truncate(size)
+        try:
+            os.posix_fallocate(outfile.fileno(), 0, size)
+        except (AttributeError, OSError):
+            pass
+
+    @staticmethod
+    def _write_all(outfile, view):
+        while view:
+            view = view[outfile.write(view):]
+
+    def _checkpoint(self, download_data, verified_offset):
+        with self._progress_lock:
+            download_data.verified_offset = verified_offset
+            if self.download_state_callback:
+                self.download_state_callback(download_data)
+
+    def _add_progress(self, download_data, byte_count):
+        self._metrics.increment("download_bytes_total", byte_count)
+        with self._progress_lock:
+            download_data.download_progress += byte_count
+            self._received_bytes += byte_count
+            if not self.download_data_callback:
+                return
+            now = time.monotonic()
+            if download_data.complete or now - self._reported_time >= self._progress_interval or \
+                    download_data.download_progress - self._reported_progress >= self._progress_bytes:
+                self._reported_time = now
+                self._reported_progress = download_data.download_progress
+                self.download_data_callback(download_data)
+
+    def _copy_response(self, response, outfile, download_data, length, checkpoint, stream_callback=None):
+        # Reads into one reusable buffer and writes straight from it, checkpoint(bytes_written) runs every interval
+        written = 0
+        unverified = 0
+        position = outfile.tell()
+        buffer = memoryview(bytearray(self._buffer_size))
+        reader = _ResponseReader(response, self._buffer_size)
+        while written < length:
+            byte_count = reader.readinto(buffer[:min(self._buffer_size, length - written)])
+            if not byte_count:
+                break
+            if self.download_scheduler:
+                self.download_scheduler.consume(byte_count)
+            self._write_all(outfile, buffer[:byte_count])
+            if download_data.block_hashes:
+                download_data.block_hashes.update(position + written, buffer[:byte_count])
+            if stream_callback:
+                stream_callback(buffer[:byte_count])
+            written += byte_count
+            unverified += byte_count
+            self._add_progress(download_data, byte_count)
+            if unverified >= self.CHECKPOINT_INTERVAL:
+                checkpoint(written)
+                unverified = 0
+        return written
+
+    def _handle_multipart_download(self, response, download_data, offset=0):
+        # An error page (a throttled 429 or 503 in particular) must never end up written out as audio
+        response.raise_for_status()
+        content_length = response.headers.get("content-length")
+        if not content_length:
             return False
-        download_data.content_length = int(download_data.content_length)
-        with open(download_data.tempfile, "wb") as outfile:
-            for data in response.iter_content(chunk_size=4096):
-                download_data.download_progress += len(data)
-                outfile.write(data)
-                outfile.flush()
-                if self.download_data_callback:
-                    self.download_data_callback(download_data)
-
-    def download_audiobook(self, adm_file):
+        self._record_validators(response, download_data)
+        download_data.content_length = offset + int(content_length)
+        download_data.download_progress = offset
+        if offset:
+            if not download_data.block_hashes:
+                download_data.block_hashes = BlockHashes(download_data.content_length)
+            download_data.block_hashes.resume(download_data.tempfile, offset)
+        else:
+            download_data.block_hashes = BlockHashes(download_data.content_length)
+        with open(download_data.tempfile, "r+b" if offset else "wb", buffering=0) as outfile:
+            self._preallocate(outfile, download_data.content_length)
+            # Recorded before any data arrives, a retry has to reuse this file rather than leave it behind
+            self._checkpoint(download_data, offset)
+            outfile.seek(offset)
+            self._copy_response(response, outfile, download_data, download_data.content_length - offset,
+                                lambda written: self._checkpoint(download_data, offset + written),
+                                None if offset else self.download_stream_callback)
+        self._checkpoint(download_data, download_data.download_progress)
+        return download_data.complete
+
+    def _get_range_response(self, download_url, start, end=None, validator=""):
+        headers = dict(self._headers)
+        headers["Range"] = "bytes={0}-{1}".format(start, "" if end is None else end)
+        if validator:
+            headers["If-Range"] = validator
+        return self._session.get(download_url, headers=headers, stream=True, timeout=self._timeout)
+
+    @staticmethod
+    def _raise_if_throttled(response):
+        if response.status_code in THROTTLED_STATUS_CODES:
+            response.raise_for_status()
+
+    @staticmethod
+    def _get_range_start_and_total(response):
+        # Content-Range: bytes <start>-<end>/<total>, only trusted on a 206 response
+        if response.status_code != 206:
+            return None, None
+        unit_and_range = response.headers.get("content-range", "").split(" ")
+        if len(unit_and_range) != 2 or unit_and_range[0] != "bytes":
+            return None, None
+        byte_range, _, total = unit_and_range[1].partition("/")
+        start = byte_range.partition("-")[0]
+        if not start.isdigit() or not total.isdigit():
+            return None, None
+        return int(start), int(total)
+
+    def _get_segment_bounds(self, content_length):
+        segment_count = max(1, min(self._segments, content_length // self.MIN_SEGMENT_SIZE))
+        segment_size = -(-content_length // segment_count)
+        # Whole hash blocks per segment, each block is then written front to back by a single stream
+        segment_size = -(-segment_size // BLOCK_SIZE) * BLOCK_SIZE
+        return [(offset, min(segment_size, content_length - offset))
+                for offset in range(0, content_length, segment_size)]
+
+    def _checkpoint_segments(self, download_data, segments, flushed):
+        # Only the unbroken run of data from the start of the file can be resumed with a single range request
+        verified_offset = 0
+        for offset, length in segments:
+            verified_offset += flushed[offset]
+            if flushed[offset] < length:
+                break
+        self._checkpoint(download_data, verified_offset)
+
+    def _write_segment(self, response, download_data, offset, length, segments, flushed):
+        def checkpoint(written):
+            flushed[offset] = written
+            self._checkpoint_segments(download_data, segments, flushed)
+
+        with open(download_data.tempfile, "r+b", buffering=0) as outfile:
+            outfile.seek(offset)
+            written = self._copy_response(response, outfile, download_data, length, checkpoint)
+        checkpoint(written)
+        return written == length
+
+    def _download_segment(self, download_url, download_data, offset, length, segments, flushed):
+        with self._get_range_response(download_url, offset, offset + length - 1) as response:
+            self._raise_if_throttled(response)
+            if self._get_range_start_and_total(response) != (offset, download_data.content_length):
+                return False
+            return self._write_segment(response, download_data, offset, length, segments, flushed)
+
+    def _handle_segmented_download(self, download_url, download_data):
+        # The first request is open ended, so a server that ignores Range still hands back the whole file
+        with self._get_range_response(download_url, 0) as response:
+            start, content_length = self._get_range_start_and_total(response)
+            if start != 0:
+                return self._handle_multipart_download(response, download_data)
+            self._record_validators(response, download_data)
+            download_data.content_length = content_length
+            download_data.block_hashes = BlockHashes(content_length)
+            segments = self._get_segment_bounds(content_length)
+            if len(segments) == 1:
+                return self._handle_multipart_download(response, download_data)
+            flushed = {offset: 0 for offset, _ in segments}
+            with open(download_data.tempfile, "wb") as outfile:
+                self._preallocate(outfile, content_length)
+            self._checkpoint(download_data, 0)
+            with ThreadPoolExecutor(max_workers=len(segments) - 1) as executor:
+                pending = [executor.submit(self._download_segment, download_url, download_data, offset, length,
+                                           segments, flushed)
+                           for offset, length in segments[1:]]
+                first_offset, first_length = segments[0]
+                results = [self._write_segment(response, download_data, first_offset, first_length,
+                                               segments, flushed)]
+                results.extend(future.result() for future in pending)
+        return all(results) and download_data.complete
+
+    def _resume_download(self, download_url, download_data):
+        offset = download_data.verified_offset
+        with self._get_range_response(download_url, offset, validator=download_data.validator) as response:
+            # Starting over would throw away the partial file for what's only a temporary refusal
+            self._raise_if_throttled(response)
+            start, content_length = self._get_range_start_and_total(response)
+            if start == offset and content_length == download_data.content_length:
+                print("[*] Resuming download of {0} at byte {1}".format(download_data.title, offset))
+                return self._handle_multipart_download(response, download_data, offset)
+            if response.status_code == 200:
+                # If-Range didn't match, so the server sent the current version of the file from the beginning
+                return self._handle_multipart_download(response, download_data)
+        return None
+
+    def download_audiobook(self, adm_file, download_data=None):
         adm_data = self._get_adm_data(adm_file)
-        download_progress = DownloadData()
+        download_progress = download_data if download_data is not None else DownloadData()
         download_progress.title = adm_data.title
-        response = requests.get("http://{0}/download?{1}".format(self._cdn_hostname, adm_data.to_http_params()),
-                                headers=self._headers, stream=True)
-        self._handle_multipart_download(response, download_progress)
+        download_url = "http://{0}/download?{1}".format(self._cdn_hostname, adm_data.to_http_params())
+        resumable = download_progress.verified_offset and os.path.isfile(download_progress.tempfile)
+        self._received_bytes = 0
+        with self._metrics.span("download", download_progress.title, resumed_from=0) as span:
+            if resumable:
+                span.fields["resumed_from"] = download_progress.verified_offset
+            if not resumable or self._resume_download(download_url, download_progress) is None:
+                download_progress.verified_offset = 0
+                if self._segments > 1:
+                    self._handle_segmented_download(download_url, download_progress)
+                else:
+                    with self._session.get(download_url, headers=self._headers, stream=True,
+                                           timeout=self._timeout) as response:
+                        self._handle_multipart_download(response, download_progress)
+            span.fields["bytes"] = self._received_bytes
+            span.fields["content_length"] = download_progress.content_length
+            if not download_progress.complete:
+                span.result = "incomplete"
+        return download_progress
 
 
 class DownloadProgressBar:
@@ -1,106 +1,213 @@
 import os
 import sys
 import json
+import time
 import string
 import random
 import requests
-import progressbar
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pipeline_metrics import PipelineMetrics
 
 using_python3 = sys.version_info[0] == 3
 
 try:
     from synchronized_cache_file import SynchronizedCacheFile
     from adh_handler.adh_parser import AdhParser
+    from adh_handler.library_page import parse_library_page
     from audible_driver.driver_config import AudibleDriverConfig
 except ImportError:
     from adh_parser import AdhParser
+    from library_page import parse_library_page
     from driver_config import AudibleDriverConfig
 
 
 class AdhDownloader:
 
-    def __init__(self, config: AudibleDriverConfig, adm_cache_file, adh_download_folder):
+    # Finished helper files are recorded in the cache in groups of this size rather than one commit per file
+    ADH_COMMIT_BATCH_SIZE = 50
+
+    SYNC_STATE_KEY = "library"
+
+    def __init__(self, config: AudibleDriverConfig, adm_cache_file, adh_download_folder, max_page_requests=4,
+                 sync_cache_file=None, full_sync_interval=7 * 24 * 60 * 60):
         self._config = config
         self._adm_cache_file = adm_cache_file
         self._adh_download_folder = adh_download_folder
+        self._max_page_requests = max(1, max_page_requests)
+        # Delta sync is only available with somewhere to keep the high-water mark
+        self._sync_cache_file = sync_cache_file
+        self._full_sync_interval = full_sync_interval
+        self.adh_file_callback = None
 
     @staticmethod
-    def _get_prepared_session(audible_session_data):
+    def _get_prepared_session(audible_session_data, pool_size=1):
         session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
         for cookie in audible_session_data["cookies"]:
             session.cookies.set(cookie["name"], cookie["value"])
         return session
 
+    def _download_adh_file(self, session, download_link, destination_file):
+        with PipelineMetrics().span("adh_fetch", os.path.basename(destination_file)) as span:
+            response = session.get(download_link, headers={"User-Agent": self._config.browser_user_agent})
+            response.raise_for_status()
+            # Written under a temporary name so a helper file only ever appears complete
+            temp_file = destination_file + ".tmp"
+            with open(temp_file, "wb") as outfile:
+                outfile.write(response.content)
+            os.replace(temp_file, destination_file)
+            span.fields["response_bytes"] = len(response.content)
+        return destination_file
+
+    def _get_adh_destination(self):
+        filename = "{0}.adh".format(''.join(random.choices(string.ascii_letters + string.digits, k=32)))
+        return os.path.join(self._adh_download_folder, filename)
+
+    def _load_adh_cache(self):
+        return SynchronizedCacheFile(self._adm_cache_file)
+
     @staticmethod
-    def _get_max_library_page(audible_library_html):
-        available_pages = []
-        soup = BeautifulSoup(audible_library_html, "html.parser")
-        page_links = soup.find_all("a", {"class": "pageNumberElement", "data-name": "page"})
-        for page_link in page_links:
-            try:
-                page_number = int(page_link['data-value'])
-                available_pages.append(page_number)
-            except ValueError:
-                pass
-        return max(available_pages)
+    def _save_adh_entries(adh_cache, adh_entries):
+        if adh_entries:
+            adh_cache.update(adh_entries)
+            adh_entries.clear()
 
     @staticmethod
-    def _get_adh_download_urls(audible_library_html):
-        download_urls = []
-        soup = BeautifulSoup(audible_library_html, "html.parser")
-        library_content = soup.findAll("div", id=lambda x: x and x.startswith("library-download-popover"))
-        for content_row in library_content:
-            content_adh_link = content_row.find_all("a", {"class": "bc-link", "aria-label": "DownloadFull"}, href=True)
-            if content_adh_link:
-                download_urls.append(content_adh_link[0]['href'])
-        return download_urls
+    def _get_missing_adh_links(adh_cache, page_links):
+        missing_links = {}
+        for adh_identifier, download_link in page_links:
+            # Entries from older runs could be recorded before their file was written, fetch those again
+            cached = adh_identifier in adh_cache and os.path.isfile(adh_cache[adh_identifier])
+            if not cached and adh_identifier not in missing_links:
+                missing_links[adh_identifier] = download_link
+        return missing_links
 
-    def _download_adh_file(self, session, download_link, destination_file):
-        response = session.get(download_link, headers={"User-Agent": self._config.browser_user_agent})
-        with open(destination_file, "wb") as outfile:
-            outfile.write(response.content)
-
-    def _process_adh_link(self, download_link, session):
-        with self._load_adh_cache() as adh_cache:
-            adh_identifier = AdhParser.get_adh_identifier(download_link)
-            if adh_identifier not in adh_cache:
-                filename = "{0}.adh".format(''.join(random.choices(string.ascii_letters + string.digits, k=32)))
-                dest_file = os.path.join(self._adh_download_folder, filename)
-                adh_cache[adh_identifier] = dest_file
-                self._download_adh_file(session, download_link, dest_file)
-                self._save_adh_cache(adh_cache)
+    def _hand_over_adh_file(self, adh_file):
+        # Blocks while the download stage is busy, which in turn holds back further library paging
+        if self.adh_file_callback is not None:
+            self.adh_file_callback(adh_file)
 
-    def _load_adh_cache(self):
-        return SynchronizedCacheFile(self._adm_cache_file)
+    def _download_adh_files(self, executor, session, adh_cache, missing_links):
+        failed_downloads = 0
+        adh_entries = {}
+        pending = {executor.submit(self._download_adh_file, session, download_link,
+                                   self._get_adh_destination()): adh_identifier
+                   for adh_identifier, download_link in missing_links.items()}
+        for adh_future in as_completed(pending):
+            try:
+                # Only files that made it to disk get a cache entry
+                adh_file = adh_future.result()
+            except (requests.RequestException, OSError) as e:
+                failed_downloads += 1
+                PipelineMetrics().increment("adh_files_total", result="error")
+                print("[*] Failed to download helper file {0}: {1}".format(missing_links[pending[adh_future]], e))
+                continue
+            PipelineMetrics().increment("adh_files_total", result="ok")
+            adh_entries[pending[adh_future]] = adh_file
+            if len(adh_entries) >= self.ADH_COMMIT_BATCH_SIZE:
+                self._save_adh_entries(adh_cache, adh_entries)
+            self._hand_over_adh_file(adh_file)
+        self._save_adh_entries(adh_cache, adh_entries)
+        return failed_downloads
 
-    def _save_adh_cache(self, cache_data):
-        cache_data.flush()
-
-    def download_adh_files(self, audible_session_data):
-        library_page = 1
-        adm_download_links = []
-        session = self._get_prepared_session(audible_session_data)
-        max_page = self._get_max_library_page(
-            str(session.get(
-                self._config.library_url.format("1"),
-                headers={"User-Agent": self._config.browser_user_agent}
-            ).content, 'utf-8')
-        )
-        for library_page in range(1, max_page + 1):
-            print("[*] Processing library page {0} . . .".format(library_page))
+    def _get_library_page(self, session, library_page):
+        with PipelineMetrics().span("library_page", "page {0}".format(library_page)) as span:
             response = session.get(self._config.library_url.format(library_page),
                                    headers={"User-Agent": self._config.browser_user_agent})
-            download_links = self._get_adh_download_urls(str(response.content, 'utf-8'))
-            if not download_links:
-                break
-            adm_download_links.extend(download_links)
-        print("[*] Found {0} audiobooks in your library.".format(len(adm_download_links)))
-        print("[*] Processing required helper files . . .")
-        i = 0
-        with progressbar.ProgressBar(max_value=len(adm_download_links)) as bar:
-            for download_link in adm_download_links:
-                self._process_adh_link(download_link, session)
-                i += 1
-                bar.update(i)
\ No newline at end of file
+            span.fields["response_bytes"] = len(response.content)
+        PipelineMetrics().increment("library_pages_total")
+        return str(response.content, 'utf-8')
+
+    def _iter_library_pages(self, session):
+        """
+            Yields (library_page, download_links) newest first.  Once a page has been handed out, a window of the
+            following pages is fetched ahead on the pool while it's being processed.  Nothing is requested past a
+            page the caller stopped iterating at, beyond what was already in flight.
+        """
+        max_page, first_page_links = parse_library_page(self._get_library_page(session, 1))
+        yield 1, first_page_links
+        pending_pages = {}
+        with ThreadPoolExecutor(max_workers=self._max_page_requests) as executor:
+            try:
+                for library_page in range(2, max_page + 1):
+                    last_page = min(max_page, library_page + self._max_page_requests - 1)
+                    for next_page in range(library_page, last_page + 1):
+                        if next_page not in pending_pages:
+                            pending_pages[next_page] = executor.submit(self._get_library_page, session, next_page)
+                    _, download_links = parse_library_page(pending_pages.pop(library_page).result())
+                    yield library_page, download_links
+            finally:
+                for page_future in pending_pages.values():
+                    page_future.cancel()
+
+    @staticmethod
+    def _is_synced_page(adh_cache, page_links, high_water_mark):
+        return any(x == high_water_mark for x, _ in page_links) or all(x in adh_cache for x, _ in page_links)
+
+    def _load_sync_state(self):
+        if not self._sync_cache_file:
+            return {}
+        return SynchronizedCacheFile(self._sync_cache_file).get(self.SYNC_STATE_KEY, {})
+
+    def _save_sync_state(self, sync_state):
+        if self._sync_cache_file:
+            with SynchronizedCacheFile(self._sync_cache_file) as sync_cache:
+                sync_cache[self.SYNC_STATE_KEY] = sync_state
+
+    def _use_delta_sync(self, sync_state, full_sync):
+        if full_sync or not self._sync_cache_file or "high_water_mark" not in sync_state:
+            return False
+        return time.time() - sync_state.get("last_full_sync", 0) < self._full_sync_interval
+
+    def download_adh_files(self, audible_session_data, full_sync=False):
+        """
+            Fetches the helper file of every title not downloaded yet, page by page.  Each helper file is handed to
+            adh_file_callback as soon as it's available, so downloads can start while later pages are still being
+            discovered.  Unless full_sync is set or the last full sync is older than the full sync interval, paging
+            stops at the first page without new titles.
+        """
+        sync_started = time.perf_counter()
+        title_count = 0
+        failed_downloads = 0
+        high_water_mark = None
+        sync_state = self._load_sync_state()
+        delta_sync = self._use_delta_sync(sync_state, full_sync)
+        # Page prefetching and helper file fetching each get a pool of max_page_requests
+        session = self._get_prepared_session(audible_session_data, self._max_page_requests * 2)
+        with self._load_adh_cache() as adh_cache, ThreadPoolExecutor(max_workers=self._max_page_requests) as executor:
+            print("[*] Starting {0} library sync . . .".format("delta" if delta_sync else "full"))
+            for library_page, download_links in self._iter_library_pages(session):
+                if not download_links:
+                    break
+                page_links = [(AdhParser.get_adh_identifier(x), x) for x in download_links]
+                high_water_mark = high_water_mark or page_links[0][0]
+                title_count += len(page_links)
+                # The library is sorted newest first, so everything past this page is known from an earlier sync
+                synced = delta_sync and self._is_synced_page(adh_cache, page_links, sync_state.get("high_water_mark"))
+                missing_links = self._get_missing_adh_links(adh_cache, page_links)
+                print("[*] Library page {0}: {1} titles, fetching {2} helper files . . .".format(
+                    library_page, len(page_links), len(missing_links)))
+                for adh_identifier, _ in page_links:
+                    if adh_identifier not in missing_links:
+                        self._hand_over_adh_file(adh_cache[adh_identifier])
+                failed_downloads += self._download_adh_files(executor, session, adh_cache, missing_links)
+                if synced:
+                    print("[*] Library page {0} holds no new titles, stopping delta sync.".format(library_page))
+                    break
+            print("[*] Found {0} audiobooks in your library.".format(title_count))
+        PipelineMetrics().record_span("library_sync", time.perf_counter() - sync_started,
+                                      result="incomplete" if failed_downloads else "ok",
+                                      mode="delta" if delta_sync else "full", titles=title_count,
+                                      failed=failed_downloads)
+        # Only a sync that got every helper file moves the high-water mark, otherwise the next run has to look again
+        if high_water_mark and not failed_downloads:
+            now = time.time()
+            self._save_sync_state({
+                "high_water_mark": high_water_mark,
+                "last_sync": now,
+                "last_full_sync": sync_state.get("last_full_sync", 0) if delta_sync else now
+            })
@@ -0,0 +1,223 @@
+import time
+import threading
+import contextlib
+
+from collections import deque
+
+from pipeline_metrics import PipelineMetrics
+
+
+class BandwidthSchedule:
+    """
+        Bandwidth limit by time of day.  windows is a list of {"start": "HH:MM", "end": "HH:MM", "bandwidth_limit": MB/s}
+        in local time, the first window containing the current time wins and a window may run past midnight.  Outside
+        every window default_limit applies.  A limit of 0 or None means unlimited.
+    """
+
+    def __init__(self, default_limit=None, windows=None):
+        self._default_limit = default_limit
+        self._windows = [(self._parse_time(x["start"]), self._parse_time(x["end"]), x.get("bandwidth_limit"))
+                         for x in windows or []]
+
+    @staticmethod
+    def _parse_time(time_of_day):
+        hours, _, minutes = time_of_day.partition(":")
+        return int(hours) * 60 + int(minutes or 0)
+
+    @staticmethod
+    def _to_bytes_per_second(limit):
+        return limit * 1e6 if limit else None
+
+    def get_limit(self, now=None):
+        """
+            Bytes per second allowed at now (seconds since the epoch), None when unlimited.
+        """
+        local_time = time.localtime(now)
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        for start, end, limit in self._windows:
+            in_window = start <= minute < end if start <= end else minute >= start or minute < end
+            if in_window:
+                return self._to_bytes_per_second(limit)
+        return self._to_bytes_per_second(self._default_limit)
+
+
+class DownloadScheduler:
+    """
+        Shared between every download of a run.  Each download holds a stream slot for as long as it runs and passes
+        every chunk it receives through consume(), which enforces the bandwidth schedule as one token bucket for all
+        streams and measures the combined throughput.
+
+        With adaptive set, the number of slots is tuned AIMD style once per adjust interval.  While every slot is in
+        use a slot is added, and kept only when it raised the combined throughput by at least MIN_GAIN.  Throttled or
+        dropped responses (record_congestion()) and sudden slow-downs halve the slots.  Running downloads are never
+        interrupted, a lowered limit only holds back the next ones.
+    """
+
+    ADJUST_INTERVAL = 5.0
+    # An extra stream has to add this share of throughput to be kept
+    MIN_GAIN = 0.1
+    # Throughput falling below this share of the last interval with the same streams counts as a slow-down
+    SLOWDOWN = 0.5
+    # Intervals to wait after backing off before probing with another stream again
+    HOLD_INTERVALS = 6
+    # Once this share of the bandwidth budget is used, or streams spend this share of the interval waiting for it,
+    # the budget and not the stream count is the bottleneck
+    BUDGET_USED = 0.9
+    BUDGET_WAIT = 0.1
+    # Idle time only builds up this many seconds of burst
+    MAX_BURST = 0.25
+    # How long a bandwidth limit looked up from the schedule is used before looking again
+    SCHEDULE_REFRESH = 30
+    HISTORY_LENGTH = 1000
+
+    def __init__(self, max_streams, initial_streams=None, schedule=None, adaptive=True,
+                 adjust_interval=ADJUST_INTERVAL, clock=time.monotonic):
+        self._max_streams = max(1, max_streams)
+        self._adaptive = adaptive
+        self._stream_limit = self._max_streams
+        if adaptive:
+            self._stream_limit = min(self._max_streams, max(1, initial_streams or 1))
+        self._schedule = schedule or BandwidthSchedule()
+        self._adjust_interval = adjust_interval
+        self._clock = clock
+        self._lock = threading.Condition()
+        now = self._clock()
+        self._active = 0
+        self._active_time = 0.0
+        self._last_change = now
+        self._interval_start = now
+        self._interval_bytes = 0
+        self._budget_wait = 0.0
+        self._congested = False
+        self._last_throughput = None
+        self._probe = None
+        self._hold_until = now
+        self._rate = None
+        self._rate_checked = None
+        self._tokens = 0.0
+        self._last_refill = now
+        # (time, throughput, average busy streams, stream limit, reason for a change) per adjust interval
+        self.history = deque(maxlen=self.HISTORY_LENGTH)
+        self._metrics = PipelineMetrics()
+        self._metrics.set_gauge("download_stream_limit", self._stream_limit)
+        self._metrics.track_gauge("bandwidth_limit_bytes_per_second", lambda: self._rate or 0)
+
+    @staticmethod
+    def from_config(config):
+        scheduler_config = config.get("download_scheduler") or {}
+        schedule = BandwidthSchedule(scheduler_config.get("bandwidth_limit"),
+                                     scheduler_config.get("bandwidth_schedule"))
+        return DownloadScheduler(int(config.get("max_downloads", 1)), scheduler_config.get("initial_downloads"),
+                                 schedule, scheduler_config.get("adaptive", False),
+                                 scheduler_config.get("adjust_interval", DownloadScheduler.ADJUST_INTERVAL))
+
+    @property
+    def stream_limit(self):
+        return self._stream_limit
+
+    def _track_active(self, now):
+        self._active_time += self._active * (now - self._last_change)
+        self._last_change = now
+
+    @contextlib.contextmanager
+    def stream(self):
+        with self._lock:
+            self._lock.wait_for(lambda: self._active < self._stream_limit)
+            self._track_active(self._clock())
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._track_active(self._clock())
+                self._active -= 1
+                self._lock.notify_all()
+
+    def _get_rate(self, now):
+        if self._rate_checked is None or now - self._rate_checked >= self.SCHEDULE_REFRESH:
+            self._rate = self._schedule.get_limit()
+            self._rate_checked = now
+        return self._rate
+
+    def consume(self, byte_count):
+        debt = 0
+        with self._lock:
+            now = self._clock()
+            self._interval_bytes += byte_count
+            if self._adaptive:
+                self._adjust(now)
+            rate = self._get_rate(now)
+            if rate:
+                self._tokens = min(rate * self.MAX_BURST, self._tokens + (now - self._last_refill) * rate)
+                self._tokens -= byte_count
+                debt = -self._tokens / rate if self._tokens < 0 else 0
+                self._budget_wait += debt
+            self._last_refill = now
+        if debt:
+            time.sleep(debt)
+
+    def record_congestion(self):
+        """
+            Reports a throttled (429/503) or dropped response, the stream limit is halved at the next adjustment.
+        """
+        self._metrics.increment("download_congestion_total")
+        with self._lock:
+            self._congested = True
+
+    def _back_off(self, now):
+        self._stream_limit = max(1, self._stream_limit // 2)
+        self._probe = None
+        self._hold_until = now + self.HOLD_INTERVALS * self._adjust_interval
+
+    def _adjust(self, now):
+        elapsed = now - self._interval_start
+        if elapsed < self._adjust_interval:
+            return
+        self._track_active(now)
+        throughput = self._interval_bytes / elapsed
+        # Only an interval where every allowed stream was busy says anything about adding streams
+        saturated = self._active_time / elapsed >= self._stream_limit * 0.9
+        rate = self._get_rate(now)
+        previous_limit = self._stream_limit
+        reason = None
+        # What a slow-down in the next interval is measured against
+        baseline = None
+        if self._congested:
+            self._back_off(now)
+            reason = "congestion"
+        elif not saturated:
+            pass
+        elif self._probe is not None:
+            probe_throughput, probe_limit = self._probe
+            self._probe = None
+            if throughput < probe_throughput * (1 + self.MIN_GAIN):
+                self._stream_limit = probe_limit
+                self._hold_until = now + self.HOLD_INTERVALS * self._adjust_interval
+                baseline = probe_throughput
+                reason = "no gain"
+        elif rate and (throughput >= rate * self.BUDGET_USED or self._budget_wait >= elapsed * self.BUDGET_WAIT):
+            # More streams would only split the same budget
+            pass
+        elif self._last_throughput and throughput < self._last_throughput * self.SLOWDOWN:
+            self._back_off(now)
+            reason = "slow-down"
+        elif self._stream_limit < self._max_streams and now >= self._hold_until:
+            self._probe = (throughput, self._stream_limit)
+            self._stream_limit += 1
+            reason = "probe"
+        self.history.append((now, throughput, self._active_time / elapsed, self._stream_limit, reason))
+        if self._stream_limit != previous_limit:
+            print("[*] Download streams {0} -> {1} ({2}, {3:.1f} MB/s, {4:.1f} MB/s per stream)".format(
+                previous_limit, self._stream_limit, reason, throughput / 1e6, throughput / 1e6 / previous_limit))
+            self._metrics.set_gauge("download_stream_limit", self._stream_limit)
+            self._metrics.write_event({"event": "download_streams", "time": time.time(), "from": previous_limit,
+                                       "to": self._stream_limit, "reason": reason, "throughput": throughput})
+            self._lock.notify_all()
+        self._interval_start = now
+        self._interval_bytes = 0
+        self._budget_wait = 0.0
+        self._active_time = 0.0
+        self._congested = False
+        # Throughput right after a change isn't comparable with what came before, except going back to the streams
+        # the probe started from
+        self._last_throughput = throughput if self._stream_limit == previous_limit else baseline
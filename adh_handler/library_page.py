@@ -0,0 +1,64 @@
+from html.parser import HTMLParser
+
+
+class LibraryPageParser(HTMLParser):
+    """
+        Single pass over an Audible library page, picking out the pagination links and the DownloadFull link of every
+        library-download-popover div without building a document tree.
+    """
+
+    DOWNLOAD_POPOVER_PREFIX = "library-download-popover"
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.page_numbers = []
+        self.download_urls = []
+        # One entry per open div, True for the download popovers
+        self._div_stack = []
+        self._open_popovers = 0
+        self._popover_link_found = False
+
+    @staticmethod
+    def _has_class(attributes, class_name):
+        return class_name in (attributes.get("class") or "").split()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "div":
+            div_id = dict(attrs).get("id") or ""
+            is_popover = div_id.startswith(self.DOWNLOAD_POPOVER_PREFIX)
+            self._div_stack.append(is_popover)
+            if is_popover:
+                if not self._open_popovers:
+                    self._popover_link_found = False
+                self._open_popovers += 1
+        elif tag == "a":
+            attributes = dict(attrs)
+            if self._has_class(attributes, "pageNumberElement") and attributes.get("data-name") == "page":
+                try:
+                    self.page_numbers.append(int(attributes.get("data-value")))
+                except (TypeError, ValueError):
+                    pass
+            elif self._open_popovers and not self._popover_link_found and attributes.get("href") and \
+                    attributes.get("aria-label") == "DownloadFull" and self._has_class(attributes, "bc-link"):
+                self.download_urls.append(attributes["href"])
+                self._popover_link_found = True
+
+    def handle_endtag(self, tag):
+        if tag == "div" and self._div_stack:
+            if self._div_stack.pop():
+                self._open_popovers -= 1
+
+    @property
+    def max_page(self):
+        # A library that fits on one page has no pagination links at all
+        return max(self.page_numbers, default=1)
+
+
+def parse_library_page(audible_library_html):
+    """
+        Returns (max_page, download_urls) for one library page.
+    """
+    parser = LibraryPageParser()
+    parser.feed(audible_library_html)
+    parser.close()
+    return parser.max_page, parser.download_urls
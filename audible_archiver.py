@@ -1,68 +1,93 @@
 import os
-import time
+import sys
 import json
+import time
+import queue
 import shutil
 import random
 import string
 import getpass
+import argparse
 import threading
-import progressbar
+import collections
 
-import audible_driver
 from aax_converter import AaxConverter
-from audible_activator import AudibleActivator
+from pipeline_metrics import PipelineMetrics
 from synchronized_cache_file import SynchronizedCacheFile
 
-from adh_handler import AudibleDownloader
-from adh_handler.adh_parser import AdhParser
-from adh_handler.adh_downloader import AdhDownloader
+# selenium, requests and progressbar are only imported by the code paths that go online, so convert and status start
+# quickly and work without a network or a browser.
 
 
 class DownloadProgressBar:
 
-    def __init__(self, config):
+    def __init__(self, config, show_progress=True):
         self._config = config
+        self._show_progress = show_progress
         self._progress_bar = None
         self.title = ""
         self.destination_file = ""
+        self.checksum = None
 
     @staticmethod
     def clean_title(title):
         return ''.join([x for x in title if x not in (string.punctuation + string.whitespace)])
 
-    def _finalize(self, update_progress):
-        time.sleep(2)
-        self._progress_bar.finish()
-        self.title = update_progress.title
-        dest_file = os.path.join(self._config["aax_download_directory"], "{0}_{1}.aax".format(
-            self.clean_title(update_progress.title), ''.join(random.choices(string.ascii_letters + string.digits, k=16))))
-        shutil.move(update_progress.tempfile, dest_file)
-        self.destination_file = dest_file
+    def finalize(self, download_data, destination_file):
+        if self._progress_bar:
+            self._progress_bar.finish()
+        self.title = download_data.title
+        self.checksum = download_data.checksum
+        shutil.move(download_data.tempfile, destination_file)
+        self.destination_file = destination_file
 
     def update_progress(self, download_data):
+        if not self._show_progress:
+            return
         if not self._progress_bar:
+            import progressbar
             print("Downloading audiobook: {0}".format(download_data.title))
             self._progress_bar = progressbar.ProgressBar(max_value=download_data.content_length)
             self._progress_bar.start()
-        finish = False
-        if download_data.download_progress < download_data.content_length:
-            update_progress = download_data.download_progress
-        else:
-            update_progress = download_data.content_length
-            finish = True
-        self._progress_bar.update(update_progress)
-        if finish:
-            t = threading.Thread(target=self._finalize, args=(download_data,))
-            t.start()
+        self._progress_bar.update(min(download_data.download_progress, download_data.content_length))
 
 
 class AudibleLibraryDownloader:
 
+    # Titles waiting for a free download worker, beyond this discovery blocks until the downloads catch up
+    QUEUED_DOWNLOADS_PER_WORKER = 2
+    # Tries per title and run when the CDN throttles or drops downloads, each one resumes where the last stopped
+    DOWNLOAD_ATTEMPTS = 3
+    RETRY_DELAY = 5
+    MAX_RETRY_DELAY = 120
+
     def __init__(self, config):
         self._config = config
         self.aax_converter = None
+        self._download_threads = []
+        self._pending_downloads = None
+        self._claimed_identifiers = set()
+        self._claim_lock = threading.Lock()
+        self._finished_downloads = 0
+        self._max_downloads = max(1, int(config.get("max_downloads", 1)))
+        self._download_segments = max(1, int(config.get("download_segments", 1)))
+        # Created by start_downloads(), converting what's already on disk never opens a connection
+        self._session = None
+        self._download_scheduler = None
+        aax_download_cache = self._load_aax_download_cache()
+        aax_download_cache.create_index("filepath", lambda cache_entry: cache_entry.get("filepath"))
+        aax_download_cache.create_index("state", self.get_aax_cache_state)
+
+    @staticmethod
+    def get_aax_cache_state(cache_entry):
+        if cache_entry.get("converted"):
+            return "converted"
+        elif cache_entry.get("download_finished"):
+            return "downloaded"
+        return "pending"
 
     def _get_adh_file_identifier(self, adh_file):
+        from adh_handler.adh_parser import AdhParser
         return AdhParser.get_adh_identifier("https://{0}/download?{1}".format(
             self._config["audible_cdn"], AdhParser(adh_file).parse_adm_file().to_http_params()))
 
@@ -75,118 +100,509 @@ class AudibleLibraryDownloader:
     def _save_aax_download_cache(self, cache_data):
         cache_data.flush()
 
-    def _get_adh_file_list(self):
-        pending_downloads = []
+    def _claim_download(self, adh_identifier):
+        """
+            Returns whether the title still has to be downloaded.  Each title is only looked at once per run, so one
+            found by library discovery and again in the helper file cache isn't downloaded or converted twice.
+        """
+        with self._claim_lock:
+            if adh_identifier in self._claimed_identifiers:
+                return False
+            self._claimed_identifiers.add(adh_identifier)
+        cache_entry = self._load_aax_download_cache().get(adh_identifier, {})
+        cache_state = self.get_aax_cache_state(cache_entry)
+        if cache_state == "converted":
+            return False
+        elif cache_state == "downloaded" and os.path.isfile(cache_entry["filepath"]):
+            self.aax_converter.convert_file(cache_entry["filepath"])
+            return False
+        # Unfinished downloads keep their partial file, _get_download_state picks it back up
+        return True
+
+    def verify_downloads(self, deep=False):
+        """
+            Checks every downloaded title that's waiting for conversion against what was recorded when its download
+            finished.  By default only size and mtime are compared, deep hashes every file again.  Titles that are
+            missing, truncated or corrupt are marked to be downloaded again, so they never reach ffmpeg.  Returns how
+            many failed.
+        """
+        from file_integrity import verify_files
         aax_download_cache = self._load_aax_download_cache()
+        keys = list(aax_download_cache.lookup("state", "downloaded"))
+        if deep:
+            print("[*] Verifying {0} downloaded titles . . .".format(len(keys)))
+        cache_entries = [aax_download_cache[x] for x in keys]
+        metrics = PipelineMetrics()
+        failed = 0
+        with metrics.span("verify", deep=deep, files=len(keys)):
+            results = verify_files(cache_entries, deep, self._config.get("verify_workers"))
+        for key, cache_entry, (result, record) in zip(keys, cache_entries, results):
+            metrics.increment("files_verified_total", result=result)
+            if result == "ok":
+                if record:
+                    aax_download_cache[key] = dict(cache_entry, **record)
+                continue
+            failed += 1
+            print("[*] {0} is {1}, it will be downloaded again.".format(cache_entry["filepath"], result))
+            if result != "missing":
+                os.unlink(cache_entry["filepath"])
+            aax_download_cache[key] = {"filepath": cache_entry["filepath"], "download_finished": False}
+        if deep or failed:
+            print("[*] {0} of {1} downloaded titles failed verification.".format(failed, len(keys)))
+        return failed
+
+    def _get_adh_file_list(self):
         adh_download_cache = self._load_adh_download_cache()
-        for identifier in adh_download_cache:
-            if identifier in aax_download_cache:
-                if "converted" in aax_download_cache[identifier] and aax_download_cache[identifier]["converted"]:
-                    continue
-                elif os.path.isfile(aax_download_cache[identifier]["filepath"]):
-                    if aax_download_cache[identifier]["download_finished"]:
-                        self.aax_converter.convert_file(aax_download_cache[identifier]["filepath"])
-                        continue
-                    else:
-                        os.unlink(aax_download_cache[identifier]["filepath"])
-            pending_downloads.append(adh_download_cache[identifier])
-        return pending_downloads
-
-    def _finalize_download(self, adh_file, destination_file):
+        return [adh_download_cache[x] for x in adh_download_cache if self._claim_download(x)]
+
+    def _get_download_state(self, adh_identifier, adh_file):
+        from adh_handler import DownloadData
+        from adh_handler.adh_parser import AdhParser
+        cache_entry = self._load_aax_download_cache().get(adh_identifier, {})
+        if "download_state" in cache_entry:
+            download_data = DownloadData.from_dict(cache_entry["download_state"])
+            if os.path.isfile(download_data.tempfile):
+                download_data.verified_offset = min(download_data.verified_offset,
+                                                    os.path.getsize(download_data.tempfile))
+                return cache_entry["filepath"], download_data
+        title = AdhParser(adh_file).parse_adm_file().title
+        destination_file = os.path.join(self._config["aax_download_directory"], "{0}_{1}.aax".format(
+            DownloadProgressBar.clean_title(title), ''.join(random.choices(string.ascii_letters + string.digits, k=16))))
+        return destination_file, DownloadData(destination_file + ".part")
+
+    def _record_download_state(self, adh_identifier, destination_file, download_data):
+        aax_download_cache = self._load_aax_download_cache()
+        aax_download_cache[adh_identifier] = {
+            "filepath": destination_file,
+            "download_finished": False,
+            "download_state": download_data.to_dict()
+        }
+
+    def _finalize_download(self, adh_file, destination_file, checksum=None):
+        from file_integrity import get_file_record
         if os.path.isfile(destination_file):
             with self._load_aax_download_cache() as download_cache:
                 adh_identifier = self._get_adh_file_identifier(adh_file)
-                download_cache[adh_identifier] = {
+                cache_entry = {
                     "filepath": destination_file,
                     "download_finished": True
                 }
+                # Size and mtime for the quick check at startup, the checksum for a deep one
+                cache_entry.update(get_file_record(destination_file, checksum))
+                download_cache[adh_identifier] = cache_entry
                 self._save_aax_download_cache(download_cache)
             return True
         return False
 
     def _write_to_tsv(self, metadata):
         write_header = False
-        csv_columns = ["title", "album", "artist", "date", "copyright"]
+        csv_columns = ["title", "album", "artist", "date", "copyright", "output_file"]
         if not os.path.isfile(self._config["tsv_path"]):
             write_header = True
+        else:
+            # Files started before output_file was tracked keep their original columns
+            with open(self._config["tsv_path"], "r") as infile:
+                csv_columns = [x for x in infile.readline().strip().split("\t") if x in csv_columns]
         with open(self._config["tsv_path"], "a") as outfile:
             if write_header:
                 outfile.write("{0}\r\n".format("\t".join(csv_columns)))
             outfile.write("{0}\r\n".format("\t".join([metadata.to_dict()[x] for x in csv_columns])))
 
     def finalize_conversion(self, metadata):
-        prospective_filepath = os.path.join(
-            self._config["converter_config"]["library_directory"],
-            DownloadProgressBar.clean_title(metadata.title)
-        ) + ".mp3"
-        if os.path.isfile(prospective_filepath):
+        if os.path.isfile(metadata.output_file):
             with self._load_aax_download_cache() as download_data:
-                for key in download_data:
-                    if download_data[key]["filepath"] == metadata.aax_file:
-                        download_data[key]["converted"] = True
-                        if self._config["remove_after_conversion"]:
-                            os.unlink(metadata.aax_file)
-                            download_data[key]["download_finished"] = False
-                        break
+                for key in download_data.lookup("filepath", metadata.aax_file):
+                    # Entries are replaced rather than edited in place so the cache knows which keys to persist
+                    cache_entry = dict(download_data[key])
+                    cache_entry["converted"] = True
+                    if self._config["remove_after_conversion"]:
+                        os.unlink(metadata.aax_file)
+                        cache_entry["download_finished"] = False
+                    download_data[key] = cache_entry
+                    break
             self._write_to_tsv(metadata)
 
+    def _download_audiobook(self, adh_file):
+        from adh_handler import AudibleDownloader
+        adh_identifier = self._get_adh_file_identifier(adh_file)
+        destination_file, download_data = self._get_download_state(adh_identifier, adh_file)
+        # Progress bars can't share a terminal, so they're only drawn when titles are downloaded one at a time
+        download_progressbar = DownloadProgressBar(self._config, show_progress=self._max_downloads == 1)
+        adh_downloader = AudibleDownloader(
+            self._config["audible_cdn"], self._config["user_agent"], self._session, self._download_segments,
+            self._config.get("download_buffer_size", AudibleDownloader.DEFAULT_BUFFER_SIZE),
+            self._config.get("progress_interval", AudibleDownloader.DEFAULT_PROGRESS_INTERVAL),
+            timeout=self._config.get("download_timeout", AudibleDownloader.DEFAULT_TIMEOUT)
+        )
+        adh_downloader.download_scheduler = self._download_scheduler
+        adh_downloader.download_data_callback = download_progressbar.update_progress
+        adh_downloader.download_state_callback = lambda state: self._record_download_state(
+            adh_identifier, destination_file, state)
+        conversion_stream = None
+        # Only a fresh single stream download delivers its bytes in order from the start of the file
+        if not download_data.verified_offset and self._download_segments == 1:
+            conversion_stream = self.aax_converter.open_stream(download_data.tempfile)
+            if conversion_stream:
+                adh_downloader.download_stream_callback = conversion_stream.feed
+        try:
+            adh_downloader.download_audiobook(adh_file, download_data)
+            if download_data.complete:
+                download_progressbar.finalize(download_data, destination_file)
+        except Exception:
+            if conversion_stream:
+                conversion_stream.abort()
+            raise
+        if conversion_stream and not download_data.complete:
+            conversion_stream.abort()
+        return download_progressbar, conversion_stream
+
+    def _get_retry_delay(self, attempt, error=None):
+        # Retry-After (in seconds) from a throttled response wins over the exponential back-off
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after", "") if response is not None else ""
+        if retry_after.isdigit():
+            return min(int(retry_after), self.MAX_RETRY_DELAY)
+        return min(self.RETRY_DELAY * 2 ** attempt, self.MAX_RETRY_DELAY) * random.uniform(0.5, 1)
+
+    def _handle_download_result(self, adh_file, attempt=0):
+        """
+            Returns how many seconds to wait before trying the title again when the CDN throttled or dropped the
+            download, None when it's done with for this run.
+        """
+        import requests
+        from adh_handler import THROTTLED_STATUS_CODES
+        retry = attempt + 1 < self.DOWNLOAD_ATTEMPTS
+        try:
+            download_progressbar, conversion_stream = self._download_audiobook(adh_file)
+        except (requests.RequestException, OSError) as e:
+            response = getattr(e, "response", None)
+            # A read timeout is a connection that went quiet, as much a dropped response as a reset one
+            congested = isinstance(e, (requests.ConnectionError, requests.Timeout,
+                                       requests.exceptions.ChunkedEncodingError)) or \
+                (response is not None and response.status_code in THROTTLED_STATUS_CODES)
+            if congested:
+                self._download_scheduler.record_congestion()
+            if congested and retry:
+                print("[*] Download throttled ({0}), retrying . . .".format(e))
+                return self._get_retry_delay(attempt, e)
+            print("[*] Download failed ({0}), will retry on next run.".format(e))
+            return None
+        try:
+            if self._finalize_download(adh_file, download_progressbar.destination_file,
+                                       download_progressbar.checksum):
+                print("[*] Successfully downloaded title: {0}".format(download_progressbar.title))
+                if conversion_stream:
+                    conversion_stream.finish(download_progressbar.destination_file)
+                else:
+                    self.aax_converter.convert_file(download_progressbar.destination_file)
+                return None
+        finally:
+            # A no-op once finish() ran, otherwise the converter would wait on this stream forever
+            if conversion_stream:
+                conversion_stream.abort()
+        # A body that ended early is a dropped connection too, the partial file is resumed on the retry
+        self._download_scheduler.record_congestion()
+        if retry:
+            print("[*] Download incomplete, retrying . . .")
+            return self._get_retry_delay(attempt)
+        print("[*] Download failed, will retry on next run.")
+        return None
+
+    def _download_title(self, adh_file):
+        for attempt in range(self.DOWNLOAD_ATTEMPTS):
+            # The stream slot is given up while waiting, so the back-off doesn't hold back other titles
+            with self._download_scheduler.stream():
+                retry_delay = self._handle_download_result(adh_file, attempt)
+            if retry_delay is None:
+                break
+            time.sleep(retry_delay)
+
+    def _download_worker(self):
+        while True:
+            adh_file = self._pending_downloads.get()
+            if adh_file is None:
+                break
+            try:
+                self._download_title(adh_file)
+            except Exception as e:
+                # Keep the worker alive, a dead worker would eventually leave queue_download() blocked for good
+                print("[*] Download of {0} failed: {1}".format(adh_file, e))
+            with self._claim_lock:
+                self._finished_downloads += 1
+                print("[*] Finished audiobook {0}".format(self._finished_downloads))
+
+    def start_downloads(self):
+        """
+            Starts the download workers.  Titles handed to queue_download() start downloading as soon as a worker is
+            free, so downloads can begin while the library is still being discovered.
+        """
+        if self._download_threads:
+            return
+        from adh_handler import AudibleDownloader
+        from adh_handler.download_scheduler import DownloadScheduler
+        self._session = AudibleDownloader.create_session(self._max_downloads * self._download_segments)
+        # max_downloads workers are started either way, the scheduler decides how many of them download at once
+        self._download_scheduler = DownloadScheduler.from_config(self._config)
+        self._pending_downloads = queue.Queue(maxsize=self._max_downloads * self.QUEUED_DOWNLOADS_PER_WORKER)
+        PipelineMetrics().track_gauge("queue_depth", self._pending_downloads.qsize, queue="downloads")
+        for _ in range(self._max_downloads):
+            t = threading.Thread(target=self._download_worker)
+            t.setDaemon(True)
+            t.start()
+            self._download_threads.append(t)
+
+    def queue_download(self, adh_file):
+        """
+            Hands a helper file to the download workers.  Blocks while the download queue is full, which holds back
+            whoever is feeding it.
+        """
+        if self._claim_download(self._get_adh_file_identifier(adh_file)):
+            self._pending_downloads.put(adh_file)
+
+    def wait_for_downloads(self):
+        for _ in self._download_threads:
+            self._pending_downloads.put(None)
+        for t in self._download_threads:
+            t.join()
+        self._download_threads = []
+
     def download_all_files(self):
-        i = 0
+        """
+            Downloads every title in the helper file cache that wasn't already handed to queue_download(), then waits
+            for all downloads to finish.
+        """
+        self.start_downloads()
         adh_files = self._get_adh_file_list()
         print("[*] {0} files pending download.".format(len(adh_files)))
         for adh_file in adh_files:
-            i += 1
-            print("[*] Downloading audiobook {0}/{1}".format(i, len(adh_files)))
-            download_progressbar = DownloadProgressBar(self._config)
-            adh_downloader = AudibleDownloader(self._config["audible_cdn"], self._config["user_agent"])
-            adh_downloader.download_data_callback = download_progressbar.update_progress
-            adh_downloader.download_audiobook(adh_file)
-            timeout = 0
-            while timeout < 10:
-                if download_progressbar.destination_file:
-                    break
-                time.sleep(1)
-                timeout += 1
-            if self._finalize_download(adh_file, download_progressbar.destination_file):
-                print("[*] Successfully downloaded title: {0}".format(download_progressbar.title))
-                self.aax_converter.convert_file(download_progressbar.destination_file)
-            else:
-                print("[*] Download failed, will retry on next run.")
+            self._pending_downloads.put(adh_file)
+        self.wait_for_downloads()
 
 
-if __name__ == "__main__":
+def create_activation_session_data(driver_config, get_credentials, session_store=None, driver_type=None):
+    # driver_type stands in for AudibleDriver, the pipeline simulator logs on without a browser
+    from audible_driver.session_store import is_session_valid
+    if session_store:
+        activation_session_data = session_store.load()
+        if activation_session_data and is_session_valid(driver_config, activation_session_data):
+            print("[*] Reusing the cached Audible session.")
+            return activation_session_data
+        if activation_session_data:
+            print("[*] Cached Audible session was rejected, logging on again.")
+            session_store.clear()
+    username, password = get_credentials()
+    if driver_type is None:
+        from audible_driver import AudibleDriver as driver_type
+    with driver_type(driver_config) as driver:
+        driver.log_on(username, password)
+        activation_session_data = driver.get_activation_session_data()
+    if session_store:
+        session_store.save(activation_session_data)
+    return activation_session_data
+
+
+def get_session_store(config):
+    if "session_store_file" not in config:
+        return None
+    from audible_driver.session_store import SessionStore
+    return SessionStore(config["session_store_file"], config["session_key_file"],
+                        config.get("session_max_age_hours", 24) * 60 * 60)
+
+
+def prompt_credentials():
+    username = input("Audible username > ")
+    password = getpass.getpass("Audible password > ")
+    return username, password
+
+
+def create_adh_downloader(config, driver_config, adh_downloader_type=None):
+    if adh_downloader_type is None:
+        from adh_handler.adh_downloader import AdhDownloader as adh_downloader_type
+    return adh_downloader_type(
+        driver_config, "adh_cache_file", config["adh_directory"], config.get("max_page_requests", 4),
+        "sync_cache_file" if config.get("delta_sync") and "sync_cache_file" in config else None,
+        config.get("full_sync_interval_days", 7) * 24 * 60 * 60)
+
+
+def start_converter(config, downloader):
+    print("[*] Starting AAX to {0} converter . . .".format(
+        config["converter_config"].get("output_format", "mp3").upper()))
+    converter = AaxConverter(config["converter_config"], config["activation_bytes"])
+    if "metadata_cache_file" in config:
+        converter.metadata_cache = SynchronizedCacheFile("metadata_cache_file")
+    converter.start()
+    converter.conversion_finished_event = downloader.finalize_conversion
+    downloader.aax_converter = converter
+    return converter
+
+
+def archive_library(config, driver_config, activation_session_data, adh_downloader_type=None,
+                    library_downloader_type=AudibleLibraryDownloader, full_sync=False, deep_verify=False):
+    """
+        Downloads and converts every title in the helper file cache.  With activation_session_data the library is
+        discovered first, titles being handed to the downloads as they're found, without it only cached helper files
+        are used.
+    """
+    downloader = library_downloader_type(config)
+    downloader.verify_downloads(deep_verify)
+    converter = start_converter(config, downloader)
+    print("[*] Starting library archival process, this is gonna take a while.")
+    downloader.start_downloads()
+    if activation_session_data:
+        print("[*] Linking discovery, download and conversion threads . . .")
+        adm_downloader = create_adh_downloader(config, driver_config, adh_downloader_type)
+        adm_downloader.adh_file_callback = downloader.queue_download
+        adm_downloader.download_adh_files(activation_session_data, full_sync)
+    downloader.download_all_files()
+    converter.wait_for_conversion_completion()
+
+
+def convert_library(config, finalize_existing=False, deep_verify=False):
+    """
+        Converts every downloaded title that hasn't been converted yet.  With finalize_existing, titles whose output
+        file is already in the library are only recorded as converted, for runs that stopped between ffmpeg finishing
+        and finalize_conversion().
+    """
+    downloader = AudibleLibraryDownloader(config)
+    downloader.verify_downloads(deep_verify)
+    converter = start_converter(config, downloader)
+    aax_download_cache = SynchronizedCacheFile("aax_cache_file")
+    aax_files = [aax_download_cache[x]["filepath"] for x in aax_download_cache.lookup("state", "downloaded")]
+    queued = 0
+    for aax_file in aax_files:
+        if not os.path.isfile(aax_file):
+            print("[*] Skipping {0}, the file is gone.".format(aax_file))
+            continue
+        if finalize_existing:
+            try:
+                aax_metadata = converter.probe_file(aax_file)
+            except (ValueError, OSError, KeyError) as e:
+                print("[*] Unable to read {0}: {1}".format(aax_file, e))
+                continue
+            if os.path.isfile(aax_metadata.output_file):
+                print("[*] {0} is already converted, finalizing . . .".format(aax_metadata.title))
+                downloader.finalize_conversion(aax_metadata)
+                continue
+        converter.convert_file(aax_file)
+        queued += 1
+    print("[*] {0} files pending conversion.".format(queued))
+    converter.wait_for_conversion_completion()
+
+
+def get_library_status(config):
+    adh_download_cache = SynchronizedCacheFile("adh_cache_file")
+    aax_download_cache = SynchronizedCacheFile("aax_cache_file")
+    title_states = collections.Counter()
+    for adh_identifier in adh_download_cache:
+        cache_entry = aax_download_cache.get(adh_identifier)
+        if cache_entry is None:
+            title_states["not started"] += 1
+        elif "download_state" in cache_entry:
+            title_states["partially downloaded"] += 1
+        else:
+            title_states[AudibleLibraryDownloader.get_aax_cache_state(cache_entry)] += 1
+    sync_state = {}
+    if "sync_cache_file" in config:
+        # AdhDownloader.SYNC_STATE_KEY, read here without importing the downloader
+        sync_state = SynchronizedCacheFile("sync_cache_file").get("library", {})
+    return len(adh_download_cache), title_states, sync_state
+
+
+def print_status(config):
+    title_count, title_states, sync_state = get_library_status(config)
+    print("[*] {0} titles in the library".format(title_count))
+    for state in ("converted", "downloaded", "partially downloaded", "pending", "not started"):
+        print("    {0:<22}{1:>8}".format(state, title_states[state]))
+    for key, description in (("last_sync", "Last library sync"), ("last_full_sync", "Last full library sync")):
+        if sync_state.get(key):
+            print("[*] {0}: {1}".format(description, time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                   time.localtime(sync_state[key]))))
+
+
+def load_config(config_path, export_metrics=True):
     print("[*] Loading configuration file . . .")
-    with open("config.json", "r") as infile:
+    with open(config_path, "r") as infile:
         config = json.loads(infile.read())
+    if export_metrics:
+        # Started ahead of the caches so it's still exporting while they write their last commit on exit
+        PipelineMetrics.initialize(config)
     print("[*] Initializing download and conversion caches . . .")
     SynchronizedCacheFile.initialize(config)
+    return config
+
+
+def create_session(config, config_path):
+    """
+        Logs on (or reuses the cached session) and retrieves the activation bytes when the config doesn't have them.
+    """
+    from audible_driver.driver_config import AudibleDriverConfig
     print("[*] Preparing Audible Driver configuration . . .")
-    driver_config = audible_driver.driver_config.AudibleDriverConfig(config["driver_config"])
-    username = input("Audible username > ")
-    password = getpass.getpass("Audible password > ")
+    driver_config = AudibleDriverConfig(config["driver_config"])
     print("[*] Creating valid Audible session . . .")
-    with audible_driver.AudibleDriver(driver_config) as driver:
-        driver.log_on(username, password)
-        activation_session_data = driver.get_activation_session_data()
+    activation_session_data = create_activation_session_data(driver_config, prompt_credentials,
+                                                             get_session_store(config))
     if not config["activation_bytes"]:
+        from audible_activator import AudibleActivator
         print("[*] Activation bytes not found, retrieving them.")
         activator = AudibleActivator(driver_config, config["user_agent"], activation_session_data)
         activation_bytes = activator.retrieve_activation_bytes()
         print("[*] Successfully retrieved activation bytes: {0}".format(activation_bytes))
         config["activation_bytes"] = activation_bytes
-        with open("config.json", "w") as outfile:
+        with open(config_path, "w") as outfile:
             outfile.write(json.dumps(config, indent=4))
             print("[*] Config file updated with activation byte values.")
-    print("[*] Starting AAX to MP3 converter . . .")
-    converter = AaxConverter(config["converter_config"], config["activation_bytes"])
-    converter.start()
-    adm_downloader = AdhDownloader(driver_config, "adh_cache_file", config["adh_directory"])
-    adm_downloader.download_adh_files(activation_session_data)
-    downloader = AudibleLibraryDownloader(config)
-    print("[*] Linking download and conversion threads . . .")
-    converter.conversion_finished_event = downloader.finalize_conversion
-    downloader.aax_converter = converter
-    print("[*] Starting library archival process, this is gonna take a while.")
-    downloader.download_all_files()
-    converter.wait_for_conversion_completion()
+    return driver_config, activation_session_data
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Archive an Audible library as DRM free audio books.")
+    parser.add_argument("--config", default="config.json", help="Configuration file, defaults to config.json")
+    subparsers = parser.add_subparsers(dest="command")
+    discover_parser = subparsers.add_parser("discover", help="Sync the library and fetch missing helper files")
+    discover_parser.add_argument("--full-sync", action="store_true", help="Walk every library page")
+    download_parser = subparsers.add_parser("download", help="Discover, download and convert the library (default)")
+    download_parser.add_argument("--full-sync", action="store_true", help="Walk every library page")
+    download_parser.add_argument("--no-discover", action="store_true",
+                                 help="Only download titles whose helper files are already cached")
+    download_parser.add_argument("--deep-verify", action="store_true",
+                                 help="Check every downloaded title against its checksum first, not only its size")
+    convert_parser = subparsers.add_parser("convert", help="Convert titles already downloaded, offline")
+    convert_parser.add_argument("--finalize-existing", action="store_true",
+                                help="Record titles whose output file already exists as converted instead of "
+                                     "converting them again")
+    convert_parser.add_argument("--deep-verify", action="store_true",
+                                help="Check every downloaded title against its checksum first, not only its size")
+    subparsers.add_parser("status", help="Summarize the download and conversion caches, offline")
+    subparsers.add_parser("verify", help="Check every downloaded title against its checksum, offline, and mark the "
+                                         "ones that fail to be downloaded again")
+    # Running without a command is a download with discovery, as it always has been
+    parser.set_defaults(full_sync=False, no_discover=False, deep_verify=False)
+    args = parser.parse_args(arguments)
+    command = args.command or "download"
+    # status mustn't overwrite the metrics of a run that's still going
+    config = load_config(args.config, command != "status")
+    if command == "status":
+        print_status(config)
+    elif command == "convert":
+        if not config["activation_bytes"]:
+            print("[*] Activation bytes not found, run discover or download once to retrieve them.")
+            return 1
+        convert_library(config, args.finalize_existing, args.deep_verify)
+    elif command == "verify":
+        return 1 if AudibleLibraryDownloader(config).verify_downloads(deep=True) else 0
+    elif command == "discover":
+        driver_config, activation_session_data = create_session(config, args.config)
+        create_adh_downloader(config, driver_config).download_adh_files(activation_session_data, args.full_sync)
+    elif args.no_discover:
+        if not config["activation_bytes"]:
+            create_session(config, args.config)
+        archive_library(config, None, None, deep_verify=args.deep_verify)
+    else:
+        driver_config, activation_session_data = create_session(config, args.config)
+        archive_library(config, driver_config, activation_session_data, full_sync=args.full_sync,
+                        deep_verify=args.deep_verify)
+    return 0
 
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+
+import requests
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+
+class SessionStore:
+    """
+        Keeps the activation session data (cookies and playerToken) from the last log on, encrypted with a Fernet key
+        kept in its own file, so a later run can skip starting Chrome while the session is still accepted.  Without
+        the optional cryptography package nothing is written, the cookies are as good as the password.
+    """
+
+    DEFAULT_MAX_AGE = 24 * 60 * 60
+    PROBE_TIMEOUT = 10
+
+    def __init__(self, store_file, key_file, max_age=DEFAULT_MAX_AGE):
+        self._store_file = store_file
+        self._key_file = key_file
+        self._max_age = max_age
+
+    @property
+    def available(self):
+        return Fernet is not None
+
+    def _get_fernet(self, create=False):
+        if os.path.exists(self._key_file):
+            with open(self._key_file, "rb") as infile:
+                return Fernet(infile.read().strip())
+        if not create:
+            return None
+        key = Fernet.generate_key()
+        os.makedirs(os.path.dirname(os.path.abspath(self._key_file)), exist_ok=True)
+        # Owner only, the key is all that stands between the store file and the cookies
+        with os.fdopen(os.open(self._key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as outfile:
+            outfile.write(key)
+        return Fernet(key)
+
+    def _get_expiry(self, session_data, created):
+        expiry = created + self._max_age
+        cookie_expiries = [x["expiry"] for x in session_data["cookies"] if x.get("expiry")]
+        return min([expiry] + cookie_expiries)
+
+    def load(self):
+        """
+            Returns the stored session data, or None when there is none, it can't be decrypted or it has expired.
+        """
+        if not self.available or not os.path.exists(self._store_file):
+            return None
+        try:
+            # A damaged key file is as unreadable as a damaged store, either way it's back to logging on
+            fernet = self._get_fernet()
+            if fernet is None:
+                return None
+            with open(self._store_file, "rb") as infile:
+                entry = json.loads(fernet.decrypt(infile.read()).decode("utf-8"))
+        except (InvalidToken, ValueError) as e:
+            print("[*] Ignoring unreadable session store: {0}".format(e.__class__.__name__))
+            return None
+        if entry["expires"] <= time.time():
+            return None
+        return entry["session"]
+
+    def save(self, session_data):
+        if not self.available:
+            print("[*] cryptography is not installed, not caching the Audible session.")
+            return
+        created = time.time()
+        entry = {"created": created, "expires": self._get_expiry(session_data, created), "session": session_data}
+        try:
+            fernet = self._get_fernet(create=True)
+        except ValueError:
+            # Nothing encrypted with the damaged key can be read anyway, start over with a new one
+            print("[*] Replacing unreadable session key.")
+            os.remove(self._key_file)
+            fernet = self._get_fernet(create=True)
+        token = fernet.encrypt(json.dumps(entry).encode("utf-8"))
+        temp_file = self._store_file + ".tmp"
+        with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as outfile:
+            outfile.write(token)
+        os.replace(temp_file, self._store_file)
+
+    def clear(self):
+        if os.path.exists(self._store_file):
+            os.remove(self._store_file)
+
+
+def is_session_valid(driver_config, session_data, timeout=SessionStore.PROBE_TIMEOUT):
+    """
+        Asks for the first library page without following redirects, a signed out session is sent to the sign in page.
+        Only the status line is read, the page body is left on the wire.
+    """
+    cookies = {x["name"]: x["value"] for x in session_data["cookies"]}
+    try:
+        with requests.get(driver_config.library_url.format(1), cookies=cookies, allow_redirects=False, stream=True,
+                          timeout=timeout, headers={"User-Agent": driver_config.browser_user_agent}) as response:
+            return response.status_code == 200
+    except requests.RequestException as e:
+        print("[*] Session check failed: {0}".format(e))
+        return False
@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+import multiprocessing
+
+from synchronized_cache_file import SynchronizedCacheFile
+from synchronized_cache_file.storage import open_storage, STORAGE_BACKENDS
+
+
+def open_cache(name, file_path, backend):
+    SynchronizedCacheFile({name: file_path}, backend)
+    return SynchronizedCacheFile(name)
+
+
+def make_entry(index):
+    # Shaped like an aax cache entry
+    return {
+        "filepath": "downloads/aax/Benchmark_Title_{0:06d}_AbCdEfGhIjKlMnOp.aax".format(index),
+        "download_finished": True,
+        "converted": index % 3 == 0
+    }
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def measure_concurrency(cache, writers, readers, writes_per_writer):
+    """
+        writers threads each set writes_per_writer keys while readers threads keep reading random existing keys.
+        Returns the write rate and the read latencies in microseconds.
+    """
+    for i in range(1000):
+        cache["seed_{0}".format(i)] = make_entry(i)
+    cache.flush()
+    done = threading.Event()
+    read_latencies = [[] for _ in range(readers)]
+
+    def write(writer):
+        for i in range(writes_per_writer):
+            cache["writer_{0}_{1}".format(writer, i)] = make_entry(i)
+
+    def read(reader):
+        latencies = read_latencies[reader]
+        i = reader
+        while not done.is_set():
+            key = "seed_{0}".format(i % 1000)
+            start = time.perf_counter_ns()
+            cache[key]
+            latencies.append(time.perf_counter_ns() - start)
+            i += 7
+
+    reader_threads = [threading.Thread(target=read, args=(x, )) for x in range(readers)]
+    writer_threads = [threading.Thread(target=write, args=(x, )) for x in range(writers)]
+    for t in reader_threads:
+        t.start()
+    start = time.perf_counter()
+    for t in writer_threads:
+        t.start()
+    for t in writer_threads:
+        t.join()
+    write_time = time.perf_counter() - start
+    cache.flush()
+    persisted_time = time.perf_counter() - start
+    done.set()
+    for t in reader_threads:
+        t.join()
+    latencies = sorted(x / 1000 for reader_latencies in read_latencies for x in reader_latencies)
+    return writers * writes_per_writer / write_time, writers * writes_per_writer / persisted_time, latencies
+
+
+def measure_flush_cost(cache, sizes, samples=5):
+    """
+        Grows the cache to each size and times flush() after changing a single key.
+    """
+    results = []
+    index = 0
+    for size in sizes:
+        cache.update({"key_{0}".format(x): make_entry(x) for x in range(index, size)})
+        index = size
+        cache.flush()
+        timings = []
+        for sample in range(samples):
+            cache["key_0"] = make_entry(sample)
+            start = time.perf_counter()
+            cache.flush()
+            timings.append(time.perf_counter() - start)
+        results.append((size, statistics.median(timings)))
+    return results
+
+
+def _crash_writer(file_path, backend, connection):
+    # Writes forever, reporting every sequence number confirmed by flush() until the parent kills the process
+    cache = open_cache("crash", file_path, backend)
+    sequence = 0
+    while True:
+        for _ in range(50):
+            sequence += 1
+            cache["entry_{0}".format(sequence % 5000)] = dict(make_entry(sequence), sequence=sequence)
+            cache["last_sequence"] = sequence
+        cache.flush()
+        connection.send(sequence)
+
+
+def check_crash_consistency(work_directory, backend, runs, max_delay):
+    """
+        Kills a writing process at random points and checks that the cache still loads and holds at least everything
+        the writer saw flush() confirm.  Returns a list of failure descriptions.
+    """
+    failures = []
+    for run in range(runs):
+        file_path = os.path.join(work_directory, "crash_{0}_{1}".format(backend, run))
+        parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_crash_writer, args=(file_path, backend, child_connection))
+        process.start()
+        time.sleep(max_delay * (run + 1) / runs)
+        process.kill()
+        process.join()
+        confirmed = 0
+        while parent_connection.poll():
+            confirmed = parent_connection.recv()
+        try:
+            storage = open_storage(file_path, backend)
+            state = storage.load()
+            storage.close()
+        except Exception as e:
+            failures.append("run {0}: cache unreadable after kill ({1})".format(run, e))
+            continue
+        persisted = state.get("last_sequence", 0)
+        if persisted < confirmed:
+            failures.append("run {0}: flushed up to {1} but only {2} survived".format(run, confirmed, persisted))
+        elif persisted and state.get("entry_{0}".format(persisted % 5000), {}).get("sequence") != persisted:
+            failures.append("run {0}: entry for sequence {1} is missing or stale".format(run, persisted))
+    return failures
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Throughput, latency, flush cost and crash consistency of "
+                                                 "SynchronizedCacheFile for each storage backend.")
+    parser.add_argument("--backends", default=",".join(STORAGE_BACKENDS))
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writes", type=int, default=5000, help="Writes per writer thread")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Cache sizes to time flush() at")
+    parser.add_argument("--crash-runs", type=int, default=5)
+    parser.add_argument("--crash-delay", type=float, default=2.0, help="Longest time before a writer is killed")
+    args = parser.parse_args(arguments)
+    work_directory = tempfile.mkdtemp()
+    for backend in args.backends.split(","):
+        print("[*] Backend: {0}".format(backend))
+        cache = open_cache("concurrency_" + backend, os.path.join(work_directory, "concurrency_" + backend), backend)
+        write_rate, persisted_rate, latencies = measure_concurrency(cache, args.writers, args.readers, args.writes)
+        cache.stop()
+        print("    {0} writers, {1} readers: {2:.0f} writes/s applied, {3:.0f} writes/s persisted".format(
+            args.writers, args.readers, write_rate, persisted_rate))
+        if latencies:
+            print("    __getitem__ latency: p50 {0:.1f} us  p99 {1:.1f} us  p99.9 {2:.1f} us  max {3:.1f} us".format(
+                percentile(latencies, 0.5), percentile(latencies, 0.99), percentile(latencies, 0.999),
+                latencies[-1]))
+        cache = open_cache("flush_" + backend, os.path.join(work_directory, "flush_" + backend), backend)
+        for size, flush_time in measure_flush_cost(cache, [int(x) for x in args.sizes.split(",")]):
+            print("    flush() after one change at {0:>7} keys: {1:8.2f} ms".format(size, flush_time * 1000))
+        cache.stop()
+        failures = check_crash_consistency(work_directory, backend, args.crash_runs, args.crash_delay)
+        print("    crash consistency: {0}/{1} kills survived intact".format(
+            args.crash_runs - len(failures), args.crash_runs))
+        for failure in failures:
+            print("      {0}".format(failure))
+    shutil.rmtree(work_directory)
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.cache_file
+    main(sys.argv[1:])
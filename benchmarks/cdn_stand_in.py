@@ -0,0 +1,382 @@
+import os
+import sys
+import time
+import socket
+import random
+import threading
+import multiprocessing
+
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from adh_handler import AudibleDownloader
+
+
+class SyntheticPayload:
+    """
+        A deterministic, non-repeating-at-segment-boundaries stand-in for an AAX file.  Bytes are produced from a
+        random block whose length is deliberately not a power of two, so a range written at the wrong offset shows up.
+        Payloads built with the same seed are identical, which lets another process check a download against it.
+    """
+
+    BLOCK_SIZE = 1024 * 1024 + 7
+
+    def __init__(self, size, seed=None):
+        self.size = size
+        self._block = os.urandom(self.BLOCK_SIZE) if seed is None else random.Random(seed).randbytes(self.BLOCK_SIZE)
+        self._doubled_block = memoryview(self._block + self._block)
+
+    def read(self, offset, length):
+        length = min(length, self.size - offset, self.BLOCK_SIZE)
+        start = offset % self.BLOCK_SIZE
+        return self._doubled_block[start:start + length]
+
+    def iter_range(self, start, end):
+        while start <= end:
+            data = self.read(start, end - start + 1)
+            start += len(data)
+            yield data
+
+    def matches_file(self, file_path):
+        offset = 0
+        with open(file_path, "rb") as infile:
+            while True:
+                data = infile.read(self.BLOCK_SIZE)
+                if not data:
+                    break
+                for expected in self.iter_range(offset, offset + len(data) - 1):
+                    if data[:len(expected)] != expected:
+                        return False
+                    data = data[len(expected):]
+                    offset += len(expected)
+        return offset == self.size
+
+
+class PrefixedPayload(SyntheticPayload):
+    """
+        A payload starting with fixed bytes, such as an AAX header, followed by a SyntheticPayload body.  The body can
+        be shared by many payloads.
+    """
+
+    def __init__(self, head, body):
+        self.head = head
+        self.body = body
+        self.size = len(head) + body.size
+
+    def read(self, offset, length):
+        if offset < len(self.head):
+            return memoryview(self.head)[offset:offset + min(length, self.size - offset)]
+        return self.body.read(offset - len(self.head), length)
+
+
+class _TokenBucket:
+    """
+        Caps a byte rate for everything drawing from it.  Callers take what they need up front and sleep off any debt,
+        so concurrent connections share the rate roughly evenly.
+    """
+
+    # Idle time only builds up this much burst
+    MAX_BURST = 0.1
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate * self.MAX_BURST, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= amount
+            debt = -self._tokens / self.rate if self._tokens < 0 else 0
+        if debt:
+            time.sleep(debt)
+
+
+class _CdnRequestHandler(BaseHTTPRequestHandler):
+
+    # Throttled responses are written in pieces of this size so the rate stays smooth
+    THROTTLED_WRITE_SIZE = 64 * 1024
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse_range(self):
+        range_header = self.headers.get("Range")
+        if not range_header or not self.server.support_range or not range_header.startswith("bytes="):
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range not in (self.server.etag, self.server.last_modified):
+            return None
+        start, _, end = range_header[len("bytes="):].partition("-")
+        if not start.isdigit():
+            return None
+        payload_size = self.server.get_payload(self.path).size
+        end = int(end) if end.isdigit() else payload_size - 1
+        return int(start), min(end, payload_size - 1)
+
+    def _iter_response(self, payload, start, end):
+        rate_limits = []
+        if self.server.total_bandwidth:
+            rate_limits.append(self.server.total_bandwidth)
+        if self.server.bandwidth:
+            rate_limits.append(_TokenBucket(self.server.bandwidth))
+        for data in payload.iter_range(start, end):
+            if not rate_limits:
+                yield data
+                continue
+            for offset in range(0, len(data), self.THROTTLED_WRITE_SIZE):
+                piece = data[offset:offset + self.THROTTLED_WRITE_SIZE]
+                for rate_limit in rate_limits:
+                    rate_limit.consume(len(piece))
+                yield piece
+
+    def _send_throttled(self):
+        self.send_response(503)
+        self.send_header("Retry-After", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if not self.server.open_response():
+            self._send_throttled()
+            return
+        try:
+            self._send_payload()
+        finally:
+            self.server.close_response()
+
+    def _send_payload(self):
+        payload = self.server.get_payload(self.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        byte_range = self._parse_range()
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, payload.size))
+        else:
+            start, end = 0, payload.size - 1
+            self.send_response(200)
+        self.send_header("Content-Type", "audio/vnd.audible.aax")
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Last-Modified", self.server.last_modified)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        disconnect_after, stall = self.server.take_disconnect()
+        bytes_sent = 0
+        try:
+            for data in self._iter_response(payload, start, end):
+                if disconnect_after is not None and bytes_sent + len(data) > disconnect_after:
+                    self.wfile.write(data[:disconnect_after - bytes_sent])
+                    bytes_sent = disconnect_after
+                    if stall:
+                        # Go quiet without closing anything, like a connection lost somewhere along the way
+                        self.wfile.flush()
+                        self.server.stopping.wait()
+                    # Drop the connection mid-body, the client sees a short read
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    break
+                self.wfile.write(data)
+                bytes_sent += len(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.server.record_request(bytes_sent)
+
+
+class _CdnServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, payload, support_range, latency, bandwidth, total_bandwidth, payload_factory,
+                 max_connections):
+        super().__init__(("127.0.0.1", 0), _CdnRequestHandler)
+        self.payload = payload
+        self.payload_factory = payload_factory
+        self.support_range = support_range
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.total_bandwidth = _TokenBucket(total_bandwidth) if total_bandwidth else None
+        self.last_modified = formatdate(usegmt=True)
+        self.etag = ""
+        self.requests = 0
+        self.bytes_sent = 0
+        self.max_connections = max_connections
+        self.active_responses = 0
+        self.throttled = 0
+        self._pending_disconnects = []
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients that hang up, the downloader after a dropped response in particular, aren't errors here
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    def get_payload(self, request_path):
+        return self.payload_factory(request_path) if self.payload_factory else self.payload
+
+    def open_response(self):
+        with self._lock:
+            if self.max_connections and self.active_responses >= self.max_connections:
+                self.throttled += 1
+                return False
+            self.active_responses += 1
+            return True
+
+    def close_response(self):
+        with self._lock:
+            self.active_responses -= 1
+
+    def take_disconnect(self):
+        with self._lock:
+            return self._pending_disconnects.pop(0) if self._pending_disconnects else (None, False)
+
+    def add_disconnects(self, count, after_bytes, stall=False):
+        with self._lock:
+            self._pending_disconnects.extend([(after_bytes, stall)] * count)
+
+    def record_request(self, bytes_sent):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+
+
+class CdnStandIn:
+    """
+        Local HTTP server standing in for audible_cdn.  Every GET is answered with the same synthetic payload,
+        honouring Range and If-Range requests unless support_range is turned off.
+
+        latency delays every response by that many seconds, bandwidth caps each response and total_bandwidth all of
+        them together (bytes per second).  Beyond max_connections responses at once, further GETs are turned away
+        with a 503 and Retry-After.  inject_disconnects() makes the next responses drop their connection part way
+        through the body, inject_stalls() makes them stop sending without closing it.  payload_factory(request_path)
+        can hand out a different payload per request, it has to return the same payload every time it's asked for the
+        same title.
+    """
+
+    def __init__(self, payload_size, support_range=True, latency=0.0, bandwidth=None, total_bandwidth=None,
+                 seed=None, payload_factory=None, max_connections=None):
+        self.payload = SyntheticPayload(payload_size, seed)
+        self._server = _CdnServer(self.payload, support_range, latency, bandwidth, total_bandwidth, payload_factory,
+                                  max_connections)
+        self._server_thread = None
+        self.replace_payload()
+
+    def replace_payload(self):
+        # A new validator makes If-Range requests for the old payload fall back to a full response
+        self._server.etag = '"{0}"'.format(os.urandom(8).hex())
+
+    def inject_disconnects(self, count, after_bytes):
+        self._server.add_disconnects(count, after_bytes)
+
+    def inject_stalls(self, count, after_bytes):
+        self._server.add_disconnects(count, after_bytes, stall=True)
+
+    def set_total_bandwidth(self, total_bandwidth):
+        self._server.total_bandwidth = _TokenBucket(total_bandwidth) if total_bandwidth else None
+
+    def set_max_connections(self, max_connections):
+        self._server.max_connections = max_connections
+
+    @property
+    def stats(self):
+        return {"requests": self._server.requests, "bytes_sent": self._server.bytes_sent,
+                "throttled": self._server.throttled}
+
+    @property
+    def hostname(self):
+        return "{0}:{1}".format(*self._server.server_address)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+
+    def stop(self):
+        self._server.stopping.set()
+        self._server.shutdown()
+        self._server.server_close()
+        self._server_thread.join()
+
+
+def _serve_stand_in(connection, payload_size, options):
+    with CdnStandIn(payload_size, **options) as cdn:
+        connection.send(cdn.hostname)
+        while True:
+            command, arguments = connection.recv()
+            if command == "stop":
+                break
+            connection.send(getattr(cdn, command)(*arguments) if arguments is not None else getattr(cdn, command))
+
+
+class CdnStandInProcess:
+    """
+        CdnStandIn running in its own process, so the server's CPU time and syscalls don't end up in the numbers of
+        the process being measured.  Takes the same options, the seed is needed to check downloads against payload.
+    """
+
+    def __init__(self, payload_size, seed=0, **options):
+        self.payload = SyntheticPayload(payload_size, seed)
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve_stand_in,
+                                                args=(child_connection, payload_size, dict(options, seed=seed)))
+        self._process.daemon = True
+        self.hostname = None
+
+    def _call(self, command, arguments=None):
+        self._connection.send((command, arguments))
+        return self._connection.recv()
+
+    def inject_disconnects(self, count, after_bytes):
+        self._call("inject_disconnects", (count, after_bytes))
+
+    def inject_stalls(self, count, after_bytes):
+        self._call("inject_stalls", (count, after_bytes))
+
+    def set_total_bandwidth(self, total_bandwidth):
+        self._call("set_total_bandwidth", (total_bandwidth, ))
+
+    def set_max_connections(self, max_connections):
+        self._call("set_max_connections", (max_connections, ))
+
+    @property
+    def stats(self):
+        return self._call("stats")
+
+    def __enter__(self):
+        self._process.start()
+        self.hostname = self._connection.recv()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._connection.send(("stop", None))
+        self._process.join()
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.cdn_stand_in
+    import tempfile
+    adh_file = os.path.join(tempfile.mkdtemp(), "stand_in.adh")
+    with open(adh_file, "w") as outfile:
+        outfile.write("user_id=0&product_id=STANDIN&codec=LC_64_22050_stereo&awtype=AAX&cust_id=0&title=Stand In")
+    for support_range in (True, False):
+        with CdnStandIn(64 * 1024 * 1024 + 13, support_range=support_range) as cdn:
+            downloader = AudibleDownloader(cdn.hostname, "Audible ADM 6.6.0.19;Windows Vista  Build 9200", segments=4)
+            download_data = downloader.download_audiobook(adh_file)
+            print("[*] Range support: {0}, complete: {1}, payload intact: {2}".format(
+                support_range, download_data.complete, cdn.payload.matches_file(download_data.tempfile)))
+            os.unlink(download_data.tempfile)
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+
+from aax_converter import AaxConverter
+
+
+def generate_sample_audiobook(ffmpeg_path, file_path, duration):
+    # Unencrypted AAC in an MP4 container, the same layout an AAX has once it's decrypted
+    subprocess.run([
+        ffmpeg_path, "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", "sine=frequency=440:duration={0}".format(duration),
+        "-codec:a", "aac", "-b:a", "64k",
+        "-metadata", "title=Benchmark Book", "-metadata", "artist=Benchmark Author",
+        "-metadata", "album=Benchmark Book", "-metadata", "date=2020", "-metadata", "copyright=None",
+        file_path
+    ], check=True)
+
+
+def get_child_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_conversion(converter, output_format, input_file):
+    converter._output_format = output_format
+    finished = []
+    converter.conversion_finished_event = finished.append
+    wall_start, cpu_start = time.perf_counter(), get_child_cpu_time()
+    converter._conversion_worker(input_file)
+    wall_time, cpu_time = time.perf_counter() - wall_start, get_child_cpu_time() - cpu_start
+    if not finished:
+        raise RuntimeError("Conversion to {0} failed.".format(output_format))
+    return wall_time, cpu_time, os.path.getsize(finished[0].output_file)
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Compare MP3 re-encoding against lossless M4B remuxing.")
+    parser.add_argument("--input", help="AAX file to convert, a synthetic book is generated when omitted")
+    parser.add_argument("--activation-bytes", default="")
+    parser.add_argument("--duration", type=int, default=3600, help="Length of the synthetic book in seconds")
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    args = parser.parse_args(arguments)
+    work_directory = tempfile.mkdtemp()
+    input_file = args.input
+    if not input_file:
+        input_file = os.path.join(work_directory, "benchmark.m4a")
+        generate_sample_audiobook(args.ffmpeg, input_file, args.duration)
+    converter = AaxConverter({
+        "ffmpeg_path": args.ffmpeg,
+        "library_directory": work_directory
+    }, args.activation_bytes)
+    for output_format in ("mp3", "m4b"):
+        wall_time, cpu_time, output_size = run_conversion(converter, output_format, input_file)
+        print("[*] {0}: {1:8.2f} s wall  {2:8.2f} s CPU  {3:10.1f} MB output".format(
+            output_format, wall_time, cpu_time, output_size / 1e6))
+    shutil.rmtree(work_directory)
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.conversion
+    main(sys.argv[1:])
@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+
+from audible_archiver import AudibleLibraryDownloader
+from synchronized_cache_file import SynchronizedCacheFile
+from benchmarks.cdn_stand_in import CdnStandInProcess
+
+USER_AGENT = "Audible ADM 6.6.0.19;Windows Vista  Build 9200"
+MB = 1e6
+
+
+class Scenario:
+    """
+        One run of the scheduler against a stand-in with the given options.  bandwidth_limit is the client side
+        budget in MB/s, events is a list of (seconds into the run, stand-in method, arguments) applied while the
+        downloads run.  disconnects and stalls are injected before the first download starts, each cuts off or
+        silences a response a third of the way into the title.
+    """
+
+    def __init__(self, name, description, stand_in_options, bandwidth_limit=None, events=None, disconnects=0,
+                 stalls=0):
+        self.name = name
+        self.description = description
+        self.stand_in_options = stand_in_options
+        self.bandwidth_limit = bandwidth_limit
+        self.events = events or []
+        self.disconnects = disconnects
+        self.stalls = stalls
+
+
+SCENARIOS = {
+    "converge": Scenario("converge", "2 MB/s per connection, 8 MB/s in total, streams should settle around 4",
+                         {"bandwidth": 2 * MB, "total_bandwidth": 8 * MB}),
+    "budget": Scenario("budget", "4 MB/s per connection, a 6 MB/s client budget, the rate should hold at 6",
+                       {"bandwidth": 4 * MB}, bandwidth_limit=6),
+    "capacity-drop": Scenario("capacity-drop", "2 MB/s per connection, the 8 MB/s total drops to 3 MB/s half way",
+                              {"bandwidth": 2 * MB, "total_bandwidth": 8 * MB},
+                              events=[(0.5, "set_total_bandwidth", (3 * MB, ))]),
+    "throttled": Scenario("throttled", "2 MB/s per connection, 503 beyond 3 connections, dropped connections",
+                          {"bandwidth": 2 * MB, "max_connections": 3}, disconnects=4),
+    "stalled": Scenario("stalled", "2 MB/s per connection, responses that go quiet without closing",
+                        {"bandwidth": 2 * MB}, stalls=2)
+}
+
+
+class NullConverter:
+    """
+        Stands in for AaxConverter, the downloads are all this benchmark looks at.
+    """
+
+    def convert_file(self, aax_file):
+        pass
+
+    def open_stream(self, partial_file):
+        return None
+
+
+class BenchmarkLibraryDownloader(AudibleLibraryDownloader):
+    """
+        The archiver's own download workers, counting the retries they make and keeping the scheduler's timeline.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.aax_converter = NullConverter()
+        self.retries = 0
+        self._retry_lock = threading.Lock()
+
+    def _handle_download_result(self, adh_file, attempt=0):
+        retry_delay = super()._handle_download_result(adh_file, attempt)
+        if retry_delay is not None:
+            with self._retry_lock:
+                self.retries += 1
+        return retry_delay
+
+    @property
+    def download_scheduler(self):
+        return self._download_scheduler
+
+    def register_adh_file(self, adh_file):
+        # Keyed the way AdhDownloader keys it, by the identifier the download workers look titles up with
+        adh_download_cache = self._load_adh_download_cache()
+        adh_download_cache[self._get_adh_file_identifier(adh_file)] = adh_file
+
+
+def build_config(work_directory, cdn, scenario, args):
+    directories = {x: os.path.join(work_directory, x) for x in ("adh", "aax", "cache")}
+    for directory in directories.values():
+        os.makedirs(directory)
+    return {
+        "audible_cdn": cdn.hostname,
+        "user_agent": USER_AGENT,
+        "aax_download_directory": directories["aax"],
+        "adh_directory": directories["adh"],
+        "adh_cache_file": os.path.join(directories["cache"], "adh"),
+        "aax_cache_file": os.path.join(directories["cache"], "aax"),
+        "cache_backend": "json",
+        "max_downloads": args.max_streams,
+        "download_segments": 1,
+        "download_timeout": [5, args.read_timeout],
+        "download_scheduler": {
+            "adaptive": True,
+            "initial_downloads": 1,
+            "adjust_interval": args.adjust_interval,
+            "bandwidth_limit": scenario.bandwidth_limit
+        }
+    }
+
+
+def write_adh_files(config, titles):
+    downloader = BenchmarkLibraryDownloader(config)
+    for i in range(titles):
+        adh_file = os.path.join(config["adh_directory"], "BENCH_{0}.adh".format(i))
+        with open(adh_file, "w") as outfile:
+            outfile.write("user_id=0&product_id=BENCH_{0}&codec=LC_64_22050_stereo&awtype=AAX&cust_id=0"
+                          "&title=Benchmark Title {0}".format(i))
+        downloader.register_adh_file(adh_file)
+    SynchronizedCacheFile("adh_cache_file").flush()
+
+
+def run_scenario(scenario, args, work_directory):
+    payload_size = int(args.title_size * 1024 * 1024)
+    runs = []
+    history = []
+    with CdnStandInProcess(payload_size, **scenario.stand_in_options) as cdn:
+        config = build_config(work_directory, cdn, scenario, args)
+        output = sys.stdout if args.verbose else open(os.devnull, "w")
+        with contextlib.redirect_stdout(output):
+            SynchronizedCacheFile.initialize(config)
+            write_adh_files(config, args.titles)
+            if scenario.disconnects:
+                cdn.inject_disconnects(scenario.disconnects, payload_size // 3)
+            if scenario.stalls:
+                cdn.inject_stalls(scenario.stalls, payload_size // 3)
+            start = time.monotonic()
+            # Events are timed against how long the downloads would take at the stand-in's full rate
+            expected_time = args.titles * payload_size / scenario.stand_in_options.get(
+                "total_bandwidth", scenario.stand_in_options["bandwidth"] * args.max_streams)
+            # Like running the archiver again, titles left over after a run are picked up by the next one
+            for _ in range(args.runs):
+                downloader = BenchmarkLibraryDownloader(config)
+                events = [threading.Timer(max(0, start + at * expected_time - time.monotonic()),
+                                          getattr(cdn, command), arguments)
+                          for at, command, arguments in scenario.events] if not runs else []
+                for event in events:
+                    event.start()
+                downloader.download_all_files()
+                for event in events:
+                    event.join()
+                runs.append(downloader.retries)
+                history.extend(downloader.download_scheduler.history)
+                aax_download_cache = SynchronizedCacheFile("aax_cache_file")
+                downloaded = [aax_download_cache[x]["filepath"]
+                              for x in aax_download_cache.lookup("state", "downloaded")]
+                if len(downloaded) == args.titles:
+                    break
+            elapsed = time.monotonic() - start
+            # A partial file no unfinished title points at is never resumed or cleaned up
+            resumable = {os.path.basename(aax_download_cache[x]["download_state"]["tempfile"])
+                         for x in aax_download_cache.lookup("state", "pending")
+                         if "download_state" in aax_download_cache[x]}
+            orphaned = [x for x in os.listdir(config["aax_download_directory"])
+                        if x.endswith(".part") and x not in resumable]
+            for cache_file_key in ("adh_cache_file", "aax_cache_file"):
+                SynchronizedCacheFile(cache_file_key).stop()
+        stats = cdn.stats
+    intact = len(downloaded) == args.titles and all(cdn.payload.matches_file(x) for x in downloaded)
+    return {
+        "mb_per_second": len(downloaded) * payload_size / elapsed / MB,
+        "elapsed": elapsed,
+        "final_streams": history[-1][3] if history else 1,
+        "runs": len(runs),
+        "retries": sum(runs),
+        "throttled": stats["throttled"],
+        "downloaded": len(downloaded),
+        "orphaned": len(orphaned),
+        "intact": intact,
+        "history": [(at - start, throughput, busy, limit, reason)
+                    for at, throughput, busy, limit, reason in history]
+    }
+
+
+def print_history(history):
+    print("    {0:>7} {1:>8} {2:>6} {3:>7}  {4}".format("time", "MB/s", "busy", "streams", "change"))
+    for at, throughput, busy, limit, reason in history:
+        print("    {0:>6.1f}s {1:>8.2f} {2:>6.2f} {3:>7}  {4}".format(at, throughput / MB, busy, limit, reason or ""))
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Runs the archiver's download workers with the adaptive scheduler "
+                                                 "against a bandwidth capped CDN stand-in and prints how the stream "
+                                                 "count developed.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Any of " + ", ".join(SCENARIOS))
+    parser.add_argument("--titles", type=int, default=24)
+    parser.add_argument("--title-size", type=float, default=8, help="MiB per title")
+    parser.add_argument("--max-streams", type=int, default=8, help="Download workers, like max_downloads")
+    parser.add_argument("--adjust-interval", type=float, default=1.0)
+    parser.add_argument("--read-timeout", type=float, default=3.0, help="Seconds a response may go quiet")
+    parser.add_argument("--runs", type=int, default=3, help="Archiver runs before giving up on a title")
+    parser.add_argument("--quiet", action="store_true", help="Leave out the per interval timeline")
+    parser.add_argument("--verbose", action="store_true", help="Show the download workers' own output")
+    args = parser.parse_args(arguments)
+    failed = False
+    for scenario in [SCENARIOS[x] for x in args.scenarios.split(",")]:
+        print("[*] {0}: {1}".format(scenario.name, scenario.description))
+        work_directory = tempfile.mkdtemp()
+        try:
+            result = run_scenario(scenario, args, work_directory)
+        finally:
+            shutil.rmtree(work_directory)
+        if not args.quiet:
+            print_history(result["history"])
+        print("[*] {0}: {1:.2f} MB/s over {2:.1f}s, {3} streams at the end, {4}/{5} titles in {6} runs, "
+              "{7} retries, {8} throttled, {9} orphaned partial files, payloads intact: {10}".format(
+                  scenario.name, result["mb_per_second"], result["elapsed"], result["final_streams"],
+                  result["downloaded"], args.titles, result["runs"], result["retries"], result["throttled"],
+                  result["orphaned"], "yes" if result["intact"] else "NO"))
+        failed = failed or not result["intact"] or result["orphaned"] > 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.download_scheduler
+    sys.exit(main(sys.argv[1:]))
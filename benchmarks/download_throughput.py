@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+from adh_handler import AudibleDownloader, DownloadData
+from benchmarks.cdn_stand_in import CdnStandInProcess
+from benchmarks.download_write_path import LegacyAudibleDownloader, NullProgressBar
+
+USER_AGENT = "Audible ADM 6.6.0.19;Windows Vista  Build 9200"
+
+
+def read_syscall_counts():
+    # Read and write style syscalls of this process, None where /proc/self/io isn't available
+    try:
+        with open("/proc/self/io", "r") as infile:
+            counters = dict(line.split(": ") for line in infile.read().splitlines())
+        return int(counters["syscr"]), int(counters["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def read_context_switches():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+
+class Variant:
+
+    def __init__(self, name, downloader_type, show_progress, **options):
+        self.name = name
+        self.downloader_type = downloader_type
+        self.show_progress = show_progress
+        self.options = options
+
+    def download(self, cdn, session, adh_file, temp_file):
+        """
+            Downloads one title, resuming after dropped connections the way the next run of the archiver would.
+            Returns how many times the download had to be resumed.
+        """
+        downloader = self.downloader_type(cdn.hostname, USER_AGENT, session, **self.options)
+        if self.show_progress:
+            downloader.download_data_callback = NullProgressBar().update_progress
+        download_data = DownloadData(temp_file)
+        resumes = 0
+        while True:
+            try:
+                downloader.download_audiobook(adh_file, download_data)
+                if download_data.complete:
+                    return resumes
+            except requests.RequestException:
+                pass
+            resumes += 1
+            if resumes > 10:
+                raise RuntimeError("{0} did not complete after {1} attempts.".format(self.name, resumes))
+
+
+VARIANTS = {
+    "legacy": Variant("legacy 4 KB loop", LegacyAudibleDownloader, True),
+    "tuned": Variant("tuned", AudibleDownloader, False),
+    "tuned+progress": Variant("tuned + progress bar", AudibleDownloader, True),
+    "segmented": Variant("tuned, 4 segments", AudibleDownloader, True, segments=4)
+}
+
+
+def run_case(variant, cdn, adh_file, work_directory, concurrency, disconnects):
+    temp_files = [os.path.join(work_directory, "download_{0}.aax.part".format(i)) for i in range(concurrency)]
+    if disconnects:
+        # Cut each of the first responses a third of the way through the payload
+        cdn.inject_disconnects(disconnects, cdn.payload.size // 3)
+    session = AudibleDownloader.create_session(concurrency * variant.options.get("segments", 1))
+    syscalls_start, switches_start = read_syscall_counts(), read_context_switches()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        resumes = sum(executor.map(lambda x: variant.download(cdn, session, adh_file, x), temp_files))
+    wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    syscalls_end, switches_end = read_syscall_counts(), read_context_switches()
+    session.close()
+    intact = all(cdn.payload.matches_file(x) for x in temp_files)
+    for temp_file in temp_files:
+        os.unlink(temp_file)
+    total_bytes = cdn.payload.size * concurrency
+    syscalls = None
+    if syscalls_start and syscalls_end:
+        syscalls = tuple((end - start) / (total_bytes / 1e9) for start, end in zip(syscalls_start, syscalls_end))
+    return {
+        "mb_per_second": total_bytes / wall_time / 1e6,
+        "cpu_per_gb": cpu_time / (total_bytes / 1e9),
+        "syscalls_per_gb": syscalls,
+        "switches_per_gb": (switches_end - switches_start) / (total_bytes / 1e9),
+        "resumes": resumes,
+        "intact": intact
+    }
+
+
+def format_result(result):
+    syscalls = "{0:>9.0f} {1:>9.0f}".format(*result["syscalls_per_gb"]) if result["syscalls_per_gb"] else \
+        "{0:>9} {0:>9}".format("n/a")
+    return "{0:8.1f} {1:8.2f} {2} {3:>9.0f} {4:>7} {5:>6}".format(
+        result["mb_per_second"], result["cpu_per_gb"], syscalls, result["switches_per_gb"], result["resumes"],
+        "yes" if result["intact"] else "NO")
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Download throughput of the AAX download paths against a local "
+                                                 "CDN stand-in running in a separate process.")
+    parser.add_argument("--sizes", default="16,128,512", help="Comma separated payload sizes in MiB")
+    parser.add_argument("--concurrency", default="1,4", help="Comma separated numbers of simultaneous downloads")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="Any of " + ", ".join(VARIANTS))
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before every response")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="Per response cap in MB/s, 0 for none")
+    parser.add_argument("--total-bandwidth", type=float, default=0.0, help="Shared cap in MB/s, 0 for none")
+    parser.add_argument("--disconnects", type=int, default=0, help="Responses dropped part way, per case")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case, the fastest is reported")
+    args = parser.parse_args(arguments)
+    work_directory = tempfile.mkdtemp()
+    adh_file = os.path.join(work_directory, "benchmark.adh")
+    with open(adh_file, "w") as outfile:
+        outfile.write("user_id=0&product_id=BENCH&codec=LC_64_22050_stereo&awtype=AAX&cust_id=0&title=Benchmark")
+    stand_in_options = {
+        "latency": args.latency,
+        "bandwidth": args.bandwidth * 1e6 or None,
+        "total_bandwidth": args.total_bandwidth * 1e6 or None
+    }
+    print("{0:<22} {1:>6} {2:>4} {3:>8} {4:>8} {5:>9} {6:>9} {7:>9} {8:>7} {9:>6}".format(
+        "variant", "MiB", "conc", "MB/s", "CPU s/GB", "syscr/GB", "syscw/GB", "ctxsw/GB", "resumes", "intact"))
+    for size in [int(x) for x in args.sizes.split(",")]:
+        with CdnStandInProcess(size * 1024 * 1024, **stand_in_options) as cdn:
+            for concurrency in [int(x) for x in args.concurrency.split(",")]:
+                for variant in [VARIANTS[x] for x in args.variants.split(",")]:
+                    results = [run_case(variant, cdn, adh_file, work_directory, concurrency, args.disconnects)
+                               for _ in range(args.repeat)]
+                    result = max(results, key=lambda x: x["mb_per_second"])
+                    print("{0:<22} {1:>6} {2:>4} {3}".format(variant.name, size, concurrency, format_result(result)))
+    shutil.rmtree(work_directory)
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.download_throughput
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+import progressbar
+
+from adh_handler import AudibleDownloader, DownloadData
+from benchmarks.cdn_stand_in import CdnStandIn
+
+
+class LegacyAudibleDownloader(AudibleDownloader):
+    """
+        The original write loop: 4 KB chunks, a flush per chunk and a progress callback per chunk.  Kept here only as
+        the baseline the tuned path is measured against.
+    """
+
+    def _handle_multipart_download(self, response, download_data, offset=0):
+        download_data.content_length = response.headers.get("content-length")
+        if not download_data.content_length:
+            return False
+        download_data.content_length = int(download_data.content_length)
+        with open(download_data.tempfile, "wb") as outfile:
+            for data in response.iter_content(chunk_size=4096):
+                download_data.download_progress += len(data)
+                outfile.write(data)
+                outfile.flush()
+                if self.download_data_callback:
+                    self.download_data_callback(download_data)
+        return download_data.complete
+
+
+class NullProgressBar:
+    # Draws a real progressbar, just not to the terminal, so redraw cost is part of the measurement
+
+    def __init__(self):
+        self._devnull = open(os.devnull, "w")
+        self._progress_bar = None
+
+    def update_progress(self, download_data):
+        if not self._progress_bar:
+            self._progress_bar = progressbar.ProgressBar(max_value=download_data.content_length, fd=self._devnull)
+            self._progress_bar.start()
+        self._progress_bar.update(min(download_data.download_progress, download_data.content_length))
+
+
+def run_download(downloader_type, cdn, adh_file, download_directory, **kwargs):
+    downloader = downloader_type(cdn.hostname, "Audible ADM 6.6.0.19;Windows Vista  Build 9200", **kwargs)
+    downloader.download_data_callback = NullProgressBar().update_progress
+    download_data = DownloadData(os.path.join(download_directory, "benchmark.aax.part"))
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    downloader.download_audiobook(adh_file, download_data)
+    wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    if not download_data.complete:
+        raise RuntimeError("Benchmark download did not complete.")
+    os.unlink(download_data.tempfile)
+    return wall_time, cpu_time
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Compare the legacy and tuned AAX download write paths.")
+    parser.add_argument("--size-mb", type=int, default=512, help="Synthetic payload size in MiB")
+    parser.add_argument("--buffer-size", type=int, default=AudibleDownloader.DEFAULT_BUFFER_SIZE)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(arguments)
+    download_directory = tempfile.mkdtemp()
+    adh_file = os.path.join(download_directory, "benchmark.adh")
+    with open(adh_file, "w") as outfile:
+        outfile.write("user_id=0&product_id=BENCH&codec=LC_64_22050_stereo&awtype=AAX&cust_id=0&title=Benchmark")
+    variants = [
+        ("legacy 4 KB loop", LegacyAudibleDownloader, {}),
+        ("tuned readinto loop", AudibleDownloader, {"buffer_size": args.buffer_size})
+    ]
+    size = args.size_mb * 1024 * 1024
+    with CdnStandIn(size) as cdn:
+        for name, downloader_type, kwargs in variants:
+            # Best of N, the stand-in shares the machine so the fastest run is the least disturbed one
+            wall_time, cpu_time = min(run_download(downloader_type, cdn, adh_file, download_directory, **kwargs)
+                                      for _ in range(args.repeat))
+            print("[*] {0:<20} {1:8.1f} MB/s  {2:6.2f} s CPU/GB".format(
+                name, size / wall_time / 1e6, cpu_time / (size / 1e9)))
+    os.unlink(adh_file)
+    os.rmdir(download_directory)
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.download_write_path
+    main(sys.argv[1:])
@@ -0,0 +1,29 @@
+"""
+    Stands in for ffmpeg in the pipeline simulator.  Reads its input the way a conversion would, spends
+    FAKE_FFMPEG_ENCODE_SECONDS on the "encode" and writes a small output file to the last argument.
+"""
+import os
+import sys
+import time
+
+READ_SIZE = 1024 * 1024
+
+
+def main(arguments):
+    input_file = arguments[arguments.index("-i") + 1] if "-i" in arguments else None
+    output_file = arguments[-1]
+    if input_file == "pipe:0":
+        while sys.stdin.buffer.read(READ_SIZE):
+            pass
+    elif input_file:
+        with open(input_file, "rb") as infile:
+            while infile.read(READ_SIZE):
+                pass
+    time.sleep(float(os.environ.get("FAKE_FFMPEG_ENCODE_SECONDS", "0")))
+    with open(output_file, "wb") as outfile:
+        outfile.write(b"fake ffmpeg output\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,70 @@
+import os
+
+
+PRODUCT_ROW = """<div class="adbl-library-content-row" id="adbl-library-content-row-{asin}">
+  <div class="bc-row-responsive">
+    <div class="bc-col-responsive bc-col-2">
+      <a class="bc-link" href="/pd/{asin}"><img class="bc-pub-block bc-image-inset-border" alt="{title}" src="https://m.media-amazon.com/images/I/{asin}._SL175_.jpg"></a>
+    </div>
+    <div class="bc-col-responsive bc-col-6">
+      <ul class="bc-list bc-list-nostyle">
+        <li class="bc-list-item"><a class="bc-link bc-color-base" href="/pd/{asin}"><span class="bc-text bc-size-headline3">{title}</span></a></li>
+        <li class="bc-list-item authorLabel"><span class="bc-text">By: <a class="bc-link bc-color-base" href="/author/{index}">Author {index}</a></span></li>
+        <li class="bc-list-item narratorLabel"><span class="bc-text">Narrated by: <a class="bc-link bc-color-base" href="/search?searchNarrator={index}">Narrator {index}</a></span></li>
+        <li class="bc-list-item"><span class="bc-text bc-color-secondary">{index} hrs and 12 mins</span></li>
+      </ul>
+    </div>
+    <div class="bc-col-responsive bc-col-4">
+      <span class="bc-button bc-button-primary"><a class="bc-button-text" href="/webplayer?asin={asin}" role="button"><span class="bc-text bc-button-text-inner bc-size-action-large">Listen now</span></a></span>
+      <div class="bc-popover bc-hidden" id="library-download-popover-{asin}" role="tooltip">
+        <div class="bc-popover-inner">
+          <a class="bc-link bc-color-link" aria-label="DownloadPart" href="https://cds.audible.com/download?asin={asin}&amp;part=1">Part 1</a>
+          <a class="bc-link bc-color-link" aria-label="DownloadFull" href="{download_base}/download?user_id=bench&amp;product_id={product_id}&amp;codec=LC_64_22050_Stereo&amp;awtype=AAX&amp;cust_id=bench">Download</a>
+        </div>
+      </div>
+      <script type="text/javascript">P.when("library-row").execute(function(row) {{ row.init("{asin}", {{"rating": 4, "finished": false}}); }});</script>
+    </div>
+  </div>
+</div>
+"""
+
+
+def get_title(index):
+    return "Benchmark Title {0}".format(index)
+
+
+def get_product_id(index):
+    return "BK_BENCH_{0:06d}".format(index)
+
+
+def generate_library_page(library_page, page_count, titles_per_page=50, first_index=None, last_index=None,
+                          download_base="https://cds.audible.com"):
+    """
+        Markup shaped like an Audible library page: one content row per title, each with a download popover holding
+        the DownloadFull link, and the pagination links at the bottom.  Titles are numbered newest first across pages.
+    """
+    if first_index is None:
+        first_index = (library_page - 1) * titles_per_page
+    if last_index is None:
+        last_index = first_index + titles_per_page
+    rows = []
+    for index in range(first_index, last_index):
+        rows.append(PRODUCT_ROW.format(asin="B{0:09d}".format(index), title=get_title(index), index=index,
+                                       product_id=get_product_id(index), download_base=download_base))
+    pagination = "".join(
+        '<li class="bc-list-item"><a class="bc-link pageNumberElement" data-name="page" data-value="{0}" '
+        'href="/lib?page={0}">{0}</a></li>'.format(x) for x in range(1, page_count + 1))
+    return ("<!DOCTYPE html><html><head><title>Library</title>"
+            "<style>.bc-row-responsive {{ display: flex; }}</style></head><body>"
+            "<div id=\"adbl-library-content-main\">{0}</div>"
+            "<ul class=\"bc-list pagingElements\">{1}</ul></body></html>").format("".join(rows), pagination)
+
+
+def write_library_pages(directory, page_count, titles_per_page=50):
+    file_paths = []
+    for library_page in range(1, page_count + 1):
+        file_path = os.path.join(directory, "library_page_{0:03d}.html".format(library_page))
+        with open(file_path, "w", encoding="utf-8") as outfile:
+            outfile.write(generate_library_page(library_page, page_count, titles_per_page))
+        file_paths.append(file_path)
+    return file_paths
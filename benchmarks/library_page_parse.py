@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from adh_handler.library_page import parse_library_page
+from benchmarks.library_fixtures import write_library_pages
+
+
+def legacy_parse_library_page(audible_library_html):
+    """
+        The original extraction: two complete BeautifulSoup trees of the same page.  Kept here only as the baseline
+        the single pass extractor is measured and checked against.
+    """
+    from bs4 import BeautifulSoup
+    available_pages = []
+    soup = BeautifulSoup(audible_library_html, "html.parser")
+    for page_link in soup.find_all("a", {"class": "pageNumberElement", "data-name": "page"}):
+        try:
+            available_pages.append(int(page_link['data-value']))
+        except ValueError:
+            pass
+    download_urls = []
+    soup = BeautifulSoup(audible_library_html, "html.parser")
+    for content_row in soup.find_all("div", id=lambda x: x and x.startswith("library-download-popover")):
+        content_adh_link = content_row.find_all("a", {"class": "bc-link", "aria-label": "DownloadFull"}, href=True)
+        if content_adh_link:
+            download_urls.append(content_adh_link[0]['href'])
+    return max(available_pages, default=1), download_urls
+
+
+def find_fixture_pages(paths):
+    fixture_pages = []
+    for path in paths:
+        if os.path.isdir(path):
+            fixture_pages.extend(sorted(os.path.join(path, x) for x in os.listdir(path) if x.endswith(".html")))
+        else:
+            fixture_pages.append(path)
+    return fixture_pages
+
+
+def time_parser(parse_function, page_contents, repeat):
+    # Best of N per page, reported as milliseconds per page
+    per_page = []
+    for page_content in page_contents:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parse_function(page_content)
+            timings.append(time.perf_counter() - start)
+        per_page.append(min(timings))
+    return sum(per_page) / len(per_page) * 1000, max(per_page) * 1000
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Time library page extraction on saved library pages.")
+    parser.add_argument("pages", nargs="*", help="Saved library pages (.html) or directories of them, synthetic "
+                                                 "pages are generated when omitted")
+    parser.add_argument("--synthetic-pages", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(arguments)
+    work_directory = None
+    fixture_pages = find_fixture_pages(args.pages)
+    if not fixture_pages:
+        work_directory = tempfile.mkdtemp()
+        fixture_pages = write_library_pages(work_directory, args.synthetic_pages)
+    page_contents = []
+    for fixture_page in fixture_pages:
+        with open(fixture_page, "r", encoding="utf-8") as infile:
+            page_contents.append(infile.read())
+    print("[*] {0} pages, {1:.1f} KB average".format(
+        len(page_contents), sum(len(x) for x in page_contents) / len(page_contents) / 1024))
+    variants = [("single pass extractor", parse_library_page)]
+    try:
+        import bs4
+        variants.insert(0, ("legacy BeautifulSoup", legacy_parse_library_page))
+        for fixture_page, page_content in zip(fixture_pages, page_contents):
+            if parse_library_page(page_content) != legacy_parse_library_page(page_content):
+                print("[*] Extractors disagree on {0}".format(fixture_page))
+    except ImportError:
+        print("[*] bs4 not installed, skipping the legacy baseline")
+    for name, parse_function in variants:
+        mean_time, worst_time = time_parser(parse_function, page_contents, args.repeat)
+        print("[*] {0:<22} {1:8.2f} ms/page  {2:8.2f} ms worst".format(name, mean_time, worst_time))
+    if work_directory:
+        shutil.rmtree(work_directory)
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.library_page_parse [saved pages or directories]
+    main(sys.argv[1:])
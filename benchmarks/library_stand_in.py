@@ -0,0 +1,126 @@
+import time
+import threading
+
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.library_fixtures import generate_library_page, get_title
+
+
+class _LibraryRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_sign_in_redirect(self):
+        self.send_response(302)
+        self.send_header("Location", "{0}/ap/signin".format(self.server.base_url))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _is_signed_in(self):
+        if self.server.session_token is None:
+            return True
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        return "session-token" in cookie and cookie["session-token"].value == self.server.session_token
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        request = urlparse(self.path)
+        query = dict(parse_qsl(request.query))
+        if not self._is_signed_in():
+            self._send_sign_in_redirect()
+        elif request.path.endswith("/download"):
+            self._send(self.server.get_adh_content(query.get("product_id", "")), "audio/vnd.audible.adh")
+        else:
+            self._send(self.server.get_library_page(int(query.get("page", "1"))), "text/html; charset=utf-8")
+        self.server.record_request(request.path)
+
+
+class _LibraryServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, title_count, titles_per_page, latency, session_token):
+        super().__init__(("127.0.0.1", 0), _LibraryRequestHandler)
+        self.title_count = title_count
+        self.titles_per_page = titles_per_page
+        self.latency = latency
+        self.session_token = session_token
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return "http://{0}:{1}".format(*self.server_address)
+
+    def get_library_page(self, library_page):
+        page_count = max(1, -(-self.title_count // self.titles_per_page))
+        first_index = (library_page - 1) * self.titles_per_page
+        last_index = min(self.title_count, first_index + self.titles_per_page)
+        return generate_library_page(library_page, page_count, self.titles_per_page, first_index,
+                                     max(first_index, last_index), self.base_url).encode("utf-8")
+
+    def get_adh_content(self, product_id):
+        index = int(product_id.rsplit("_", 1)[-1])
+        return "user_id=bench&product_id={0}&codec=LC_64_22050_Stereo&awtype=AAX&cust_id=bench&title={1}".format(
+            product_id, get_title(index)).encode("utf-8")
+
+    def record_request(self, request_path):
+        with self._lock:
+            self.requests[request_path] = self.requests.get(request_path, 0) + 1
+
+
+class LibraryStandIn:
+    """
+        Local HTTP server standing in for the Audible website: library pages listing title_count synthetic titles,
+        newest first, with DownloadFull links pointing back at this server for the ADH helper files.  With a
+        session_token, requests without a matching session-token cookie are redirected to the sign in page, the way
+        Audible treats a signed out or expired session.
+    """
+
+    LIBRARY_URL = "lib?page={0}"
+
+    def __init__(self, title_count, titles_per_page=50, latency=0.0, session_token=None):
+        self._server = _LibraryServer(title_count, titles_per_page, latency, session_token)
+        self._server_thread = None
+
+    @property
+    def base_url(self):
+        return self._server.base_url + "/"
+
+    @property
+    def requests(self):
+        return dict(self._server.requests)
+
+    def set_session_token(self, session_token):
+        # Signs out every session handed out so far
+        self._server.session_token = session_token
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._server_thread = threading.Thread(target=self._server.serve_forever)
+        self._server_thread.daemon = True
+        self._server_thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._server_thread.join()
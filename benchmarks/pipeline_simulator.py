@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+
+from urllib.parse import urlparse, parse_qsl
+
+import audible_archiver
+from audible_archiver import AudibleLibraryDownloader
+from audible_driver.driver_config import AudibleDriverConfig
+from adh_handler.adh_downloader import AdhDownloader
+from pipeline_metrics import PipelineMetrics
+from synchronized_cache_file import SynchronizedCacheFile
+from benchmarks.cdn_stand_in import CdnStandIn, PrefixedPayload, SyntheticPayload
+from benchmarks.library_stand_in import LibraryStandIn
+from benchmarks.library_fixtures import get_title
+from benchmarks.synthetic_aax import build_aax_head
+
+USER_AGENT = "Audible ADM 6.6.0.19;Windows Vista  Build 9200"
+BROWSER_USER_AGENT = "Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; AS; rv:11.0) like Gecko"
+
+
+class FakeAudibleDriver:
+    """
+        Stands in for AudibleDriver: logs on without a browser and hands back canned activation session data.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def log_on(self, username, password, mfa_token=None):
+        self.config.set_login_username(username)
+
+    def get_activation_session_data(self):
+        return {
+            "data": {"playerToken": "simulated"},
+            "cookies": [{"name": "session-id", "value": "simulated"}, {"name": "session-token", "value": "simulated"}]
+        }
+
+
+class StageTimer:
+    """
+        Collects (start, end, size) per pipeline stage and reports each stage's throughput over the time it was
+        active, along with the mean time a single item spent in it.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, start, end, size=0):
+        with self._lock:
+            count, first_start, last_end, total_size, busy_time = self._stages.get(stage, (0, start, end, 0, 0.0))
+            self._stages[stage] = (count + 1, min(first_start, start), max(last_end, end), total_size + size,
+                                   busy_time + end - start)
+
+    def report(self, origin):
+        lines = ["{0:<14} {1:>7} {2:>9} {3:>9} {4:>10} {5:>9} {6:>10}".format(
+            "stage", "items", "first s", "last s", "items/s", "MB/s", "mean s")]
+        for stage, (count, first_start, last_end, total_size, busy_time) in self._stages.items():
+            span = max(last_end - first_start, 1e-9)
+            lines.append("{0:<14} {1:>7} {2:>9.2f} {3:>9.2f} {4:>10.1f} {5:>9.1f} {6:>10.3f}".format(
+                stage, count, first_start - origin, last_end - origin, count / span, total_size / span / 1e6,
+                busy_time / count))
+        return lines
+
+
+class InstrumentedAdhDownloader(AdhDownloader):
+
+    stage_timer = None
+
+    def _get_library_page(self, session, library_page):
+        start = time.perf_counter()
+        library_html = super()._get_library_page(session, library_page)
+        self.stage_timer.record("library pages", start, time.perf_counter(), len(library_html))
+        return library_html
+
+    def _download_adh_file(self, session, download_link, destination_file):
+        start = time.perf_counter()
+        adh_file = super()._download_adh_file(session, download_link, destination_file)
+        self.stage_timer.record("helper files", start, time.perf_counter(), os.path.getsize(adh_file))
+        return adh_file
+
+
+class InstrumentedLibraryDownloader(AudibleLibraryDownloader):
+
+    stage_timer = None
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._downloaded_at = {}
+
+    def _download_audiobook(self, adh_file):
+        start = time.perf_counter()
+        download_progressbar, conversion_stream = super()._download_audiobook(adh_file)
+        end = time.perf_counter()
+        destination_file = download_progressbar.destination_file
+        if destination_file and os.path.isfile(destination_file):
+            self.stage_timer.record("downloads", start, end, os.path.getsize(destination_file))
+            self._downloaded_at[destination_file] = end
+        return download_progressbar, conversion_stream
+
+    def finalize_conversion(self, metadata):
+        # Measured from the end of the download, so time spent waiting for a free converter counts too
+        end = time.perf_counter()
+        self.stage_timer.record("conversions", self._downloaded_at.get(metadata.aax_file, end), end)
+        super().finalize_conversion(metadata)
+
+
+class TitlePayloads:
+    """
+        payload_factory for the CDN stand-in: a synthetic AAX per title, with the title's own tags in front of an
+        audio body all titles share.
+    """
+
+    def __init__(self, audio_size, duration):
+        self._audio = SyntheticPayload(audio_size, seed=0)
+        self._duration = duration
+
+    def __call__(self, request_path):
+        product_id = dict(parse_qsl(urlparse(request_path).query)).get("product_id", "")
+        title = get_title(int(product_id.rsplit("_", 1)[-1]))
+        head = build_aax_head(title, "Benchmark Author", title, "2020", "Simulated", self._duration, 64000,
+                              self._audio.size)
+        return PrefixedPayload(head, self._audio)
+
+
+def write_ffmpeg_wrapper(directory):
+    # The converter runs ffmpeg_path as an executable, so point it at a small launcher for fake_ffmpeg.py
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ffmpeg.py")
+    if os.name == "nt":
+        wrapper = os.path.join(directory, "ffmpeg.cmd")
+        content = '@"{0}" "{1}" %*\r\n'.format(sys.executable, script)
+    else:
+        wrapper = os.path.join(directory, "ffmpeg")
+        content = '#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable, script)
+    with open(wrapper, "w") as outfile:
+        outfile.write(content)
+    os.chmod(wrapper, 0o755)
+    return wrapper
+
+
+def build_config(work_directory, library, cdn, ffmpeg_path, args):
+    directories = {x: os.path.join(work_directory, x) for x in ("adh", "aax", "cache", "library")}
+    for directory in directories.values():
+        os.makedirs(directory)
+    return {
+        "activation_bytes": "deadbeef",
+        "audible_cdn": cdn.hostname,
+        "user_agent": USER_AGENT,
+        "aax_download_directory": directories["aax"],
+        "adh_directory": directories["adh"],
+        "adh_cache_file": os.path.join(directories["cache"], "adh"),
+        "aax_cache_file": os.path.join(directories["cache"], "aax"),
+        "sync_cache_file": os.path.join(directories["cache"], "sync"),
+        "cache_backend": args.cache_backend,
+        "remove_after_conversion": False,
+        "max_downloads": args.downloads,
+        "max_page_requests": args.page_requests,
+        "delta_sync": False,
+        "download_segments": 1,
+        "tsv_path": os.path.join(work_directory, "library_contents.tsv"),
+        "driver_config": {
+            "language": "us",
+            "audible_username": "",
+            "base_url": library.base_url,
+            "library_url": LibraryStandIn.LIBRARY_URL,
+            "browser_user_agent": BROWSER_USER_AGENT
+        },
+        "converter_config": {
+            "max_threads": args.conversions,
+            "library_directory": directories["library"],
+            "output_format": "mp3",
+            "ffmpeg_path": ffmpeg_path,
+            "stream_conversion": args.stream_conversion,
+            "chapter_parallel_min_duration": 0
+        }
+    }
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Run the whole archival pipeline against local stand-ins for the "
+                                                 "browser, the Audible website, the CDN and ffmpeg.")
+    parser.add_argument("--titles", type=int, default=100, help="Size of the synthetic library")
+    parser.add_argument("--title-size", type=int, default=1024, help="Synthetic AAX size in KiB")
+    parser.add_argument("--duration", type=float, default=3600, help="Running time written into each AAX")
+    parser.add_argument("--encode-seconds", type=float, default=0.05, help="Fake ffmpeg time per conversion")
+    parser.add_argument("--page-latency", type=float, default=0.0, help="Seconds per library page or ADH request")
+    parser.add_argument("--cdn-latency", type=float, default=0.0, help="Seconds before every CDN response")
+    parser.add_argument("--cdn-bandwidth", type=float, default=0.0, help="Shared CDN cap in MB/s, 0 for none")
+    parser.add_argument("--downloads", type=int, default=4)
+    parser.add_argument("--page-requests", type=int, default=4)
+    parser.add_argument("--conversions", type=int, default=4)
+    parser.add_argument("--stream-conversion", action="store_true")
+    parser.add_argument("--cache-backend", default="sqlite")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output")
+    parser.add_argument("--metrics-directory", help="Export the pipeline's metrics (events.jsonl, "
+                                                    "audible_archiver.prom) to this directory")
+    args = parser.parse_args(arguments)
+    work_directory = tempfile.mkdtemp()
+    os.environ["FAKE_FFMPEG_ENCODE_SECONDS"] = str(args.encode_seconds)
+    stage_timer = StageTimer()
+    InstrumentedAdhDownloader.stage_timer = stage_timer
+    InstrumentedLibraryDownloader.stage_timer = stage_timer
+    title_payloads = TitlePayloads(args.title_size * 1024, args.duration)
+    with LibraryStandIn(args.titles, latency=args.page_latency) as library, \
+            CdnStandIn(1, latency=args.cdn_latency, total_bandwidth=args.cdn_bandwidth * 1e6 or None,
+                       payload_factory=title_payloads) as cdn:
+        config = build_config(work_directory, library, cdn, write_ffmpeg_wrapper(work_directory), args)
+        output = sys.stdout if args.verbose else open(os.devnull, "w")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            if args.metrics_directory:
+                config["metrics"] = {
+                    "jsonl_path": os.path.join(args.metrics_directory, "events.jsonl"),
+                    "prometheus_path": os.path.join(args.metrics_directory, "audible_archiver.prom"),
+                    "export_interval": 1
+                }
+                PipelineMetrics.initialize(config)
+            SynchronizedCacheFile.initialize(config)
+            driver_config = AudibleDriverConfig(config["driver_config"])
+            activation_session_data = audible_archiver.create_activation_session_data(
+                driver_config, lambda: ("simulated", "simulated"), driver_type=FakeAudibleDriver)
+            audible_archiver.archive_library(config, driver_config, activation_session_data,
+                                             InstrumentedAdhDownloader, InstrumentedLibraryDownloader)
+        total_time = time.perf_counter() - start
+        converted = len(SynchronizedCacheFile("aax_cache_file").lookup("state", "converted"))
+    print("[*] {0} titles, {1} KiB each, {2} converted".format(args.titles, args.title_size, converted))
+    for line in stage_timer.report(start):
+        print(line)
+    print("[*] End to end: {0:.2f} s, {1:.1f} titles/s".format(total_time, converted / total_time))
+    shutil.rmtree(work_directory)
+    return 0 if converted == args.titles else 1
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.pipeline_simulator --titles 1000
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+import audible_archiver
+from audible_driver.driver_config import AudibleDriverConfig
+from audible_driver.session_store import SessionStore
+from benchmarks.library_stand_in import LibraryStandIn
+from benchmarks.pipeline_simulator import FakeAudibleDriver, BROWSER_USER_AGENT
+
+
+class CountingAudibleDriver(FakeAudibleDriver):
+    """
+        FakeAudibleDriver handing out whichever session token the library stand-in currently accepts, counting how
+        often it was asked to log on.
+    """
+
+    session_token = "simulated"
+    log_ons = 0
+
+    def log_on(self, username, password, mfa_token=None):
+        CountingAudibleDriver.log_ons += 1
+        super().log_on(username, password, mfa_token)
+
+    def get_activation_session_data(self):
+        return {
+            "data": {"playerToken": "simulated"},
+            "cookies": [{"name": "session-id", "value": "simulated"},
+                        {"name": "session-token", "value": self.session_token}]
+        }
+
+
+def sign_out(library, session_token):
+    library.set_session_token(session_token)
+    CountingAudibleDriver.session_token = session_token
+
+
+def corrupt_key_file(key_file):
+    with open(key_file, "wb") as outfile:
+        outfile.write(b"not a fernet key")
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Starts the archiver against a library stand-in that signs out "
+                                                 "sessions it doesn't recognise, and checks when a cached session is "
+                                                 "reused and when it logs on again.")
+    parser.add_argument("--verbose", action="store_true", help="Show the archiver's own output")
+    args = parser.parse_args(arguments)
+    work_directory = tempfile.mkdtemp()
+    session_store = SessionStore(os.path.join(work_directory, "session"), os.path.join(work_directory, "session.key"))
+    if not session_store.available:
+        print("[*] cryptography is not installed, nothing to check.")
+        return 0
+    # (name, change made before the run, whether the run should log on)
+    steps = [
+        ("first run", None, True),
+        ("cached session", None, False),
+        ("signed out", lambda: sign_out(library, "rotated"), True),
+        ("after logging on again", None, False),
+        ("corrupt key file", lambda: corrupt_key_file(os.path.join(work_directory, "session.key")), True),
+        ("after replacing the key", None, False)
+    ]
+    failed = False
+    try:
+        with LibraryStandIn(1, session_token=CountingAudibleDriver.session_token) as library:
+            driver_config = AudibleDriverConfig({
+                "language": "us",
+                "audible_username": "",
+                "base_url": library.base_url,
+                "library_url": LibraryStandIn.LIBRARY_URL,
+                "browser_user_agent": BROWSER_USER_AGENT
+            })
+            for name, change, expect_log_on in steps:
+                if change:
+                    change()
+                log_ons = CountingAudibleDriver.log_ons
+                output = sys.stdout if args.verbose else open(os.devnull, "w")
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(output):
+                    audible_archiver.create_activation_session_data(
+                        driver_config, lambda: ("simulated", "simulated"), session_store, CountingAudibleDriver)
+                elapsed = time.perf_counter() - start
+                logged_on = CountingAudibleDriver.log_ons > log_ons
+                print("[*] {0:<24} {1:<10} {2:>8.1f} ms  {3}".format(
+                    name, "logged on" if logged_on else "reused", elapsed * 1000,
+                    "as expected" if logged_on == expect_log_on else "EXPECTED THE OTHER WAY"))
+                failed = failed or logged_on != expect_log_on
+    finally:
+        shutil.rmtree(work_directory)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.session_reuse
+    sys.exit(main(sys.argv[1:]))
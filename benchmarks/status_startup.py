@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from synchronized_cache_file.storage import open_storage, STORAGE_BACKENDS
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("selenium", "requests", "urllib3", "progressbar", "bs4", "ffmpeg")
+# Runs the status command the way the entry point does and reports which heavy modules ended up imported
+STATUS_RUNNER = """
+import sys
+import audible_archiver
+exit_code = audible_archiver.main(["--config", sys.argv[1], "status"])
+sys.stderr.write(",".join(x for x in sys.argv[2:] if x in sys.modules))
+sys.exit(exit_code)
+"""
+
+
+def write_cache(file_path, backend, state):
+    storage = open_storage(file_path, backend)
+    storage.commit(state, state.keys())
+    storage.close()
+
+
+def write_library_caches(work_directory, title_count, backend):
+    """
+        Writes adh, aax and sync caches for title_count titles, a third each converted, downloaded and not started,
+        plus a few partial downloads, and returns a config pointing at them.
+    """
+    adh_state, aax_state = {}, {}
+    for i in range(title_count):
+        adh_identifier = "{0:040x}".format(i)
+        adh_state[adh_identifier] = os.path.join(work_directory, "adh", "{0:032x}.adh".format(i))
+        aax_file = os.path.join(work_directory, "aax", "Benchmark_Title_{0:06d}_AbCdEfGhIjKlMnOp.aax".format(i))
+        if i % 100 == 0:
+            aax_state[adh_identifier] = {"filepath": aax_file, "download_finished": False, "download_state": {
+                "tempfile": aax_file + ".part", "verified_offset": 1048576, "content_length": 104857600}}
+        elif i % 3 == 0:
+            aax_state[adh_identifier] = {"filepath": aax_file, "download_finished": True, "converted": True}
+        elif i % 3 == 1:
+            aax_state[adh_identifier] = {"filepath": aax_file, "download_finished": True}
+    now = time.time()
+    config = {
+        "adh_cache_file": os.path.join(work_directory, "adh_cache"),
+        "aax_cache_file": os.path.join(work_directory, "aax_cache"),
+        "sync_cache_file": os.path.join(work_directory, "sync_cache"),
+        "cache_backend": backend
+    }
+    write_cache(config["adh_cache_file"], backend, adh_state)
+    write_cache(config["aax_cache_file"], backend, aax_state)
+    write_cache(config["sync_cache_file"], backend, {"library": {
+        "high_water_mark": "{0:040x}".format(0), "last_sync": now, "last_full_sync": now}})
+    config_path = os.path.join(work_directory, "config.json")
+    with open(config_path, "w") as outfile:
+        outfile.write(json.dumps(config, indent=4))
+    return config_path
+
+
+def time_command(command, repeat):
+    times = []
+    stderr = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(command, cwd=REPOSITORY_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        times.append(time.perf_counter() - start)
+        if process.returncode:
+            raise RuntimeError("{0} failed: {1}".format(command, process.stderr))
+        stderr = process.stderr
+    return statistics.median(times), max(times), stderr
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Time the status command against a large download cache.")
+    parser.add_argument("--titles", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.3, help="Median seconds status may take, including "
+                                                                   "interpreter startup")
+    parser.add_argument("--backends", nargs="+", default=sorted(STORAGE_BACKENDS), choices=sorted(STORAGE_BACKENDS))
+    args = parser.parse_args(arguments)
+    interpreter_time, _, _ = time_command([sys.executable, "-c", "pass"], args.repeat)
+    print("[*] Interpreter startup: {0:8.1f} ms".format(interpreter_time * 1000))
+    over_budget = False
+    for backend in args.backends:
+        work_directory = tempfile.mkdtemp()
+        try:
+            config_path = write_library_caches(work_directory, args.titles, backend)
+            median_time, worst_time, loaded_modules = time_command(
+                [sys.executable, "-c", STATUS_RUNNER, config_path] + list(HEAVY_MODULES), args.repeat)
+        finally:
+            shutil.rmtree(work_directory)
+        over_budget = over_budget or median_time > args.budget
+        print("[*] status, {0} titles, {1:<6} {2:8.1f} ms median  {3:8.1f} ms worst  {4}".format(
+            args.titles, backend, median_time * 1000, worst_time * 1000,
+            "over budget" if median_time > args.budget else "within {0:.0f} ms".format(args.budget * 1000)))
+        if loaded_modules:
+            print("[*] status imported {0}".format(loaded_modules.replace(",", ", ")))
+            over_budget = True
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    # Run from the repository root: python -m benchmarks.status_startup
+    sys.exit(main(sys.argv[1:]))
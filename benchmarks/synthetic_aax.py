@@ -0,0 +1,67 @@
+import struct
+
+
+def _box(box_type, *payload):
+    payload = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def _full_box(box_type, *payload, version=0, flags=0):
+    return _box(box_type, struct.pack(">I", (version << 24) | flags), *payload)
+
+
+# Identity transformation matrix used by mvhd and tkhd
+_MATRIX = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def _descriptor(tag, *payload):
+    payload = b"".join(payload)
+    return struct.pack(">BB", tag, len(payload)) + payload
+
+
+def _build_esds(bit_rate):
+    decoder_config = _descriptor(
+        0x04, struct.pack(">BB", 0x40, 0x15), b"\x00\x00\x00", struct.pack(">II", bit_rate, bit_rate),
+        # AAC LC, 22050 Hz, stereo
+        _descriptor(0x05, b"\x13\x90"))
+    return _full_box(b"esds", _descriptor(0x03, struct.pack(">HB", 1, 0), decoder_config, _descriptor(0x06, b"\x02")))
+
+
+def _build_audio_track(duration, bit_rate, sample_rate):
+    tkhd = _full_box(b"tkhd", struct.pack(">IIIII", 0, 0, 1, 0, int(duration * 1000)), b"\x00" * 8,
+                     struct.pack(">hhhH", 0, 0, 0x0100, 0), _MATRIX, struct.pack(">II", 0, 0), flags=3)
+    mdhd = _full_box(b"mdhd", struct.pack(">IIIIHH", 0, 0, sample_rate, int(duration * sample_rate), 0x55c4, 0))
+    hdlr = _full_box(b"hdlr", struct.pack(">I4s", 0, b"soun"), b"\x00" * 12, b"SoundHandler\x00")
+    sample_entry = _box(b"aavd", b"\x00" * 6, struct.pack(">H", 1), b"\x00" * 8,
+                        struct.pack(">HHHHI", 2, 16, 0, 0, sample_rate << 16), _build_esds(bit_rate))
+    # The sample tables stay empty, nothing reading this header decodes audio
+    stbl = _box(b"stbl", _full_box(b"stsd", struct.pack(">I", 1), sample_entry),
+                _full_box(b"stts", struct.pack(">I", 0)), _full_box(b"stsc", struct.pack(">I", 0)),
+                _full_box(b"stsz", struct.pack(">II", 0, 0)), _full_box(b"stco", struct.pack(">I", 0)))
+    dinf = _box(b"dinf", _full_box(b"dref", struct.pack(">I", 1), _full_box(b"url ", flags=1)))
+    minf = _box(b"minf", _full_box(b"smhd", struct.pack(">hH", 0, 0)), dinf, stbl)
+    return _box(b"trak", tkhd, _box(b"mdia", mdhd, hdlr, minf))
+
+
+def _build_tags(tags):
+    items = []
+    for item_type, value in tags:
+        items.append(_box(item_type, _box(b"data", struct.pack(">II", 1, 0), value.encode("utf-8"))))
+    hdlr = _full_box(b"hdlr", struct.pack(">I4s", 0, b"mdir"), b"appl", b"\x00" * 8, b"\x00")
+    return _box(b"udta", _full_box(b"meta", hdlr, _box(b"ilst", *items)))
+
+
+def build_aax_head(title, artist, album, date, copyright, duration, bit_rate, audio_size, sample_rate=22050):
+    """
+        Everything of an AAX file up to the audio: ftyp, a moov box with the tags, running time and bit rate the
+        converter reads, and the mdat header for audio_size bytes of audio that follow.  moov comes first, like in
+        the files Audible serves, so the result can also be streamed.
+    """
+    ftyp = _box(b"ftyp", b"aax ", struct.pack(">I", 0x01000000), b"aax M4B mp42isom")
+    mvhd = _full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, int(duration * 1000)),
+                     struct.pack(">IhH", 0x00010000, 0x0100, 0), b"\x00" * 8, _MATRIX, b"\x00" * 24,
+                     struct.pack(">I", 2))
+    moov = _box(b"moov", mvhd, _build_audio_track(duration, bit_rate, sample_rate), _build_tags([
+        (b"\xa9nam", title), (b"\xa9ART", artist), (b"\xa9alb", album), (b"\xa9day", date), (b"cprt", copyright)
+    ]))
+    return ftyp + moov + struct.pack(">I4s", 8 + audio_size, b"mdat")
@@ -0,0 +1,179 @@
+import os
+import hashlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+ALGORITHM = "sha256"
+# Segmented downloads split files on multiples of this, so every block is written front to back by one stream
+BLOCK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+class BlockHashes(object):
+    """
+        Hashes a file as it's written, one hash per BLOCK_SIZE block.  Blocks may be written in any order and by
+        several threads, as long as each block is written front to back by one of them.  digest is the hash over all
+        block hashes, which is what verify_files() compares a file on disk against.
+    """
+
+    def __init__(self, size, digests=None, block_size=BLOCK_SIZE, algorithm=ALGORITHM):
+        self.size = size
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self._digests = dict(enumerate(digests or []))
+        # block index -> (hash object, next offset expected in that block)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def block_count(self):
+        return -(-self.size // self.block_size)
+
+    def update(self, offset, data):
+        while data:
+            index = offset // self.block_size
+            block_end = min((index + 1) * self.block_size, self.size)
+            length = min(len(data), block_end - offset)
+            with self._lock:
+                block_hash, expected_offset = self._pending.pop(index, (None, index * self.block_size))
+                if block_hash is None and offset == expected_offset:
+                    # (Re)starting at the front of the block
+                    block_hash = hashlib.new(self.algorithm)
+                    self._digests.pop(index, None)
+            # A block written out of order is left without a hash, so the file never gets a digest
+            if block_hash is not None and offset == expected_offset:
+                block_hash.update(data[:length])
+                with self._lock:
+                    if offset + length == block_end:
+                        self._digests[index] = block_hash.hexdigest()
+                    else:
+                        self._pending[index] = (block_hash, offset + length)
+            offset += length
+            data = data[length:]
+
+    def resume(self, file_path, offset):
+        """
+            Prepares for the file to be written on from offset.  Hashes of blocks before offset that weren't kept, and
+            the part of the block offset falls into, are read back from the file.
+        """
+        resume_index = offset // self.block_size
+        with self._lock:
+            self._digests = {i: x for i, x in self._digests.items() if i < resume_index}
+            self._pending = {}
+        with open(file_path, "rb") as infile:
+            for index in range(resume_index):
+                if index not in self._digests:
+                    self._digests[index] = self._hash_block(infile, index).hexdigest()
+            if offset % self.block_size:
+                block_hash = self._hash_block(infile, resume_index, offset)
+                if offset == self.size:
+                    self._digests[resume_index] = block_hash.hexdigest()
+                else:
+                    self._pending[resume_index] = (block_hash, offset)
+
+    def _hash_block(self, infile, index, end=None):
+        start = index * self.block_size
+        return hash_range(infile, start, min(start + self.block_size, self.size) if end is None else end,
+                          self.algorithm)
+
+    def get_digests(self, end):
+        """
+            Hashes of the unbroken run of blocks that lie entirely before end, to resume from later.
+        """
+        digests = []
+        with self._lock:
+            for index in range(min(end // self.block_size, self.block_count)):
+                if index not in self._digests:
+                    break
+                digests.append(self._digests[index])
+        return digests
+
+    @property
+    def digest(self):
+        digests = self.get_digests(self.size + self.block_size)
+        if len(digests) != self.block_count:
+            return None
+        return combine_digests(digests, self.algorithm)
+
+
+def combine_digests(digests, algorithm=ALGORITHM):
+    file_hash = hashlib.new(algorithm)
+    for digest in digests:
+        file_hash.update(bytes.fromhex(digest))
+    return file_hash.hexdigest()
+
+
+def hash_range(infile, start, end, algorithm=ALGORITHM):
+    range_hash = hashlib.new(algorithm)
+    infile.seek(start)
+    while start < end:
+        data = infile.read(min(READ_SIZE, end - start))
+        if not data:
+            break
+        range_hash.update(data)
+        start += len(data)
+    return range_hash
+
+
+def hash_file(file_path, block_size=BLOCK_SIZE, algorithm=ALGORITHM):
+    """
+        The digest BlockHashes arrives at for the file, read back from disk.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as infile:
+        digests = [hash_range(infile, x, min(x + block_size, size), algorithm).hexdigest()
+                   for x in range(0, size, block_size)]
+    return combine_digests(digests, algorithm)
+
+
+def get_file_record(file_path, digest=None):
+    """
+        The fields a finished download keeps in the aax cache to be verified against later.
+    """
+    file_stat = os.stat(file_path)
+    record = {"size": file_stat.st_size, "mtime": file_stat.st_mtime_ns}
+    if digest:
+        record["checksum"] = {"algorithm": ALGORITHM, "block_size": BLOCK_SIZE, "digest": digest}
+    return record
+
+
+def verify_file(cache_entry, deep=False):
+    """
+        Returns (result, record).  result is "ok", "missing", "truncated" (the size changed) or "corrupt" (the
+        checksum doesn't match).  The fast check only looks at size and mtime, a file whose mtime changed is hashed to
+        find out whether its content did too.  deep hashes every file.  record holds fields to update in the cache
+        entry when the file is fine but they're out of date, it's None otherwise.
+    """
+    try:
+        file_stat = os.stat(cache_entry["filepath"])
+    except OSError:
+        return "missing", None
+    if "size" not in cache_entry:
+        # Downloaded before checksums were kept, a deep check records what the file looks like now
+        return "ok", get_file_record(cache_entry["filepath"], hash_file(cache_entry["filepath"])) if deep else None
+    if file_stat.st_size != cache_entry["size"]:
+        return "truncated", None
+    if not deep and file_stat.st_mtime_ns == cache_entry["mtime"]:
+        return "ok", None
+    checksum = cache_entry.get("checksum")
+    if not checksum:
+        return "ok", get_file_record(cache_entry["filepath"], hash_file(cache_entry["filepath"]) if deep else None)
+    digest = hash_file(cache_entry["filepath"], checksum["block_size"], checksum["algorithm"])
+    if digest != checksum["digest"]:
+        return "corrupt", None
+    if file_stat.st_mtime_ns == cache_entry["mtime"]:
+        return "ok", None
+    record = get_file_record(cache_entry["filepath"])
+    record["checksum"] = checksum
+    return "ok", record
+
+
+def verify_files(cache_entries, deep=False, workers=None):
+    """
+        verify_file() for every entry, in order.  Files are hashed on a thread per core, hashlib and file reads don't
+        hold the GIL.
+    """
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        return list(executor.map(lambda x: verify_file(x, deep), cache_entries))
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import atexit
+import threading
+
+
+DURATION_BUCKETS = (0.005, 0.025, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 14400)
+THROUGHPUT_BUCKETS = (1e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8)
+
+# name -> (type, help, histogram buckets), every metric the pipeline reports
+METRICS = {
+    "stage_duration_seconds": ("histogram", "Time per item spent in each pipeline stage.", DURATION_BUCKETS),
+    "throughput_bytes_per_second": ("histogram", "Per title download and conversion rate.", THROUGHPUT_BUCKETS),
+    "library_pages_total": ("counter", "Library pages fetched.", None),
+    "adh_files_total": ("counter", "Helper files fetched, by result.", None),
+    "download_bytes_total": ("counter", "Audiobook bytes received from the CDN.", None),
+    "conversion_bytes_total": ("counter", "AAX bytes run through a finished conversion.", None),
+    "cache_commit_keys_total": ("counter", "Cache entries written to disk, by cache.", None),
+    "queue_depth": ("gauge", "Items waiting in each work queue.", None),
+    "download_stream_limit": ("gauge", "Downloads the scheduler currently lets run at once.", None),
+    "bandwidth_limit_bytes_per_second": ("gauge", "Download bandwidth budget in force, 0 when unlimited.", None),
+    "download_congestion_total": ("counter", "Throttled or dropped download responses.", None),
+    "files_verified_total": ("counter", "Downloaded titles checked before conversion, by result.", None)
+}
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Cumulative, like the exported _bucket series
+        self.bucket_counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsSpan(object):
+    """
+        Times one item through a stage.  Anything set on fields ends up in the item's JSON-lines event, a bytes field
+        also feeds the stage's throughput histogram.  result is reported as "error" when the block raised.
+    """
+
+    def __init__(self, metrics, stage, title, fields):
+        self._metrics = metrics
+        self._start = None
+        self.stage = stage
+        self.title = title
+        self.fields = fields
+        self.result = "ok"
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.result = "error"
+        self._metrics.record_span(self.stage, time.perf_counter() - self._start, self.title, self.result,
+                                  **self.fields)
+
+
+class PipelineMetrics(object):
+    """
+        Counters, histograms and gauges for every stage of the archival run, plus a span per item.  Spans and periodic
+        gauge snapshots go to a JSON-lines file as they happen, and everything is written out in the Prometheus text
+        format every export interval, for the node exporter's textfile collector.  Without export paths the numbers
+        are still kept, they just aren't written anywhere.
+    """
+    class __PipelineMetrics(object):
+
+        PREFIX = "audible_archiver_"
+
+        def __init__(self):
+            self._lock = threading.Lock()
+            self._counters = {}
+            self._histograms = {}
+            self._gauges = {}
+            self._jsonl_file = None
+            self._prometheus_path = None
+            self._export_interval = 15
+            self._stop_event = threading.Event()
+            self._export_thread = None
+
+        @staticmethod
+        def _get_key(name, labels):
+            if name not in METRICS:
+                raise ValueError("Unknown metric: {0}".format(name))
+            return name, tuple(sorted(labels.items()))
+
+        def increment(self, name, value=1, **labels):
+            key = self._get_key(name, labels)
+            with self._lock:
+                self._counters[key] = self._counters.get(key, 0) + value
+
+        def observe(self, name, value, **labels):
+            key = self._get_key(name, labels)
+            with self._lock:
+                if key not in self._histograms:
+                    self._histograms[key] = _Histogram(METRICS[name][2])
+                self._histograms[key].observe(value)
+
+        def set_gauge(self, name, value, **labels):
+            key = self._get_key(name, labels)
+            with self._lock:
+                self._gauges[key] = value
+
+        def track_gauge(self, name, callback, **labels):
+            """
+                callback() is read every time the metrics are exported, for values like queue sizes.
+            """
+            self.set_gauge(name, callback, **labels)
+
+        def span(self, stage, title="", **fields):
+            return MetricsSpan(self, stage, title, fields)
+
+        def record_span(self, stage, duration, title="", result="ok", **fields):
+            self.observe("stage_duration_seconds", duration, stage=stage, result=result)
+            if result == "ok" and fields.get("bytes") and duration > 0:
+                self.observe("throughput_bytes_per_second", fields["bytes"] / duration, stage=stage)
+            event = {"event": "span", "time": time.time(), "stage": stage, "title": title, "duration": duration,
+                     "result": result}
+            event.update(fields)
+            self.write_event(event)
+
+        def write_event(self, event):
+            if self._jsonl_file is None:
+                return
+            line = json.dumps(event) + "\n"
+            with self._lock:
+                if self._jsonl_file is not None:
+                    self._jsonl_file.write(line)
+                    self._jsonl_file.flush()
+
+        def _read_gauges(self):
+            gauges = {}
+            with self._lock:
+                tracked = list(self._gauges.items())
+            for key, value in tracked:
+                try:
+                    gauges[key] = value() if callable(value) else value
+                except Exception:
+                    # A queue that's gone away mustn't stop the export
+                    continue
+            return gauges
+
+        @staticmethod
+        def _format_labels(labels, extra_label=None):
+            labels = list(labels) + ([extra_label] if extra_label else [])
+            if not labels:
+                return ""
+            return "{{{0}}}".format(",".join('{0}="{1}"'.format(
+                name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                for name, value in labels))
+
+        def render_prometheus(self):
+            gauges = self._read_gauges()
+            with self._lock:
+                counters = dict(self._counters)
+                histograms = {key: (list(x.bucket_counts), x.sum, x.count) for key, x in self._histograms.items()}
+            lines = []
+            for name, (metric_type, description, buckets) in sorted(METRICS.items()):
+                series = {"counter": counters, "gauge": gauges, "histogram": histograms}[metric_type]
+                keys = sorted(x for x in series if x[0] == name)
+                if not keys:
+                    continue
+                full_name = self.PREFIX + name
+                lines.append("# HELP {0} {1}".format(full_name, description))
+                lines.append("# TYPE {0} {1}".format(full_name, metric_type))
+                for key in keys:
+                    labels = key[1]
+                    if metric_type != "histogram":
+                        lines.append("{0}{1} {2}".format(full_name, self._format_labels(labels), series[key]))
+                        continue
+                    bucket_counts, total, count = series[key]
+                    for upper_bound, bucket_count in zip(buckets, bucket_counts):
+                        lines.append("{0}_bucket{1} {2}".format(
+                            full_name, self._format_labels(labels, ("le", repr(float(upper_bound)))), bucket_count))
+                    lines.append("{0}_bucket{1} {2}".format(full_name, self._format_labels(labels, ("le", "+Inf")),
+                                                            count))
+                    lines.append("{0}_sum{1} {2}".format(full_name, self._format_labels(labels), total))
+                    lines.append("{0}_count{1} {2}".format(full_name, self._format_labels(labels), count))
+            return "\n".join(lines) + "\n"
+
+        def export(self):
+            if self._jsonl_file is not None:
+                gauges = self._read_gauges()
+                self.write_event({"event": "gauges", "time": time.time(), "gauges": [
+                    dict(key[1], name=key[0], value=value) for key, value in sorted(gauges.items())]})
+            if self._prometheus_path:
+                # Written next to the target and swapped in, the collector must never read half a file
+                temp_path = self._prometheus_path + ".tmp"
+                with open(temp_path, "w") as outfile:
+                    outfile.write(self.render_prometheus())
+                os.replace(temp_path, self._prometheus_path)
+
+        def _export_worker(self):
+            while not self._stop_event.wait(self._export_interval):
+                try:
+                    self.export()
+                except OSError as e:
+                    print("[*] Unable to export metrics: {0}".format(e))
+
+        def start(self, jsonl_path=None, prometheus_path=None, export_interval=15):
+            if self._export_thread:
+                return
+            for file_path in (jsonl_path, prometheus_path):
+                if file_path:
+                    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+            if jsonl_path:
+                self._jsonl_file = open(jsonl_path, "a")
+            self._prometheus_path = prometheus_path
+            self._export_interval = export_interval
+            if jsonl_path or prometheus_path:
+                self._stop_event.clear()
+                self._export_thread = threading.Thread(target=self._export_worker)
+                self._export_thread.setDaemon(True)
+                self._export_thread.start()
+
+        def stop(self):
+            if not self._export_thread:
+                return
+            self._stop_event.set()
+            self._export_thread.join()
+            self._export_thread = None
+            self.export()
+            with self._lock:
+                if self._jsonl_file is not None:
+                    self._jsonl_file.close()
+                    self._jsonl_file = None
+
+    __instance = None
+
+    def __new__(cls):
+        if not PipelineMetrics.__instance:
+            PipelineMetrics.__instance = PipelineMetrics.__PipelineMetrics()
+            atexit.register(PipelineMetrics.__instance.stop)
+        return PipelineMetrics.__instance
+
+    @staticmethod
+    def initialize(config):
+        metrics_config = config.get("metrics") or {}
+        PipelineMetrics().start(metrics_config.get("jsonl_path"), metrics_config.get("prometheus_path"),
+                                metrics_config.get("export_interval", 15))
@@ -1,10 +1,15 @@
 import os
-import time
-import json
 import queue
 import atexit
 import threading
 
+from pipeline_metrics import PipelineMetrics
+
+try:
+    from synchronized_cache_file.storage import open_storage
+except ImportError:
+    from storage import open_storage
+
 
 class SynchronizedCacheFile(object):
     """
@@ -13,21 +18,49 @@ class SynchronizedCacheFile(object):
     """
     class __SynchronizedCacheFile(object):
 
-        def __init__(self, file_path):
-            self._index = 0
+        _STOP_REQUEST = object()
+
+        def __init__(self, file_path, backend="json"):
             self._state = {}
+            self._indexes = {}
+            self._storage = None
+            self._backend = backend
+            self._dirty_keys = set()
             self._active = False
-            self._no_write = False
             self._write_thread = None
             self._file_path = file_path
+            self._state_lock = threading.Lock()
             self._access_queue = queue.Queue()
 
         def __getitem__(self, item):
-            self._wait_for_changes()
             return self._state[item]
 
         def __setitem__(self, key, value):
-            self._access_queue.put((key, value))
+            # Applied to the in-memory state right away so every later read sees it, the writer persists it later
+            with self._state_lock:
+                if key in self._state:
+                    self._update_indexes(key, self._state[key], remove=True)
+                self._state[key] = value
+                self._update_indexes(key, value)
+                self._dirty_keys.add(key)
+            self._access_queue.put(None)
+
+        def update(self, entries):
+            # Several writes applied together and handed to the writer as a single commit
+            with self._state_lock:
+                for key, value in entries.items():
+                    if key in self._state:
+                        self._update_indexes(key, self._state[key], remove=True)
+                    self._state[key] = value
+                    self._update_indexes(key, value)
+                    self._dirty_keys.add(key)
+            self._access_queue.put(None)
+
+        def __contains__(self, item):
+            return item in self._state
+
+        def __len__(self):
+            return len(self._state)
 
         def __enter__(self):
             return self
@@ -36,55 +69,104 @@ class SynchronizedCacheFile(object):
             self.flush()
 
         def __iter__(self):
-            self._index = 0
-            return self
+            # Iterates over a snapshot of the keys, so writes made while iterating don't disturb the loop
+            with self._state_lock:
+                return iter(list(self._state))
 
-        def __next__(self):
-            keys = list(self._state.keys())
-            try:
-                item = keys[self._index]
-            except IndexError:
-                raise StopIteration()
-            self._index += 1
-            return item
+        def get(self, key, default=None):
+            return self._state.get(key, default)
 
+        def items(self):
+            with self._state_lock:
+                return list(self._state.items())
 
-        def _worker_thread(self):
-            i = 0
-            while self._active:
-                if not self._access_queue.empty():
-                    key, value = self._access_queue.get()
-                    self._state[key] = value
-                    i = (i + 1) % 3
-                    if not i and not self._no_write:
-                        self._save_state(self._state)
+        def _update_indexes(self, key, value, remove=False):
+            for key_function, index in self._indexes.values():
+                index_value = key_function(value)
+                if index_value is None:
                     continue
-                time.sleep(0.1)
+                if remove:
+                    index[index_value].discard(key)
+                    if not index[index_value]:
+                        del index[index_value]
+                else:
+                    index.setdefault(index_value, set()).add(key)
+
+        def create_index(self, name, key_function):
+            """
+                Maintains a secondary index of key_function(value) -> keys.  Values for which key_function returns
+                None are left out.  Creating an index that already exists rebuilds it.
+            """
+            with self._state_lock:
+                self._indexes[name] = (key_function, {})
+                for key, value in self._state.items():
+                    index_value = key_function(value)
+                    if index_value is not None:
+                        self._indexes[name][1].setdefault(index_value, set()).add(key)
+
+        def lookup(self, index_name, index_value):
+            with self._state_lock:
+                return set(self._indexes[index_name][1].get(index_value, ()))
 
-        def _wait_for_changes(self, timeout=1):
-            while not self._access_queue.empty() and timeout:
-                time.sleep(0.1)
-                timeout -= 1
+        def _worker_thread(self):
+            active = True
+            while active:
+                # Sleep until there's work, then take everything that queued up meanwhile and commit it as one group
+                pending = [self._access_queue.get()]
+                while True:
+                    try:
+                        pending.append(self._access_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                error = None
+                try:
+                    self._save_state()
+                except Exception as e:
+                    # The writer has to outlive a failed commit, or every later flush() would wait for it forever
+                    print("[*] Unable to save {0}: {1}".format(self._file_path, e))
+                    error = e
+                for request in pending:
+                    if request is self._STOP_REQUEST:
+                        active = False
+                    elif request is not None:
+                        request.error = error
+                        request.set()
 
         def _load_state(self):
-            state = {}
-            if os.path.isfile(self._file_path):
-                with open(self._file_path, "r") as infile:
-                    state_content = infile.read()
-                state = json.loads(state_content)
-            return state
-
-        def _save_state(self, state):
-            with open(self._file_path, "w") as outfile:
-                outfile.write(json.dumps(state, indent=4))
+            return self._storage.load()
+
+        def _save_state(self):
+            # The JSON backend rewrites everything, SQLite only upserts the keys written since the last commit
+            with self._state_lock:
+                changed_keys, self._dirty_keys = self._dirty_keys, set()
+                if self._storage.full_rewrite:
+                    state = dict(self._state)
+                else:
+                    state = {key: self._state[key] for key in changed_keys}
+            if changed_keys:
+                cache_name = os.path.basename(self._file_path)
+                try:
+                    with PipelineMetrics().span("cache_commit", cache_name, keys=len(changed_keys),
+                                                backend=self._backend):
+                        self._storage.commit(state, changed_keys)
+                except Exception:
+                    # Still unsaved, the next commit tries them again
+                    with self._state_lock:
+                        self._dirty_keys |= changed_keys
+                    raise
+                PipelineMetrics().increment("cache_commit_keys_total", len(changed_keys), cache=cache_name)
 
         def flush(self):
-            self._no_write = True
-            self._wait_for_changes(5)
-            self._save_state(self._state)
-            self._no_write = False
+            if not self._active:
+                return
+            committed = threading.Event()
+            self._access_queue.put(committed)
+            committed.wait()
+            if committed.error is not None:
+                raise committed.error
 
         def start(self):
+            self._storage = open_storage(self._file_path, self._backend)
             self._state = self._load_state()
             self._active = True
             self._write_thread = threading.Thread(target=self._worker_thread)
@@ -93,12 +175,12 @@ class SynchronizedCacheFile(object):
 
         def stop(self):
             if self._active:
-                self.flush()
+                self._access_queue.put(self._STOP_REQUEST)
+                self._write_thread.join()
+                self._write_thread = None
                 self._active = False
-                if self._write_thread:
-                    self._write_thread.join()
-                    self._write_thread = None
-                self._save_state(self._state)
+                self._save_state()
+                self._storage.close()
 
     __instances = {}
 
@@ -107,10 +189,10 @@ class SynchronizedCacheFile(object):
         for instance_type in SynchronizedCacheFile.__instances:
             SynchronizedCacheFile.__instances[instance_type].stop()
 
-    def __new__(cls, arg):
+    def __new__(cls, arg, backend="json"):
         if type(arg) is dict:
             for instance_type in arg:
-                new_instance = SynchronizedCacheFile.__SynchronizedCacheFile(arg[instance_type])
+                new_instance = SynchronizedCacheFile.__SynchronizedCacheFile(arg[instance_type], backend)
                 new_instance.start()
                 SynchronizedCacheFile.__instances[instance_type] = new_instance
             atexit.register(SynchronizedCacheFile._cleanup)
@@ -127,26 +209,8 @@ class SynchronizedCacheFile(object):
         cache_file_keys = ["adh_cache_file", "aax_cache_file"]
         for cache_file_key in cache_file_keys:
             cache_files[cache_file_key] = config[cache_file_key]
-        SynchronizedCacheFile(cache_files)
-
-
-def test_function(cache, index):
-    import hashlib
-    print(i)
-    value = hashlib.sha1(bytes(index)).hexdigest()
-    cache[value] = index
-
-
-if __name__ == "__main__":
-    caches = {
-        "aax_cache": "aax.test",
-        "adh_cache": "adh.test"
-    }
-    SynchronizedCacheFile(caches)
-
-    for cache_file in caches:
-        with SynchronizedCacheFile(cache_file) as cache:
-            for i in range(5000):
-                for value in [i, i*2]:
-                    t = threading.Thread(target=test_function, args=(cache, value))
-                    t.start()
\ No newline at end of file
+        # Optional, older configs don't have a library sync state or metadata cache
+        for cache_file_key in ("sync_cache_file", "metadata_cache_file"):
+            if cache_file_key in config:
+                cache_files[cache_file_key] = config[cache_file_key]
+        SynchronizedCacheFile(cache_files, config.get("cache_backend", "json"))
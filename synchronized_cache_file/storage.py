@@ -0,0 +1,100 @@
+import os
+import json
+import sqlite3
+
+
+class JsonCacheStorage(object):
+    """
+        The original storage format: the whole cache as one indented JSON document.  Every commit rewrites the file,
+        but it's written next to the original and swapped in so a crash can't leave half a document behind.
+    """
+
+    full_rewrite = True
+
+    def __init__(self, file_path):
+        self._file_path = file_path
+
+    def load(self):
+        state = {}
+        if os.path.isfile(self._file_path):
+            with open(self._file_path, "r") as infile:
+                state_content = infile.read()
+            state = json.loads(state_content)
+        return state
+
+    def commit(self, state, changed_keys):
+        temp_path = self._file_path + ".tmp"
+        with open(temp_path, "w") as outfile:
+            outfile.write(json.dumps(state, indent=4))
+        os.replace(temp_path, self._file_path)
+
+    def close(self):
+        pass
+
+
+class SqliteCacheStorage(object):
+    """
+        One row per cache key in a WAL-mode SQLite database, so a commit only touches the keys that changed.  The
+        database lives next to the JSON cache it replaces, which is imported once, the first time it can be read.
+    """
+
+    FILE_SUFFIX = ".sqlite3"
+    full_rewrite = False
+
+    def __init__(self, file_path):
+        self._json_path = file_path
+        self._db_path = file_path + self.FILE_SUFFIX
+        # Only the cache's writer thread commits, reads happen before it starts and after it stops
+        self._connection = sqlite3.connect(self._db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.commit()
+        if not self._is_json_imported():
+            self.import_json_cache(self._json_path)
+
+    def _is_json_imported(self):
+        if self._connection.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+            return True
+        # Databases from before the import was recorded only count as imported once they hold entries, an empty one
+        # may be what a failed import left behind
+        return self._connection.execute("SELECT 1 FROM cache LIMIT 1").fetchone() is not None
+
+    def import_json_cache(self, json_path):
+        """
+            Copies the JSON cache into the database and records that it was done, in one transaction.  If the JSON
+            can't be read nothing is recorded, so the import is tried again on the next start.
+        """
+        state = JsonCacheStorage(json_path).load()
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                                         [(key, json.dumps(value)) for key, value in state.items()])
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)",
+                                     (json_path, ))
+        if state:
+            print("[*] Imported {0} entries from {1} into {2}".format(len(state), json_path, self._db_path))
+        return len(state)
+
+    def load(self):
+        return {key: json.loads(value) for key, value in self._connection.execute("SELECT key, value FROM cache")}
+
+    def commit(self, state, changed_keys):
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                                         [(key, json.dumps(state[key])) for key in changed_keys])
+
+    def close(self):
+        self._connection.close()
+
+
+STORAGE_BACKENDS = {
+    "json": JsonCacheStorage,
+    "sqlite": SqliteCacheStorage
+}
+
+
+def open_storage(file_path, backend="json"):
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError("Invalid cache backend: {0}".format(backend))
+    return STORAGE_BACKENDS[backend](file_path)